@@ -0,0 +1,332 @@
+import os
+import io
+import json
+import random
+import shutil
+import subprocess
+import tempfile
+import time
+import argparse
+from concurrent.futures import ProcessPoolExecutor
+from contextlib import nullcontext, redirect_stdout
+from datetime import datetime, timezone
+from git_indexer import GitRepoIndexer, SearchService, SearchFilters
+
+# resource is Unix only, peak RSS is not measured elsewhere
+try:
+    import resource
+except ImportError:
+    resource = None
+
+WORDS = [
+    'alpha', 'buffer', 'cache', 'delta', 'event', 'filter', 'graph', 'handle',
+    'index', 'journal', 'kernel', 'lookup', 'merge', 'node', 'offset',
+    'packet', 'query', 'record', 'socket', 'token', 'update', 'vector',
+    'worker', 'yield', 'zone'
+]
+KEYWORDS = ['def', 'return', 'class', 'import', 'if', 'for', 'while']
+BINARY_SUFFIXES = ['.png', '.bin', '.dat']
+TEXT_SUFFIXES = ['.py', '.txt', '.md', '.c']
+
+# (name, target, mode, query, sort) run against every generated corpus
+QUERY_MIX = [
+    ('word', 'history', 'query', 'buffer', 'score'),
+    ('two_words', 'history', 'query', 'cache AND socket', 'score'),
+    ('rare_word', 'history', 'query', 'zone_7', 'score'),
+    ('phrase', 'history', 'query', '"merge node"', 'score'),
+    ('newest', 'history', 'query', 'kernel', 'date'),
+    ('literal', 'history', 'literal', 'return packet', 'score'),
+    ('regex', 'history', 'regex', r'def (cache|vector)_\d+', 'score'),
+    ('snapshot', 'snapshot', 'query', 'journal', 'score')
+]
+
+
+def text_content(rng, size, seed):
+    """Generate source-like text of about size bytes"""
+    lines = []
+    length = 0
+    while length < size:
+        line = ' '.join([rng.choice(KEYWORDS)] + [
+            f'{rng.choice(WORDS)}_{rng.randrange(seed % 50 + 10)}'
+            if rng.random() < 0.3 else rng.choice(WORDS)
+            for _ in range(rng.randint(3, 10))])
+        lines.append(line)
+        length += len(line) + 1
+
+    return ('\n'.join(lines) + '\n').encode('utf-8')
+
+
+def binary_content(rng, size):
+    return b'\0' + bytes(rng.getrandbits(8) for _ in range(size - 1))
+
+
+def file_content(rng, path, size, seed):
+    if os.path.splitext(path)[1] in BINARY_SUFFIXES:
+        return binary_content(rng, size)
+
+    return text_content(rng, size, seed)
+
+
+def fast_import_stream(rng, commits, files, file_size, binary_ratio,
+                       changes_per_commit):
+    """Yield a git fast-import stream building a linear history"""
+    paths = []
+    for i in range(files):
+        suffixes = BINARY_SUFFIXES if rng.random() < binary_ratio else TEXT_SUFFIXES
+        paths.append(f'dir_{i % 10}/file_{i}{rng.choice(suffixes)}')
+
+    timestamp = 1_600_000_000
+    for number in range(commits):
+        changed = paths if number == 0 else rng.sample(
+            paths, min(changes_per_commit, len(paths)))
+        message = f'commit {number}'.encode('utf-8')
+
+        yield b'commit refs/heads/main\n'
+        author = f'Bench Author {number % 5} <bench{number % 5}@example.com>'
+        yield f'author {author} {timestamp} +0000\n'.encode('utf-8')
+        yield f'committer {author} {timestamp} +0000\n'.encode('utf-8')
+        yield b'data %d\n%s\n' % (len(message), message)
+
+        for path in changed:
+            size = max(1, int(rng.expovariate(1 / file_size)))
+            data = file_content(rng, path, size, number)
+            yield f'M 100644 inline {path}\n'.encode('utf-8')
+            yield b'data %d\n%s\n' % (len(data), data)
+
+        timestamp += 3600
+
+
+def generate_repo(path, seed, commits, files, file_size, binary_ratio,
+                  changes_per_commit):
+    """Create a git repository with a synthetic linear history"""
+    rng = random.Random(seed)
+    subprocess.run(['git', 'init', '--quiet', path], check=True)
+    subprocess.run(['git', '-C', path, 'symbolic-ref', 'HEAD',
+                    'refs/heads/main'], check=True)
+
+    process = subprocess.Popen(['git', '-C', path, 'fast-import', '--quiet'],
+                               stdin=subprocess.PIPE)
+    for chunk in fast_import_stream(rng, commits, files, file_size,
+                                    binary_ratio, changes_per_commit):
+        process.stdin.write(chunk)
+    process.stdin.close()
+    if process.wait() != 0:
+        raise RuntimeError(f"git fast-import failed for {path}")
+
+
+def directory_size(path):
+    return sum(os.path.getsize(os.path.join(root, filename))
+               for root, _, filenames in os.walk(path)
+               for filename in filenames)
+
+
+def percentile(values, percent):
+    """Nearest-rank percentile of a list of numbers"""
+    ordered = sorted(values)
+    rank = max(1, -(-len(ordered) * percent // 100))
+    return ordered[int(rank) - 1]
+
+
+def run_index(repos_dir, index_dir, jobs, verbose, pack_reader=False):
+    """Index the corpus, runs in its own process so its peak RSS is its own
+
+    Peak RSS is None where the resource module is not available.
+    """
+    with nullcontext() if verbose else redirect_stdout(io.StringIO()):
+        indexer = GitRepoIndexer(repos_dir, index_dir, pack_reader=pack_reader)
+        metrics = indexer.index_repos(jobs=jobs)
+        indexer.index_snapshot()
+
+    if resource is None:
+        return metrics.summary(), None, None
+
+    return (metrics.summary(),
+            resource.getrusage(resource.RUSAGE_SELF).ru_maxrss,
+            resource.getrusage(resource.RUSAGE_CHILDREN).ru_maxrss)
+
+
+def measure_search(repos_dir, index_dir, repeat):
+    """Time every query of the mix against a warm, uncached SearchService"""
+    indexer = GitRepoIndexer(repos_dir, index_dir)
+    service = SearchService(indexer, cache_size=0)
+    results = {}
+    all_timings = []
+    try:
+        for name, target, mode, query, sort in QUERY_MIX:
+            timings = []
+            count = 0
+            with redirect_stdout(io.StringIO()):
+                for _ in range(repeat):
+                    start = time.perf_counter()
+                    body = service.search(query, target, 100, mode, False,
+                                          SearchFilters(), sort)
+                    timings.append((time.perf_counter() - start) * 1000)
+                    count = len(body['results'])
+
+            all_timings.extend(timings)
+            results[name] = {
+                'query': query,
+                'target': target,
+                'mode': mode,
+                'sort': sort,
+                'results': count,
+                'p50_ms': round(percentile(timings, 50), 3),
+                'p99_ms': round(percentile(timings, 99), 3)
+            }
+    finally:
+        service.close()
+
+    return {
+        'p50_ms': round(percentile(all_timings, 50), 3),
+        'p99_ms': round(percentile(all_timings, 99), 3),
+        'queries': results
+    }
+
+
+def git_revision():
+    """Get the commit of the indexer being measured, None outside a checkout"""
+    result = subprocess.run(
+        ['git', '-C', os.path.dirname(os.path.abspath(__file__)),
+         'rev-parse', '--short', 'HEAD'],
+        capture_output=True, text=True)
+    return result.stdout.strip() or None
+
+
+def print_comparison(report, baseline):
+    """Print the change of the headline numbers against an earlier report"""
+    rows = [
+        ('index files/s', report['index']['files_per_sec'],
+         baseline['index']['files_per_sec']),
+        ('index MB/s', report['index']['mb_per_sec'],
+         baseline['index']['mb_per_sec']),
+        ('index size', report['index']['index_bytes'],
+         baseline['index']['index_bytes']),
+        ('peak RSS', report['index']['peak_rss_kb'],
+         baseline['index']['peak_rss_kb']),
+        ('search p50 ms', report['search']['p50_ms'],
+         baseline['search']['p50_ms']),
+        ('search p99 ms', report['search']['p99_ms'],
+         baseline['search']['p99_ms'])
+    ]
+    print(f"Compared with {baseline.get('revision')} "
+          f"from {baseline.get('created')}:")
+    for label, current, previous in rows:
+        if current is None or previous is None:
+            print(f"  {label}: {'n/a' if previous is None else previous} -> "
+                  f"{'n/a' if current is None else current}")
+            continue
+
+        change = (current - previous) / previous * 100 if previous else 0.0
+        print(f"  {label}: {previous} -> {current} ({change:+.1f}%)")
+
+
+def main():
+    parser = argparse.ArgumentParser(
+        description='Benchmark git_indexer on generated repositories')
+    parser.add_argument('--repos', type=int, default=2,
+                        help='Number of repositories to generate')
+    parser.add_argument('--commits', type=int, default=200,
+                        help='Commits per repository')
+    parser.add_argument('--files', type=int, default=100,
+                        help='Files per repository')
+    parser.add_argument('--file-size', type=int, default=4096,
+                        help='Mean file size in bytes')
+    parser.add_argument('--binary-ratio', type=float, default=0.1,
+                        help='Fraction of files with binary content')
+    parser.add_argument('--changes', type=int, default=5,
+                        help='Files changed by each commit after the first')
+    parser.add_argument('--seed', type=int, default=1,
+                        help='Seed for the generated content')
+    parser.add_argument('-j', '--jobs', type=int, default=1,
+                        help='Worker processes to index with')
+    parser.add_argument('--pack-reader', action='store_true',
+                        help='Index with the packfile reader')
+    parser.add_argument('--repeat', type=int, default=20,
+                        help='Times to run each query of the mix')
+    parser.add_argument('--work-dir',
+                        help='Directory to create the repositories and index '
+                        'in, a temporary one by default')
+    parser.add_argument('--keep', action='store_true',
+                        help='Keep the work directory afterwards')
+    parser.add_argument('--baseline',
+                        help='Earlier JSON report to compare against')
+    parser.add_argument('-o', '--output', default='benchmark.json',
+                        help='Where to write the JSON report')
+    parser.add_argument('-v', '--verbose', action='store_true',
+                        help='Show the output of the indexer')
+    args = parser.parse_args()
+
+    work_dir = args.work_dir or tempfile.mkdtemp(prefix='git_indexer_bench_')
+    repos_dir = os.path.join(work_dir, 'repos')
+    index_dir = os.path.join(work_dir, 'index')
+    shutil.rmtree(repos_dir, ignore_errors=True)
+    shutil.rmtree(index_dir, ignore_errors=True)
+    os.makedirs(repos_dir)
+
+    try:
+        start = time.perf_counter()
+        for i in range(args.repos):
+            generate_repo(os.path.join(repos_dir, f'repo_{i}'), args.seed + i,
+                          args.commits, args.files, args.file_size,
+                          args.binary_ratio, args.changes)
+        print(f"Generated {args.repos} repositories in "
+              f"{time.perf_counter() - start:.1f}s")
+
+        with ProcessPoolExecutor(max_workers=1) as pool:
+            summary, rss_self, rss_children = pool.submit(
+                run_index, repos_dir, index_dir, args.jobs,
+                args.verbose, args.pack_reader).result()
+        print(f"Indexed {summary['files']} files at "
+              f"{summary['files_per_sec']} files/s")
+
+        search = measure_search(repos_dir, index_dir, args.repeat)
+        print(f"Search latency p50 {search['p50_ms']} ms, "
+              f"p99 {search['p99_ms']} ms")
+
+        report = {
+            'created': datetime.now(timezone.utc).isoformat(),
+            'revision': git_revision(),
+            'config': {
+                'repos': args.repos,
+                'commits': args.commits,
+                'files': args.files,
+                'file_size': args.file_size,
+                'binary_ratio': args.binary_ratio,
+                'changes': args.changes,
+                'seed': args.seed,
+                'jobs': args.jobs,
+                'pack_reader': args.pack_reader,
+                'repeat': args.repeat
+            },
+            'index': {
+                'seconds': summary['seconds'],
+                'files': summary['files'],
+                'blobs': summary['blobs'],
+                'bytes': summary['bytes'],
+                'files_per_sec': summary['files_per_sec'],
+                'mb_per_sec': summary['mb_per_sec'],
+                'index_bytes': directory_size(index_dir),
+                'peak_rss_kb': rss_self,
+                'peak_child_rss_kb': rss_children,
+                'stages': summary['stages']
+            },
+            'search': search
+        }
+    finally:
+        if not args.keep:
+            shutil.rmtree(repos_dir, ignore_errors=True)
+            shutil.rmtree(index_dir, ignore_errors=True)
+            if not args.work_dir:
+                os.rmdir(work_dir)
+
+    with open(args.output, 'w') as f:
+        json.dump(report, f, indent=2)
+    print(f"Wrote benchmark report to {args.output}")
+
+    if args.baseline:
+        with open(args.baseline) as f:
+            print_comparison(report, json.load(f))
+
+
+if __name__ == '__main__':
+    main()
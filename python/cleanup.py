@@ -1,10 +1,15 @@
 import os
 import sys
-import sqlite3
+import hashlib
 from argparse import ArgumentParser
-import sys
+from collections import defaultdict
+from concurrent.futures import ThreadPoolExecutor
+from lib.directory_tree import connect
 
 CHUNK_SIZE = 10000
+SAMPLE_SIZE = 4096
+READ_BUFFER = 1024 * 1024
+DEFAULT_THREADS = min(32, (os.cpu_count() or 1) + 4)
 sys.stdout.reconfigure(encoding='utf-8')
 
 
@@ -30,71 +35,282 @@ def read_args():
         action="store_true",
         help="When set, only prints the files to delete, does not delete them"
     )
+    parser.add_argument(
+        "-c",
+        "--content",
+        action="store_true",
+        help=("Find duplicates by comparing file contents instead of relative "
+              "path and modified time, empty files are left alone")
+    )
+    parser.add_argument(
+        "-t",
+        "--threads",
+        type=int,
+        default=DEFAULT_THREADS,
+        help=f"Threads hashing files with --content (default {DEFAULT_THREADS})"
+    )
     args = parser.parse_args()
 
     directory_path = args.directory
     if not os.path.isdir(directory_path):
         raise ValueError(f"[{directory_path}] is not a valid directory")
 
-    return directory_path, args.dry_run
+    return directory_path, args.dry_run, args.content, args.threads
+
+
+def stat_file(file_path):
+    try:
+        stat = os.stat(file_path)
+    except OSError:
+        return None
+
+    return stat.st_size, stat.st_mtime_ns, stat.st_ino
+
+
+def sample_hash(file_path, size):
+    digest = hashlib.blake2b()
+    try:
+        with open(file_path, 'rb', buffering=0) as f:
+            if size <= 2 * SAMPLE_SIZE:
+                digest.update(f.read())
+            else:
+                digest.update(f.read(SAMPLE_SIZE))
+                f.seek(-SAMPLE_SIZE, os.SEEK_END)
+                digest.update(f.read(SAMPLE_SIZE))
+    except OSError:
+        return None
+
+    return digest.hexdigest()
+
+
+def full_hash(file_path):
+    digest = hashlib.blake2b()
+    buffer = bytearray(READ_BUFFER)
+    view = memoryview(buffer)
+    try:
+        with open(file_path, 'rb', buffering=0) as f:
+            while read := f.readinto(buffer):
+                digest.update(view[:read])
+    except OSError:
+        return None
+
+    return digest.hexdigest()
+
+
+def colliding(groups):
+    return [row for rows in groups.values() if len(rows) > 1 for row in rows]
+
+
+def hash_files(conn, directory_path, threads):
+    # Only files sharing their size get a sample hash of their first and last
+    # bytes, and only files sharing that get hashed in full. Hashes of files
+    # whose size, modified time and inode did not change are reused. Sizes
+    # are taken from the crawl and checked again for the files sharing them.
+    cursor = conn.cursor()
+    cursor.execute('SELECT COUNT(*) FROM files')
+    total, = cursor.fetchone()
+    cursor.execute('''
+        SELECT f.parent_id, f.directory_id, f.name, p.name, d.path
+        FROM files f
+        JOIN parents p ON p.id = f.parent_id
+        JOIN directories d ON d.id = f.directory_id
+        WHERE f.size IN (
+            SELECT size FROM files WHERE size > 0
+            GROUP BY size HAVING COUNT(*) > 1
+        )
+    ''')
+    rows = cursor.fetchall()
+    cursor.execute('''
+        SELECT parent_id, directory_id, name, size, mtime_ns, inode,
+            sample_hash, full_hash
+        FROM file_hashes
+    ''')
+    cached = {tuple(row[:3]): row[3:] for row in cursor}
+
+    def file_path(row):
+        parent_id, directory, name, parent, path = row
+        return os.path.join(directory_path, parent, path, name)
+
+    with ThreadPoolExecutor(max_workers=threads) as pool:
+        stats = {}
+        for row, stat in zip(rows, pool.map(stat_file, map(file_path, rows))):
+            if stat is not None and stat[0] > 0:
+                stats[row] = stat
+
+        by_size = defaultdict(list)
+        for row, (size, *_) in stats.items():
+            by_size[size].append(row)
+        candidates = colliding(by_size)
+        print(f"{total} files, {len(candidates)} share their size")
+
+        hashes = {}
+        to_sample = []
+        for row in candidates:
+            entry = cached.get(row[:3])
+            if entry and tuple(entry[:3]) == stats[row] and entry[3]:
+                hashes[row] = [entry[3], entry[4]]
+            else:
+                to_sample.append(row)
+
+        samples = pool.map(lambda row: sample_hash(file_path(row), stats[row][0]),
+                           to_sample)
+        for row, sample in zip(to_sample, samples):
+            if sample is not None:
+                hashes[row] = [sample, None]
+
+        by_sample = defaultdict(list)
+        for row, (sample, _) in hashes.items():
+            by_sample[stats[row][0], sample].append(row)
+        candidates = colliding(by_sample)
+        print(f"{len(candidates)} share their first and last "
+              f"{SAMPLE_SIZE} bytes")
+
+        to_hash = []
+        for row in candidates:
+            if stats[row][0] <= 2 * SAMPLE_SIZE:
+                hashes[row][1] = hashes[row][0]
+            elif hashes[row][1] is None:
+                to_hash.append(row)
+
+        for row, digest in zip(to_hash, pool.map(full_hash,
+                                                 map(file_path, to_hash))):
+            hashes[row][1] = digest
+        print(f"Hashed {len(to_hash)} files in full")
+
+    cursor.execute('DELETE FROM file_hashes')
+    values = [(*row[:3], *stats[row], *hashes[row]) for row in hashes]
+    for chunk in batched(values, CHUNK_SIZE):
+        cursor.executemany('''
+            INSERT INTO file_hashes (parent_id, directory_id, name, size,
+                                     mtime_ns, inode, sample_hash, full_hash)
+            VALUES (?, ?, ?, ?, ?, ?, ?, ?)
+        ''', chunk)
+    conn.commit()
+
+
+def unchanged(file_path, size, mtime_ns):
+    stat = stat_file(file_path)
+    return stat is not None and stat[:2] == (size, mtime_ns)
+
+
+def delete_files(conn, directory_path, rows, dry_run):
+    # Files can change after the crawl, so a duplicate is only removed when
+    # it and the copy that is kept still have the size and modified time
+    # they were matched with
+    cursor = conn.cursor()
+
+    rows_to_delete = []
+    for (parent_id, directory, name, parent, path, size, mtime_ns,
+         kept_parent, kept_path, kept_name, kept_size, kept_mtime_ns) in rows:
+        file_to_remove = os.path.join(directory_path, parent, path, name)
+        kept_file = os.path.join(directory_path, kept_parent, kept_path,
+                                 kept_name)
+        if not (unchanged(file_to_remove, size, mtime_ns)
+                and unchanged(kept_file, kept_size, kept_mtime_ns)):
+            print(f"Skipping [{file_to_remove}], it or [{kept_file}] changed "
+                  "since the crawl")
+            continue
+
+        rows_to_delete.append((parent_id, directory, name))
+        print(file_to_remove)
+
+        if not dry_run:
+            os.remove(file_to_remove)
+
+    if not dry_run:
+        delete_stmt = ('''
+            DELETE FROM files WHERE
+            parent_id = ? AND directory_id = ? AND name = ?
+        ''')
+
+        for chunk in batched(rows_to_delete, CHUNK_SIZE):
+            cursor.executemany(delete_stmt, chunk)
+            cursor.executemany('''
+                DELETE FROM file_hashes
+                WHERE parent_id = ? AND directory_id = ? AND name = ?
+            ''', chunk)
+            conn.commit()
 
 
 def main():
     try:
-        directory_path, dry_run = read_args()
+        directory_path, dry_run, content, threads = read_args()
     except Exception as e:
         print(f"Failed to read directory from arguments: {e}")
         sys.exit(1)
     directory_path = os.path.abspath(directory_path)
 
-    with sqlite3.connect("directory_tree.db") as conn:
+    with connect() as conn:
         cursor = conn.cursor()
 
-        cursor.execute('''
-            CREATE TABLE IF NOT EXISTS files (
-                parent VARCHAR(255),
-                path VARCHAR(65535), 
-                modified INTEGER,
-                PRIMARY KEY (parent, path)
-            )
-        ''')
-
-        select_stmt = ('''
-            WITH ranked_files AS (
-                SELECT
-                    parent,
-                    path,
-                    modified,
-                    ROW_NUMBER() OVER (PARTITION BY path, modified ORDER BY parent ASC) AS rn,
-                    COUNT(*) OVER (PARTITION BY path, modified) AS cnt
-                FROM files
-            )
-            SELECT parent, path, modified
-            FROM ranked_files
-            WHERE rn < cnt
-            ORDER BY path, parent;
-        ''')
+        if content:
+            hash_files(conn, directory_path, threads)
+            select_stmt = ('''
+                WITH ranked_files AS (
+                    SELECT
+                        h.parent_id,
+                        h.directory_id,
+                        h.name,
+                        p.name AS parent,
+                        d.path,
+                        h.size,
+                        h.mtime_ns,
+                        LAST_VALUE(p.name) OVER copies AS kept_parent,
+                        LAST_VALUE(d.path) OVER copies AS kept_path,
+                        LAST_VALUE(h.name) OVER copies AS kept_name,
+                        LAST_VALUE(h.mtime_ns) OVER copies AS kept_mtime_ns,
+                        ROW_NUMBER() OVER copies AS rn,
+                        COUNT(*) OVER copies AS cnt
+                    FROM file_hashes h
+                    JOIN parents p ON p.id = h.parent_id
+                    JOIN directories d ON d.id = h.directory_id
+                    WHERE h.full_hash IS NOT NULL
+                    WINDOW copies AS (
+                        PARTITION BY h.size, h.full_hash
+                        ORDER BY p.name ASC, d.path ASC, h.name ASC
+                        ROWS BETWEEN UNBOUNDED PRECEDING
+                            AND UNBOUNDED FOLLOWING
+                    )
+                )
+                SELECT parent_id, directory_id, name, parent, path, size,
+                    mtime_ns, kept_parent, kept_path, kept_name, size,
+                    kept_mtime_ns
+                FROM ranked_files
+                WHERE rn < cnt
+                ORDER BY parent, path, name;
+            ''')
+        else:
+            # Walks files_by_path, where the copies of a file in every parent
+            # are next to each other, and keeps the copy in the last parent
+            # with the same size and modified second
+            select_stmt = ('''
+                SELECT f.parent_id, f.directory_id, f.name, p.name, d.path,
+                    f.size, f.mtime_ns, k.name, d.path, g.name, g.size,
+                    g.mtime_ns
+                FROM files f
+                JOIN parents p ON p.id = f.parent_id
+                JOIN directories d ON d.id = f.directory_id
+                JOIN files g ON g.directory_id = f.directory_id
+                    AND g.name = f.name
+                JOIN parents k ON k.id = g.parent_id
+                WHERE g.size = f.size
+                    AND g.mtime_ns / 1000000000 = f.mtime_ns / 1000000000
+                    AND k.name > p.name
+                    AND NOT EXISTS (
+                        SELECT 1 FROM files h
+                        JOIN parents q ON q.id = h.parent_id
+                        WHERE h.directory_id = f.directory_id
+                            AND h.name = f.name
+                            AND h.size = f.size
+                            AND h.mtime_ns / 1000000000
+                                = f.mtime_ns / 1000000000
+                            AND q.name > k.name
+                    )
+                ORDER BY f.directory_id, f.name, p.name;
+            ''')
 
         cursor.execute(select_stmt)
-
-        rows_to_delete = []
-        for parent, path, _ in cursor.fetchall():
-            rows_to_delete.append((parent, path))
-            file_to_remove = os.path.join(directory_path, parent, path)
-            print(file_to_remove)
-
-            if not dry_run and os.path.isfile(file_to_remove):
-                os.remove(file_to_remove)
-
-        if not dry_run:
-            delete_stmt = ('''
-                DELETE FROM files WHERE
-                parent = ? AND path = ?
-            ''')
-                        
-            for chunk in batched(rows_to_delete, CHUNK_SIZE):
-                cursor.executemany(delete_stmt, chunk)
-                conn.commit()
+        delete_files(conn, directory_path, cursor.fetchall(), dry_run)
 
 
 if __name__ == '__main__':
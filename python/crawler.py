@@ -1,18 +1,17 @@
 import os
 import sys
-import sqlite3
+import time
 from argparse import ArgumentParser
+from collections import defaultdict
+from concurrent.futures import FIRST_COMPLETED, ThreadPoolExecutor, wait
 from requests.structures import CaseInsensitiveDict
+from lib.directory_tree import connect, create_file_indexes, drop_file_indexes
 
 CHUNK_SIZE = 10000
+DEFAULT_THREADS = 32
 
 
-def batched(items, chunk_size):
-    for i in range(0, len(items), chunk_size):
-        yield items[i:i + chunk_size]
-
-
-def read_directory_from_args():
+def read_args():
     parser = ArgumentParser(
         prog="Directory Crawler",
         description="Builds a SQLite database for a directory structure"
@@ -21,69 +20,370 @@ def read_directory_from_args():
         "directory",
         help="Path to the directory you want to crawl"
     )
+    parser.add_argument(
+        "-f",
+        "--full",
+        action="store_true",
+        help=("Rescan every directory, by default only directories whose "
+              "modified time changed are listed again and the known files "
+              "of the others are only checked with a stat")
+    )
+    parser.add_argument(
+        "-t",
+        "--threads",
+        type=int,
+        default=DEFAULT_THREADS,
+        help=("Directories scanned at the same time, network shares are "
+              f"bound by latency and benefit from many (default {DEFAULT_THREADS})")
+    )
     args = parser.parse_args()
 
     directory_path = args.directory
     if not os.path.isdir(directory_path):
         raise ValueError(f"[{directory_path}] is not a valid directory")
 
-    return directory_path
+    return directory_path, args.full, args.threads
 
 
-def get_all_files(parent_path):
+def scan_directory(directory_path):
     result = CaseInsensitiveDict()
+    subdirectories = []
 
-    for root, _, files in os.walk(parent_path):
-        for file in files:
-            file_path = os.path.join(root, file)
-            mt_time = os.path.getmtime(file_path)
+    with os.scandir(directory_path) as entries:
+        for entry in entries:
+            if entry.is_dir():
+                if not entry.is_symlink():
+                    subdirectories.append(entry.name)
+                continue
 
-            result[os.path.relpath(file_path, parent_path)] = int(mt_time)
+            try:
+                stat = entry.stat()
+            except OSError:
+                continue
 
-    return dict(**result)
+            result[entry.name] = (stat.st_size, stat.st_mtime_ns,
+                                  entry.inode())
 
+    return subdirectories, dict(result)
 
-def main():
+
+def stat_files(directory_path, names):
+    result = {}
+    for name in names:
+        try:
+            stat = os.stat(os.path.join(directory_path, name))
+        except OSError:
+            continue
+
+        result[name] = (stat.st_size, stat.st_mtime_ns, stat.st_ino)
+
+    return result
+
+
+def visit_directory(directory_path, stored_mtime, stored_names, full):
+    # A directory's modified time only changes when entries are added,
+    # removed or renamed in it, so unchanged directories are not listed again
+    # and their subdirectories are taken from the previous crawl. Files
+    # edited in place keep the modified time of their directory, so the
+    # known files of unchanged directories are checked with a stat.
     try:
-        directory_path = read_directory_from_args()
-    except Exception as e:
-        print(f"Failed to read directory from arguments: {e}")
-        sys.exit(1)
+        mtime = os.stat(directory_path).st_mtime_ns
+    except FileNotFoundError:
+        return None
 
-    with sqlite3.connect("directory_tree.db") as conn:
-        cursor = conn.cursor()
+    if not full and stored_mtime == mtime:
+        return mtime, None, stat_files(directory_path, stored_names), False
 
-        for item in os.listdir(directory_path):
-            item_path = os.path.join(directory_path, item)
-            if not os.path.isdir(item_path):
-                continue
+    subdirectories, current = scan_directory(directory_path)
+    return mtime, subdirectories, current, True
 
-            item_path = os.path.abspath(item_path)
-            parent = os.path.basename(item_path)
-            try:
-                directory_tree = get_all_files(item_path)
-            except Exception as e:
-                print(f"Failed to crawl [{item_path}]: {e}")
-                sys.exit(1)
-            
-            cursor.execute('''
-                CREATE TABLE IF NOT EXISTS files (
-                    parent VARCHAR(255),
-                    path VARCHAR(65535), 
-                    modified INTEGER,
-                    PRIMARY KEY (parent, path)
+
+def directory_id(cursor, path):
+    cursor.execute('INSERT OR IGNORE INTO directories (path) VALUES (?)',
+                   (path,))
+    cursor.execute('SELECT id FROM directories WHERE path = ?', (path,))
+    return cursor.fetchone()[0]
+
+
+def stored_mtime(cursor, parent_id, directory):
+    cursor.execute('''
+        SELECT mtime_ns FROM directory_mtimes
+        WHERE parent_id = ? AND directory_id = ?
+    ''', (parent_id, directory))
+    row = cursor.fetchone()
+    return row[0] if row else None
+
+
+def stored_files(cursor, parent_id, directory):
+    cursor.execute('''
+        SELECT name FROM files WHERE parent_id = ? AND directory_id = ?
+    ''', (parent_id, directory))
+    return [name for name, in cursor]
+
+
+def stored_subdirectories(cursor, parent_id, path):
+    if path:
+        prefix = path + os.sep
+        cursor.execute('''
+            SELECT d.path FROM directories d
+            JOIN directory_mtimes m ON m.directory_id = d.id
+            WHERE m.parent_id = ? AND d.path > ? AND d.path < ?
+                AND dirname(d.path) = ?
+        ''', (parent_id, prefix, prefix[:-1] + chr(ord(os.sep) + 1), path))
+    else:
+        cursor.execute('''
+            SELECT d.path FROM directories d
+            JOIN directory_mtimes m ON m.directory_id = d.id
+            WHERE m.parent_id = ? AND d.path != '' AND dirname(d.path) = ''
+        ''', (parent_id,))
+
+    return [child for child, in cursor]
+
+
+def walk(conn, directory_path, parents, full, threads):
+    # Directories of all parents are scanned concurrently by the thread pool.
+    # Yields (parent_id, directory_id, mtime, files, listed) for every
+    # directory found, directories that did not change since the last crawl
+    # are not listed and their files only hold the known files still there
+    cursor = conn.cursor()
+    pending = [(parent_id, parent, '')
+               for parent_id, parent in reversed(parents)]
+    in_flight = {}
+    with ThreadPoolExecutor(max_workers=threads) as pool:
+        while pending or in_flight:
+            while pending and len(in_flight) < threads * 2:
+                parent_id, parent, path = pending.pop()
+                directory = directory_id(cursor, path)
+                mtime = stored_mtime(cursor, parent_id, directory)
+                names = ([] if full or mtime is None
+                         else stored_files(cursor, parent_id, directory))
+                future = pool.submit(
+                    visit_directory, os.path.join(directory_path, parent, path),
+                    mtime, names, full)
+                in_flight[future] = (parent_id, parent, path, directory)
+
+            done, _ = wait(in_flight, return_when=FIRST_COMPLETED)
+            for future in done:
+                parent_id, parent, path, directory = in_flight.pop(future)
+                try:
+                    result = future.result()
+                except OSError as e:
+                    # Unreadable directories keep what the last crawl found
+                    print("Skipping unreadable "
+                          f"[{os.path.join(directory_path, parent, path)}]: {e}")
+                    result = None, None, {}, False
+                except Exception as e:
+                    print("Failed to crawl "
+                          f"[{os.path.join(directory_path, parent, path)}]: {e}")
+                    sys.exit(1)
+                if result is None:
+                    continue
+
+                mtime, subdirectories, current, listed = result
+                if listed:
+                    subdirectories = [os.path.join(path, name)
+                                      for name in subdirectories]
+                else:
+                    subdirectories = stored_subdirectories(cursor, parent_id,
+                                                           path)
+                pending.extend((parent_id, parent, child)
+                               for child in subdirectories)
+                yield parent_id, directory, mtime, current, listed
+
+
+class TreeWriter:
+    def __init__(self, cursor):
+        self.cursor = cursor
+        self.rows = defaultdict(list)
+        self.changes = defaultdict(int)
+
+    def add(self, statement, row):
+        rows = self.rows[statement]
+        rows.append(row)
+        if len(rows) >= CHUNK_SIZE:
+            self.write(statement, rows)
+
+    def write(self, statement, rows):
+        self.cursor.executemany(statement, rows)
+        self.changes[statement] += self.cursor.rowcount
+        rows.clear()
+
+    def flush(self):
+        for statement, rows in self.rows.items():
+            if rows:
+                self.write(statement, rows)
+
+
+UPSERT_FILE = '''
+    INSERT INTO files (parent_id, directory_id, name, size, mtime_ns, inode)
+    VALUES (?, ?, ?, ?, ?, ?)
+    ON CONFLICT (parent_id, directory_id, name) DO UPDATE SET
+        size = excluded.size,
+        mtime_ns = excluded.mtime_ns,
+        inode = excluded.inode
+    WHERE (size, mtime_ns, inode)
+        IS NOT (excluded.size, excluded.mtime_ns, excluded.inode)
+'''
+UPSERT_DIRECTORY = '''
+    INSERT OR REPLACE INTO directory_mtimes (parent_id, directory_id, mtime_ns)
+    VALUES (?, ?, ?)
+'''
+SCANNED_FILE = '''
+    INSERT OR IGNORE INTO temp.scanned_files (parent_id, directory_id, name)
+    VALUES (?, ?, ?)
+'''
+SEEN_DIRECTORY = '''
+    INSERT OR IGNORE INTO temp.seen_directories
+        (parent_id, directory_id, rescanned)
+    VALUES (?, ?, ?)
+'''
+
+
+def crawl(conn, directory_path, parents, full, threads):
+    # Everything found is streamed into SQLite in CHUNK_SIZE batches and
+    # compared with the previous crawl there, so memory does not grow with
+    # the number of files. Only this thread touches the database.
+    conn.create_function('dirname', 1, os.path.dirname, deterministic=True)
+    cursor = conn.cursor()
+    cursor.executemany('INSERT OR IGNORE INTO parents (name) VALUES (?)',
+                       [(parent,) for parent in parents])
+    parents = [(cursor.execute('SELECT id FROM parents WHERE name = ?',
+                               (parent,)).fetchone()[0], parent)
+               for parent in parents]
+
+    # Parents that are gone are never walked, so everything stored for them
+    # is removed here
+    current = {parent_id for parent_id, _ in parents}
+    cursor.execute('SELECT id, name FROM parents')
+    for parent_id, parent in cursor.fetchall():
+        if parent_id in current:
+            continue
+
+        cursor.execute('DELETE FROM files WHERE parent_id = ?', (parent_id,))
+        print(f"{parent}: no longer exists, {cursor.rowcount} removed files")
+        cursor.execute('DELETE FROM directory_mtimes WHERE parent_id = ?',
+                       (parent_id,))
+        cursor.execute('DELETE FROM file_hashes WHERE parent_id = ?',
+                       (parent_id,))
+        cursor.execute('DELETE FROM parents WHERE id = ?', (parent_id,))
+
+    # Building the indexes once after the first crawl is much faster than
+    # updating them for every file
+    cursor.execute('SELECT 1 FROM files LIMIT 1')
+    bulk_load = cursor.fetchone() is None
+    if bulk_load:
+        drop_file_indexes(conn)
+
+    cursor.execute('''
+        CREATE TEMP TABLE scanned_files (
+            parent_id INTEGER,
+            directory_id INTEGER,
+            name VARCHAR(255),
+            PRIMARY KEY (parent_id, directory_id, name)
+        ) WITHOUT ROWID
+    ''')
+    cursor.execute('''
+        CREATE TEMP TABLE seen_directories (
+            parent_id INTEGER,
+            directory_id INTEGER,
+            rescanned INTEGER,
+            PRIMARY KEY (parent_id, directory_id)
+        ) WITHOUT ROWID
+    ''')
+
+    writer = TreeWriter(cursor)
+    rescanned = defaultdict(int)
+    scanned_files = 0
+    started = time.perf_counter()
+
+    for parent_id, directory, mtime, current, listed in walk(
+            conn, directory_path, parents, full, threads):
+        writer.add(SEEN_DIRECTORY, (parent_id, directory, listed))
+        for name, (size, mtime_ns, inode) in current.items():
+            writer.add(UPSERT_FILE,
+                       (parent_id, directory, name, size, mtime_ns, inode))
+        if not listed:
+            continue
+
+        for name in current:
+            writer.add(SCANNED_FILE, (parent_id, directory, name))
+        writer.add(UPSERT_DIRECTORY, (parent_id, directory, mtime))
+        scanned_files += len(current)
+        rescanned[parent_id] += 1
+    writer.flush()
+
+    # Files are gone when their directory was rescanned without finding
+    # them, or when their directory was not found at all
+    for parent_id, parent in parents:
+        cursor.execute('''
+            DELETE FROM files
+            WHERE parent_id = ?
+                AND NOT EXISTS (
+                    SELECT 1 FROM temp.scanned_files s
+                    WHERE s.parent_id = files.parent_id
+                        AND s.directory_id = files.directory_id
+                        AND s.name = files.name
                 )
-            ''')
+                AND NOT EXISTS (
+                    SELECT 1 FROM temp.seen_directories d
+                    WHERE d.parent_id = files.parent_id
+                        AND d.directory_id = files.directory_id
+                        AND NOT d.rescanned
+                )
+        ''', (parent_id,))
+        removed = cursor.rowcount
+        cursor.execute('''
+            DELETE FROM directory_mtimes
+            WHERE parent_id = ? AND NOT EXISTS (
+                SELECT 1 FROM temp.seen_directories d
+                WHERE d.parent_id = directory_mtimes.parent_id
+                    AND d.directory_id = directory_mtimes.directory_id
+            )
+        ''', (parent_id,))
+
+        print(f"{parent}: rescanned {rescanned[parent_id]} directories, "
+              f"{removed} removed files")
+
+    cursor.execute('''
+        DELETE FROM directories
+        WHERE id NOT IN (SELECT directory_id FROM directory_mtimes)
+    ''')
+    cursor.execute('''
+        DELETE FROM file_hashes
+        WHERE NOT EXISTS (
+            SELECT 1 FROM files f
+            WHERE f.parent_id = file_hashes.parent_id
+                AND f.directory_id = file_hashes.directory_id
+                AND f.name = file_hashes.name
+        )
+    ''')
+    if bulk_load:
+        create_file_indexes(conn)
+
+    conn.commit()
+    cursor.execute('DROP TABLE temp.scanned_files')
+    cursor.execute('DROP TABLE temp.seen_directories')
+    cursor.execute('PRAGMA optimize')
 
-            insert_stmt = ('''
-                INSERT OR IGNORE INTO files (parent, path, modified)
-                VALUES (?, ?, ?)
-            ''')
+    elapsed = time.perf_counter() - started
+    print(f"{writer.changes[UPSERT_FILE]} new or changed files")
+    print(f"Scanned {scanned_files} files in {sum(rescanned.values())} "
+          f"directories in {elapsed:.1f}s, "
+          f"{scanned_files / elapsed if elapsed else 0:.0f} files/sec")
+
+
+def main():
+    try:
+        directory_path, full, threads = read_args()
+    except Exception as e:
+        print(f"Failed to read directory from arguments: {e}")
+        sys.exit(1)
+    directory_path = os.path.abspath(directory_path)
 
-            values = [(parent, p, m) for p, m in directory_tree.items()]
-            for chunk in batched(values, CHUNK_SIZE):
-                cursor.executemany(insert_stmt, chunk)
-                conn.commit()
+    with connect() as conn:
+        parents = sorted(item for item in os.listdir(directory_path)
+                         if os.path.isdir(os.path.join(directory_path, item)))
+        crawl(conn, directory_path, parents, full, threads)
 
 
 if __name__ == '__main__':
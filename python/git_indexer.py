@@ -1,269 +1,2872 @@
 import os
+import json
+import shutil
+import socketserver
+import sqlite3
 import subprocess
+import time
+import re
 import argparse
-from whoosh import index
-from whoosh.fields import Schema, TEXT, ID, STORED
+from concurrent.futures import ProcessPoolExecutor, ThreadPoolExecutor, as_completed
+from contextlib import contextmanager
+from datetime import datetime, timezone
+from functools import lru_cache
+from http.server import BaseHTTPRequestHandler, HTTPServer
+from urllib.parse import parse_qs, urlparse
+from whoosh import highlight, index
+from whoosh.collectors import TimeLimitCollector
+from whoosh.fields import Schema, TEXT, ID, STORED, DATETIME
 from whoosh.qparser import MultifieldParser
-from whoosh.analysis import StandardAnalyzer
+from whoosh.query import And, DateRange, Term
+from whoosh.searching import TimeLimit
+from whoosh.analysis import IDTokenizer, LowercaseFilter, StandardAnalyzer
+from collections import OrderedDict, defaultdict, namedtuple
+from lib.blob_store import BlobStore
+from lib.git_objects import GitBlobReader, PackBlobReader
+from lib.trigram_index import TrigramIndex, regex_requirements
+
+RECORD_SEPARATOR = '\x1e'
+FIELD_SEPARATOR = '\x1f'
+LOG_FORMAT = '%x1e%H%x1f%an%x1f%aI%x1f%s'
+
+GITLINK_MODE = '160000'
+MIN_COMMITS_PER_JOB = 1000
+LATEST_BLOBS_LOOKUP = 5000
+DEFAULT_MAX_BLOB_SIZE = 1024 ** 2
+BINARY_ATTRIBUTES = ['binary', 'diff', 'text']
+SHARDS_DIR = 'shards'
+SEARCH_THREADS = 8
+SNIPPET_CHARS = 160
+DEFAULT_WRITER_MB = 128
+DEFAULT_COMMIT_DOCS = 10000
+DEFAULT_COMMIT_SECONDS = 300
+DEFAULT_WATCH_INTERVAL = 2.0
+DEFAULT_WATCH_DEBOUNCE = 5.0
+WATCH_MAX_DELAY = 60.0
+
+C_ESCAPES = {
+    'a': '\a', 'b': '\b', 'f': '\f', 'n': '\n', 'r': '\r', 't': '\t', 'v': '\v'
+}
+REF_NAMESPACES = ['refs/heads', 'refs/remotes', 'refs/tags']
+
+SKIP_TOO_LARGE = 'larger than --max-blob-size'
+SKIP_BINARY_ATTRIBUTE = 'binary in .gitattributes'
+SKIP_BINARY_CONTENT = 'binary content'
+
+NOTICE_FULL_SCAN = ("Pattern has no literal of 3 or more characters, "
+                    "scanning every blob")
+
+SEARCH_FIELDS = {
+    'history': ['content'],
+    'hunks': ['added', 'removed', 'path', 'commit_hash'],
+    'snapshot': ['content', 'path']
+}
+RESULT_LABELS = [
+    ('path', 'File'),
+    ('hunk', 'Hunk'),
+    ('match', 'Match'),
+    ('snippet', 'Snippet'),
+    ('ref', 'Ref'),
+    ('blob', 'Blob'),
+    ('commit_hash', 'Commit'),
+    ('author', 'Author'),
+    ('date', 'Date')
+]
+
+CommitRecord = namedtuple(
+    'CommitRecord', ['commit_hash', 'author', 'date', 'message', 'files'])
+FileChange = namedtuple('FileChange', ['status', 'path', 'blob', 'mode'])
+IndexJob = namedtuple('IndexJob', ['repo', 'revisions', 'job_dir'])
+OCCURRENCE_COLUMNS = 'repo, commit_hash, path, commit_date, author'
+
+SearchFilters = namedtuple(
+    'SearchFilters', ['repo', 'author', 'since', 'until', 'ref'],
+    defaults=[None, None, None, None, None])
+WriterLimits = namedtuple(
+    'WriterLimits', ['limitmb', 'commit_docs', 'commit_seconds'],
+    defaults=[DEFAULT_WRITER_MB, DEFAULT_COMMIT_DOCS, DEFAULT_COMMIT_SECONDS])
+ResultPage = namedtuple('ResultPage',
+                        ['results', 'truncated', 'total', 'notice'],
+                        defaults=[False, None, None])
+HunkRecord = namedtuple('HunkRecord', [
+    'commit_hash', 'author', 'date', 'path', 'header', 'added', 'removed'])
+
+
+def iter_null_terminated(stream, chunk_size=65536):
+    """Yield NUL separated tokens from a stream without reading it whole"""
+    pending = ''
+    while True:
+        chunk = stream.read(chunk_size)
+        if not chunk:
+            break
+
+        tokens = (pending + chunk).split('\0')
+        pending = tokens.pop()
+        yield from tokens
+
+    if pending:
+        yield pending
+
+
+def format_size(size):
+    """Format a byte count for progress output"""
+    for unit in ['B', 'KB', 'MB', 'GB']:
+        if size < 1024 or unit == 'GB':
+            break
+        size /= 1024
+
+    return f"{size:.1f} {unit}" if unit != 'B' else f"{size} B"
+
+
+def time_left(deadline):
+    """Get the seconds left before a time.monotonic() deadline"""
+    return max(deadline - time.monotonic(), 0)
+
+
+def expired(deadline):
+    """Whether a deadline has passed, never without one"""
+    return deadline is not None and time.monotonic() >= deadline
+
+
+def parse_date(value):
+    """Parse an ISO 8601 date, naive values are taken as UTC"""
+    date = datetime.fromisoformat(value)
+    if date.tzinfo is None:
+        date = date.replace(tzinfo=timezone.utc)
+
+    return date
+
+
+def utc_naive(date):
+    """Convert an aware datetime to the naive UTC form Whoosh stores"""
+    return date.astimezone(timezone.utc).replace(tzinfo=None)
+
+
+def schema_signature(schema):
+    """Describe the fields of a schema so layout changes can be detected"""
+    return sorted((name, type(field).__name__, field.stored, field.unique,
+                   field.column_type is not None)
+                  for name, field in schema.items())
+
+
+def open_index(index_dir, schema):
+    """Open the Whoosh index in index_dir, creating or rebuilding it as needed"""
+    if not os.path.exists(index_dir):
+        os.makedirs(index_dir)
+        return index.create_in(index_dir, schema)
+
+    try:
+        ix = index.open_dir(index_dir)
+    except:
+        return index.create_in(index_dir, schema)
+
+    if schema_signature(ix.schema) != schema_signature(schema):
+        print(f"Index in {index_dir} was built with an older layout, rebuilding it")
+        state_file = os.path.join(index_dir, 'state.db')
+        if os.path.exists(state_file):
+            os.remove(state_file)
+        ix = index.create_in(index_dir, schema)
+
+    return ix
+
+
+def unquote_path(path):
+    """Undo the C-style quoting git applies to paths with unusual characters"""
+    if len(path) < 2 or not path.startswith('"') or not path.endswith('"'):
+        return path
+
+    # Splitting on escapes alternates plain text and the escaped character,
+    # octal escapes are the bytes of a UTF-8 sequence
+    data = bytearray()
+    for i, part in enumerate(re.split(r'\\([0-7]{3}|.)', path[1:-1])):
+        if i % 2 == 0:
+            data += part.encode('utf-8')
+        elif len(part) == 3:
+            data.append(int(part, 8))
+        else:
+            data += C_ESCAPES.get(part, part).encode('utf-8')
+
+    return data.decode('utf-8', errors='replace')
+
+
+def ref_mask(mask):
+    """Pack a set of ref bits into the bytes stored in commit_refs"""
+    return mask.to_bytes(max(1, (mask.bit_length() + 7) // 8), 'little')
+
+
+def has_ref(refs, bit):
+    """SQL function: whether bit is set in a commit_refs mask"""
+    return bit // 8 < len(refs) and refs[bit // 8] >> (bit % 8) & 1
+
+
+def ref_mask_or(refs, mask):
+    """SQL function: add the bits of mask to a commit_refs mask"""
+    return ref_mask(int.from_bytes(refs, 'little') | int.from_bytes(mask, 'little'))
+
+
+def ref_mask_clear(refs, mask):
+    """SQL function: remove the bits of mask from a commit_refs mask"""
+    return ref_mask(int.from_bytes(refs, 'little') & ~int.from_bytes(mask, 'little'))
+
+
+class GitAttributes:
+    """Answers whether .gitattributes marks paths as binary
+
+    Keeps one `git check-attr --stdin -z` process per repository and caches
+    the answer per path, attributes come from the checked out tree.
+    """
+
+    def __init__(self, repo_path):
+        self.repo_path = repo_path
+        self._proc = None
+        self._cache = {}
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *_):
+        self.close()
+
+    def _read_token(self):
+        token = bytearray()
+        while True:
+            char = self._proc.stdout.read(1)
+            if not char or char == b'\0':
+                return token.decode('utf-8', errors='replace')
+            token += char
+
+    def is_binary(self, path):
+        if path in self._cache:
+            return self._cache[path]
+
+        if self._proc is None:
+            self._proc = subprocess.Popen(
+                ['git', 'check-attr', '--stdin', '-z', *BINARY_ATTRIBUTES],
+                cwd=self.repo_path,
+                stdin=subprocess.PIPE,
+                stdout=subprocess.PIPE,
+                stderr=subprocess.DEVNULL
+            )
+
+        self._proc.stdin.write(path.encode('utf-8') + b'\0')
+        self._proc.stdin.flush()
+
+        values = {}
+        for _ in BINARY_ATTRIBUTES:
+            self._read_token()
+            attribute = self._read_token()
+            values[attribute] = self._read_token()
+
+        binary = (values.get('binary') == 'set'
+                  or values.get('diff') == 'unset'
+                  or values.get('text') == 'unset')
+        self._cache[path] = binary
+        return binary
+
+    def close(self):
+        if self._proc is None:
+            return
+
+        self._proc.stdin.close()
+        self._proc.wait()
+        self._proc.stdout.close()
+        self._proc = None
+
+
+class SkipReport:
+    """Counts the blobs skipped by the pre-filter and the bytes they held"""
+
+    def __init__(self):
+        self.counts = {}
+        self.sizes = {}
+
+    def add(self, reason, size):
+        self.counts[reason] = self.counts.get(reason, 0) + 1
+        self.sizes[reason] = self.sizes.get(reason, 0) + size
+
+    def merge(self, other):
+        for reason, count in other.counts.items():
+            self.counts[reason] = self.counts.get(reason, 0) + count
+            self.sizes[reason] = self.sizes.get(reason, 0) + other.sizes[reason]
+
+    def print_summary(self):
+        if not self.counts:
+            return
+
+        saved = sum(size for reason, size in self.sizes.items()
+                    if reason != SKIP_BINARY_CONTENT)
+        print(f"Skipped {sum(self.counts.values())} blobs, "
+              f"{format_size(saved)} were never read:")
+        for reason, count in sorted(self.counts.items()):
+            print(f"  {reason}: {count} blobs, "
+                  f"{format_size(self.sizes[reason])}")
+
+
+class IndexMetrics:
+    """Seconds and bytes spent in each indexing stage, per repository
+
+    Stages time one step each: parsing git log, the batch-check pre-filter,
+    cat-file reads, decoding, Whoosh analysis, trigram and SQLite
+    bookkeeping, merging worker output and committing segments. Stages that
+    cover every repository at once are recorded under the repo None.
+    """
+
+    def __init__(self):
+        self.stages = {}
+        self.repos = {}
+        self.started = {}
+        self.seconds = 0.0
+
+    def add(self, repo, stage, seconds, size=0):
+        entry = self.stages.setdefault((repo, stage), [0.0, 0, 0])
+        entry[0] += seconds
+        entry[1] += size
+        entry[2] += 1
+
+    @contextmanager
+    def timed(self, repo, stage, size=0):
+        start = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.add(repo, stage, time.perf_counter() - start, size)
+
+    def timed_iter(self, repo, stage, iterable, size=None):
+        """Yield from iterable, timing each step as a stage"""
+        iterator = iter(iterable)
+        while True:
+            start = time.perf_counter()
+            try:
+                item = next(iterator)
+            except StopIteration:
+                self.add(repo, stage, time.perf_counter() - start)
+                return
+
+            self.add(repo, stage, time.perf_counter() - start,
+                     size(item) if size else 0)
+            yield item
+
+    def start_repo(self, repo):
+        self.repos.setdefault(repo, {'files': 0, 'blobs': 0, 'bytes': 0,
+                                     'seconds': 0.0})
+        self.started[repo] = time.perf_counter()
+
+    def finish_repo(self, repo):
+        self.repos[repo]['seconds'] += time.perf_counter() - self.started.pop(repo)
+
+    def count(self, repo, files=0, blobs=0, size=0):
+        totals = self.repos[repo]
+        totals['files'] += files
+        totals['blobs'] += blobs
+        totals['bytes'] += size
+
+    def progress(self, repo):
+        """Get 'N files, X files/s, Y MB/s' for a repository being indexed"""
+        totals = self.repos[repo]
+        elapsed = totals['seconds'] or 1e-9
+        if repo in self.started:
+            elapsed += time.perf_counter() - self.started[repo]
+        return (f"{totals['files']} files, "
+                f"{totals['files'] / elapsed:.1f} files/s, "
+                f"{totals['bytes'] / elapsed / 1024 ** 2:.2f} MB/s")
+
+    def merge(self, other):
+        for key, (seconds, size, calls) in other.stages.items():
+            entry = self.stages.setdefault(key, [0.0, 0, 0])
+            entry[0] += seconds
+            entry[1] += size
+            entry[2] += calls
+        for repo, totals in other.repos.items():
+            mine = self.repos.setdefault(repo, dict.fromkeys(totals, 0))
+            for name, value in totals.items():
+                mine[name] += value
+        self.seconds += other.seconds
+
+    def summarize(self, totals, stages):
+        seconds = totals['seconds'] or 1e-9
+        return {
+            **totals,
+            'files_per_sec': round(totals['files'] / seconds, 2),
+            'mb_per_sec': round(totals['bytes'] / seconds / 1024 ** 2, 3),
+            'stages': {stage: {'seconds': round(entry[0], 6),
+                               'bytes': entry[1], 'calls': entry[2]}
+                       for stage, entry in sorted(stages.items())}
+        }
+
+    def summary(self):
+        """Get the metrics as a dict for the JSON summary"""
+        repos = {}
+        for repo, totals in sorted(self.repos.items()):
+            stages = {stage: entry for (name, stage), entry in self.stages.items()
+                      if name == repo}
+            repos[repo] = self.summarize(totals, stages)
+
+        stages = {}
+        for (_, stage), (seconds, size, calls) in self.stages.items():
+            entry = stages.setdefault(stage, [0.0, 0, 0])
+            entry[0] += seconds
+            entry[1] += size
+            entry[2] += calls
+
+        totals = {name: sum(repo[name] for repo in self.repos.values())
+                  for name in ('files', 'blobs', 'bytes')}
+        totals['seconds'] = round(self.seconds, 6)
+        return dict(self.summarize(totals, stages), repos=repos)
+
+    def print_summary(self):
+        summary = self.summary()
+        print(f"Throughput: {summary['files_per_sec']} files/s, "
+              f"{summary['mb_per_sec']} MB/s over {summary['seconds']:.1f}s")
+        for stage, entry in sorted(summary['stages'].items(),
+                                   key=lambda item: -item[1]['seconds']):
+            print(f"  {stage}: {entry['seconds']:.2f}s, "
+                  f"{format_size(entry['bytes'])}, {entry['calls']} calls")
+
+    def write(self, path):
+        with open(path, 'w') as f:
+            json.dump(self.summary(), f, indent=2)
+        print(f"Wrote indexing metrics to {path}")
+
+
+class SnippetFormatter(highlight.Formatter):
+    """Marks matched terms with ** so snippets read as plain text"""
+
+    between = ' ... '
+
+    def format_token(self, text, token, replace=False):
+        return f"**{highlight.get_text(text, token, replace)}**"
+
+
+class IndexState:
+    """Bookkeeping for the index that Whoosh cannot store, kept in SQLite
+
+    Whoosh holds one document per unique blob, the occurrences table maps
+    each blob back to every (repo, commit, path) it appeared at. Changes are
+    only committed with commit(), after the Whoosh writer has committed.
+    """
+
+    def __init__(self, index_dir, parent_dir=None, check_same_thread=True):
+        os.makedirs(index_dir, exist_ok=True)
+        self.conn = sqlite3.connect(os.path.join(index_dir, 'state.db'),
+                                    check_same_thread=check_same_thread)
+        self.has_parent = parent_dir is not None
+        if self.has_parent:
+            self.conn.execute('ATTACH DATABASE ? AS parent',
+                              (os.path.join(parent_dir, 'state.db'),))
+
+        self.conn.executescript('''
+            CREATE TABLE IF NOT EXISTS watermarks (
+                repo VARCHAR(255),
+                ref VARCHAR(1024),
+                commit_hash VARCHAR(64),
+                PRIMARY KEY (repo, ref)
+            );
+            CREATE TABLE IF NOT EXISTS checkpoints (
+                repo VARCHAR(255),
+                commit_hash VARCHAR(64),
+                PRIMARY KEY (repo, commit_hash)
+            );
+            CREATE TABLE IF NOT EXISTS refs (
+                repo VARCHAR(255),
+                ref VARCHAR(1024),
+                bit INTEGER,
+                commit_hash VARCHAR(64),
+                PRIMARY KEY (repo, ref)
+            );
+            CREATE TABLE IF NOT EXISTS commit_refs (
+                repo VARCHAR(255),
+                commit_hash VARCHAR(64),
+                refs BLOB,
+                PRIMARY KEY (repo, commit_hash)
+            );
+            CREATE TABLE IF NOT EXISTS blobs (
+                blob VARCHAR(64) PRIMARY KEY,
+                indexed INTEGER
+            );
+            CREATE TABLE IF NOT EXISTS occurrences (
+                blob VARCHAR(64),
+                repo VARCHAR(255),
+                commit_hash VARCHAR(64),
+                path VARCHAR(65535),
+                commit_date VARCHAR(64),
+                commit_time INTEGER,
+                author VARCHAR(255)
+            );
+            CREATE INDEX IF NOT EXISTS occurrences_blob
+                ON occurrences (blob);
+            CREATE INDEX IF NOT EXISTS occurrences_commit
+                ON occurrences (commit_hash, repo);
+            CREATE INDEX IF NOT EXISTS occurrences_path
+                ON occurrences (path);
+            CREATE INDEX IF NOT EXISTS occurrences_time
+                ON occurrences (commit_time);
+            CREATE INDEX IF NOT EXISTS occurrences_repo_time
+                ON occurrences (repo, commit_time);
+            CREATE INDEX IF NOT EXISTS occurrences_author_time
+                ON occurrences (author COLLATE NOCASE, commit_time);
+            CREATE TABLE IF NOT EXISTS oversized_blobs (
+                blob VARCHAR(64) PRIMARY KEY,
+                size INTEGER
+            );
+            CREATE TABLE IF NOT EXISTS oversized_occurrences (
+                blob VARCHAR(64),
+                repo VARCHAR(255),
+                commit_hash VARCHAR(64),
+                path VARCHAR(65535),
+                commit_date VARCHAR(64),
+                author VARCHAR(255)
+            );
+            CREATE INDEX IF NOT EXISTS oversized_occurrences_blob
+                ON oversized_occurrences (blob);
+            CREATE INDEX IF NOT EXISTS oversized_occurrences_commit
+                ON oversized_occurrences (commit_hash, repo);
+        ''')
+        self.conn.create_function('has_ref', 2, has_ref, deterministic=True)
+        self.conn.create_function('ref_mask_or', 2, ref_mask_or,
+                                  deterministic=True)
+        self.conn.create_function('ref_mask_clear', 2, ref_mask_clear,
+                                  deterministic=True)
+        self.store = BlobStore(os.path.join(index_dir, 'store'),
+                               check_same_thread=check_same_thread)
+        self.trigrams = TrigramIndex(self.conn, self.store)
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *_):
+        self.close()
+
+    def get_watermarks(self, repo):
+        """Get the last indexed commit of every ref of a repository"""
+        cursor = self.conn.execute(
+            'SELECT ref, commit_hash FROM watermarks WHERE repo = ?', (repo,))
+        return dict(cursor.fetchall())
+
+    def set_watermark(self, repo, ref, commit_hash):
+        self.conn.execute('''
+            INSERT OR REPLACE INTO watermarks (repo, ref, commit_hash)
+            VALUES (?, ?, ?)
+        ''', (repo, ref, commit_hash))
+
+    def set_watermarks(self, repo, tips):
+        """Replace the watermarks of a repository with {ref: commit} tips"""
+        self.conn.execute('DELETE FROM watermarks WHERE repo = ?', (repo,))
+        for ref, commit_hash in tips.items():
+            self.set_watermark(repo, ref, commit_hash)
+
+    def clear_repo(self, repo):
+        """Forget everything recorded for a repository except its blobs"""
+        self.conn.execute('DELETE FROM watermarks WHERE repo = ?', (repo,))
+        self.conn.execute('DELETE FROM occurrences WHERE repo = ?', (repo,))
+        self.conn.execute('DELETE FROM oversized_occurrences WHERE repo = ?',
+                          (repo,))
+        self.conn.execute('DELETE FROM refs WHERE repo = ?', (repo,))
+        self.conn.execute('DELETE FROM commit_refs WHERE repo = ?', (repo,))
+        self.clear_checkpoints(repo)
+
+    def delete_commits(self, repo, commit_hashes):
+        self.conn.executemany(
+            'DELETE FROM occurrences WHERE commit_hash = ? AND repo = ?',
+            [(c, repo) for c in commit_hashes])
+        self.conn.executemany(
+            'DELETE FROM oversized_occurrences '
+            'WHERE commit_hash = ? AND repo = ?',
+            [(c, repo) for c in commit_hashes])
+        self.conn.executemany(
+            'DELETE FROM commit_refs WHERE repo = ? AND commit_hash = ?',
+            [(repo, c) for c in commit_hashes])
+        self.clear_checkpoints(repo, commit_hashes)
+
+    def get_refs(self, repo):
+        """Get {ref: (bit, commit)} of the refs whose membership is recorded"""
+        cursor = self.conn.execute(
+            'SELECT ref, bit, commit_hash FROM refs WHERE repo = ?', (repo,))
+        return {ref: (bit, commit_hash) for ref, bit, commit_hash in cursor}
+
+    def set_ref(self, repo, ref, bit, commit_hash):
+        self.conn.execute('''
+            INSERT OR REPLACE INTO refs (repo, ref, bit, commit_hash)
+            VALUES (?, ?, ?, ?)
+        ''', (repo, ref, bit, commit_hash))
+
+    def delete_refs(self, repo, refs):
+        self.conn.executemany('DELETE FROM refs WHERE repo = ? AND ref = ?',
+                              [(repo, ref) for ref in refs])
+
+    def clear_ref_bits(self, repo, mask):
+        """Remove the ref bits in mask from every commit of a repository"""
+        self.conn.execute(
+            'UPDATE commit_refs SET refs = ref_mask_clear(refs, ?) WHERE repo = ?',
+            (ref_mask(mask), repo))
+
+    def add_ref_bits(self, repo, masks):
+        """Add {commit: ref bits} to the ref membership of commits"""
+        self.conn.executemany('''
+            INSERT INTO commit_refs (repo, commit_hash, refs) VALUES (?, ?, ?)
+            ON CONFLICT (repo, commit_hash)
+                DO UPDATE SET refs = ref_mask_or(refs, excluded.refs)
+        ''', ((repo, commit_hash, ref_mask(mask))
+              for commit_hash, mask in masks.items()))
+
+    def add_checkpoint(self, repo, commit_hash):
+        """Record that every file of a commit has been indexed"""
+        self.conn.execute(
+            'INSERT OR IGNORE INTO checkpoints (repo, commit_hash) VALUES (?, ?)',
+            (repo, commit_hash))
+
+    def is_checkpointed(self, repo, commit_hash):
+        cursor = self.conn.execute(
+            'SELECT 1 FROM checkpoints WHERE repo = ? AND commit_hash = ?',
+            (repo, commit_hash))
+        row = cursor.fetchone()
+        if row is None and self.has_parent:
+            cursor = self.conn.execute(
+                'SELECT 1 FROM parent.checkpoints '
+                'WHERE repo = ? AND commit_hash = ?', (repo, commit_hash))
+            row = cursor.fetchone()
+
+        return row is not None
+
+    def get_checkpoints(self, repo):
+        """Get the commits indexed by an interrupted run of a repository"""
+        cursor = self.conn.execute(
+            'SELECT commit_hash FROM checkpoints WHERE repo = ?', (repo,))
+        return {commit_hash for commit_hash, in cursor}
+
+    def clear_checkpoints(self, repo, commit_hashes=None):
+        """Forget the checkpoints of a repository, or of some of its commits"""
+        if commit_hashes is None:
+            self.conn.execute('DELETE FROM checkpoints WHERE repo = ?', (repo,))
+            return
+
+        self.conn.executemany(
+            'DELETE FROM checkpoints WHERE repo = ? AND commit_hash = ?',
+            [(repo, c) for c in commit_hashes])
+
+    def is_blob_indexed(self, blob):
+        """Returns None for unseen blobs, else whether it holds indexed text"""
+        cursor = self.conn.execute(
+            'SELECT indexed FROM blobs WHERE blob = ?', (blob,))
+        row = cursor.fetchone()
+        if row is None and self.has_parent:
+            cursor = self.conn.execute(
+                'SELECT indexed FROM parent.blobs WHERE blob = ?', (blob,))
+            row = cursor.fetchone()
+
+        return None if row is None else bool(row[0])
+
+    def add_blob(self, blob, indexed):
+        self.conn.execute(
+            'INSERT OR REPLACE INTO blobs (blob, indexed) VALUES (?, ?)',
+            (blob, int(indexed)))
+
+    def add_occurrence(self, blob, repo, commit_hash, path, commit_date,
+                       author):
+        commit_time = int(parse_date(commit_date).timestamp())
+        self.conn.execute('''
+            INSERT INTO occurrences
+                (blob, repo, commit_hash, path, commit_date, commit_time, author)
+            VALUES (?, ?, ?, ?, ?, ?, ?)
+        ''', (blob, repo, commit_hash, path, commit_date, commit_time, author))
+
+    def add_oversized_blob(self, blob, size):
+        self.conn.execute(
+            'INSERT OR REPLACE INTO oversized_blobs (blob, size) VALUES (?, ?)',
+            (blob, size))
+
+    def add_oversized_occurrence(self, blob, repo, commit_hash, path,
+                                 commit_date, author):
+        """Remember where a blob skipped for its size appeared"""
+        self.conn.execute('''
+            INSERT INTO oversized_occurrences
+                (blob, repo, commit_hash, path, commit_date, author)
+            VALUES (?, ?, ?, ?, ?, ?)
+        ''', (blob, repo, commit_hash, path, commit_date, author))
+
+    def get_oversized_blobs(self, repo, max_size):
+        """Get the skipped blobs of a repository that now fit max_size"""
+        cursor = self.conn.execute('''
+            SELECT DISTINCT o.blob FROM oversized_occurrences o
+            JOIN oversized_blobs b ON b.blob = o.blob
+            WHERE o.repo = ? AND b.size <= ?
+        ''', (repo, max_size))
+        return [blob for blob, in cursor]
+
+    def take_oversized_occurrences(self, blob):
+        """Remove and return the (repo, commit, path, date, author) of a blob"""
+        cursor = self.conn.execute('''
+            SELECT repo, commit_hash, path, commit_date, author
+            FROM oversized_occurrences WHERE blob = ?
+        ''', (blob,))
+        rows = cursor.fetchall()
+        self.conn.execute('DELETE FROM oversized_occurrences WHERE blob = ?',
+                          (blob,))
+        self.conn.execute('DELETE FROM oversized_blobs WHERE blob = ?',
+                          (blob,))
+        return rows
+
+    def filter_clause(self, filters):
+        """Build the SQL conditions for search filters on occurrences"""
+        conditions = []
+        params = []
+        if filters is None:
+            return conditions, params
+
+        if filters.repo:
+            conditions.append('repo = ?')
+            params.append(filters.repo)
+        if filters.author:
+            conditions.append('author = ? COLLATE NOCASE')
+            params.append(filters.author)
+        if filters.since:
+            conditions.append('commit_time >= ?')
+            params.append(int(filters.since.timestamp()))
+        if filters.until:
+            conditions.append('commit_time <= ?')
+            params.append(int(filters.until.timestamp()))
+        if filters.ref:
+            conditions.append('''EXISTS (
+                SELECT 1 FROM commit_refs c JOIN refs r ON r.repo = c.repo
+                WHERE c.repo = occurrences.repo
+                    AND c.commit_hash = occurrences.commit_hash
+                    AND r.ref IN (?, ?, ?, ?) AND has_ref(c.refs, r.bit))''')
+            params.extend([filters.ref, *(f'{namespace}/{filters.ref}'
+                                          for namespace in REF_NAMESPACES)])
+
+        return conditions, params
+
+    def query_occurrences(self, conditions, params, order='rowid',
+                          limit=None, columns=OCCURRENCE_COLUMNS):
+        """Select occurrences matching SQL conditions"""
+        sql = f'SELECT {columns} FROM occurrences'
+        if conditions:
+            sql += ' WHERE ' + ' AND '.join(conditions)
+        sql += f' ORDER BY {order}'
+        if limit is not None:
+            sql += f' LIMIT {int(limit)}'
+
+        return self.conn.execute(sql, params)
+
+    def get_occurrences(self, blob, filters=None):
+        """Get (repo, commit, path, date, author) rows of a blob"""
+        conditions, params = self.filter_clause(filters)
+        return self.query_occurrences(
+            ['blob = ?', *conditions], [blob, *params]).fetchall()
+
+    def get_latest_occurrences(self, blobs, filters=None, limit=100):
+        """Get the newest occurrences of a set of blobs, newest first"""
+        conditions, params = self.filter_clause(filters)
+        blobs = sorted(blobs)
+        rows = []
+        for start in range(0, len(blobs), 500):
+            chunk = blobs[start:start + 500]
+            rows.extend(self.query_occurrences(
+                [f'blob IN ({",".join("?" * len(chunk))})', *conditions],
+                [*chunk, *params], 'commit_time DESC', limit,
+                f'commit_time, {OCCURRENCE_COLUMNS}'))
+
+        rows.sort(key=lambda row: row[0], reverse=True)
+        return [row[1:] for row in rows[:limit]]
+
+    def iter_occurrences_by_date(self, filters=None):
+        """Stream (blob, occurrence) pairs matching filters, newest first"""
+        conditions, params = self.filter_clause(filters)
+        cursor = self.query_occurrences(
+            conditions, params, 'commit_time DESC',
+            columns=f'blob, {OCCURRENCE_COLUMNS}')
+        for blob, *row in cursor:
+            yield blob, tuple(row)
+
+    def count_occurrences(self, blobs, filters=None, terms=()):
+        """Count occurrences of a set of blobs or at exactly matching terms"""
+        conditions, params = self.filter_clause(filters)
+        blobs = sorted(blobs)
+        total = 0
+        for start in range(0, len(blobs), 500):
+            chunk = blobs[start:start + 500]
+            cursor = self.query_occurrences(
+                [f'blob IN ({",".join("?" * len(chunk))})', *conditions],
+                [*chunk, *params], columns='COUNT(*)')
+            total += cursor.fetchone()[0]
+
+        if terms:
+            placeholders = ','.join('?' * len(terms))
+            cursor = self.query_occurrences(
+                [f'(path IN ({placeholders}) OR commit_hash IN ({placeholders}))',
+                 *conditions],
+                [*terms, *terms, *params], columns='blob')
+            matched = set(blobs)
+            total += sum(1 for blob, in cursor if blob not in matched)
+
+        return total
+
+    def find_occurrences(self, term, filters=None):
+        """Get occurrences whose path or commit hash is exactly term"""
+        conditions, params = self.filter_clause(filters)
+        rows = self.query_occurrences(
+            ['path = ?', *conditions], [term, *params]).fetchall()
+        rows.extend(self.query_occurrences(
+            ['commit_hash = ?', *conditions], [term, *params]).fetchall())
+        return rows
+
+    def get_indexed_blobs(self):
+        """Get every blob with a document in the history index"""
+        cursor = self.conn.execute('SELECT blob FROM blobs WHERE indexed = 1')
+        return [blob for blob, in cursor]
+
+    def commit(self):
+        self.trigrams.flush()
+        self.store.commit()
+        self.conn.commit()
+
+    def close(self):
+        self.store.close()
+        self.conn.close()
+
+
+class CommittingWriter:
+    """A Whoosh writer that commits together with IndexState as it goes
+
+    checkpoint() is called between commits. Once commit_docs documents were
+    added or commit_seconds passed since the last commit, it commits the
+    Whoosh segment, then state.db with the checkpoints of every commit
+    indexed so far, and opens a fresh writer. limitmb bounds the postings
+    the writer buffers in memory before spilling them to disk.
+    """
+
+    def __init__(self, ix, state, limits=WriterLimits(), metrics=None):
+        self.ix = ix
+        self.state = state
+        self.limits = limits
+        self.metrics = metrics or IndexMetrics()
+        self.writer = ix.writer(limitmb=limits.limitmb)
+        self.pending = 0
+        self.last_commit = time.monotonic()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, *_):
+        if exc_type is None:
+            self.commit()
+        else:
+            self.cancel()
+
+    def update_document(self, **fields):
+        self.writer.update_document(**fields)
+        self.pending += 1
+
+    def add_reader(self, reader):
+        # Whoosh cannot copy the sortable columns of a MultiReader, so an
+        # index with several segments is added one segment at a time
+        for leaf, _ in reader.leaf_readers():
+            self.writer.add_reader(leaf)
+        self.pending += reader.doc_count()
+
+    def checkpoint(self):
+        """Commit and reopen the writer if enough work has piled up"""
+        if not self.pending:
+            return
+
+        elapsed = time.monotonic() - self.last_commit
+        if (self.pending >= self.limits.commit_docs
+                or elapsed >= self.limits.commit_seconds):
+            print(f"  Committing {self.pending} documents")
+            self.commit()
+            self.writer = self.ix.writer(limitmb=self.limits.limitmb)
+
+    def commit(self):
+        with self.metrics.timed(None, 'segment_commit'):
+            self.writer.commit()
+        with self.metrics.timed(None, 'state_commit'):
+            self.state.commit()
+        self.pending = 0
+        self.last_commit = time.monotonic()
+
+    def cancel(self):
+        self.writer.cancel()
 
 
 class GitRepoIndexer:
-    def __init__(self, repos_dir, index_dir):
+    def __init__(self, repos_dir, index_dir,
+                 max_blob_size=DEFAULT_MAX_BLOB_SIZE, repos=None,
+                 writer_limits=WriterLimits(), pack_reader=False,
+                 all_refs=False):
         self.repos_dir = os.path.abspath(repos_dir)
         self.index_dir = os.path.abspath(index_dir)
+        self.max_blob_size = max_blob_size
+        self.writer_limits = writer_limits
+        self.pack_reader = pack_reader
+        self.all_refs = all_refs
+        self.repos = repos
+        self.shard_root = os.path.join(self.index_dir, SHARDS_DIR)
+
+        self.schema = Schema(
+            blob=ID(stored=True, unique=True, sortable=True),
+            content=TEXT(analyzer=StandardAnalyzer())
+        )
+
+        self._ix = None
+
+        self.hunk_dir = os.path.join(self.index_dir, 'hunks')
+        self.hunk_schema = Schema(
+            repo=ID(stored=True),
+            path=ID(stored=True),
+            commit_hash=ID(stored=True),
+            author=ID(stored=True, sortable=True,
+                      analyzer=IDTokenizer() | LowercaseFilter()),
+            date=DATETIME(stored=True, sortable=True),
+            hunk=STORED,
+            added=TEXT(analyzer=StandardAnalyzer()),
+            removed=TEXT(analyzer=StandardAnalyzer())
+        )
+        self._hunk_ix = None
+
+        self.snapshot_dir = os.path.join(self.index_dir, 'snapshot')
+        self.snapshot_schema = Schema(
+            key=ID(unique=True),
+            repo=ID(stored=True),
+            path=ID(stored=True),
+            ref=ID(stored=True),
+            blob=ID(stored=True),
+            content=TEXT(analyzer=StandardAnalyzer())
+        )
+        self._snapshot_ix = None
+        self._git_dirs = {}
+
+    @property
+    def ix(self):
+        """The blob content index, opened on first use"""
+        if self._ix is None:
+            self._ix = open_index(self.index_dir, self.schema)
+
+        return self._ix
+
+    @property
+    def hunk_ix(self):
+        """The diff-hunk index, opened on first use"""
+        if self._hunk_ix is None:
+            self._hunk_ix = open_index(self.hunk_dir, self.hunk_schema)
+
+        return self._hunk_ix
+
+    @property
+    def snapshot_ix(self):
+        """The current-tree index, opened on first use"""
+        if self._snapshot_ix is None:
+            self._snapshot_ix = open_index(self.snapshot_dir, self.snapshot_schema)
+
+        return self._snapshot_ix
+
+    def get_repo_list(self, verbose=True):
+        """Get list of all directories that are Git repositories"""
+        repos = []
+
+        if os.path.exists(os.path.join(self.repos_dir, '.git')):
+            name = os.path.basename(self.repos_dir)
+            if self.repos is None or name in self.repos:
+                repos.append(name)
+                if verbose:
+                    print(f"Found Git repo: {name}")
+            return repos
+
+        for item in os.listdir(self.repos_dir):
+            if self.repos is not None and item not in self.repos:
+                continue
+
+            item_path = os.path.join(self.repos_dir, item)
+            if os.path.isdir(item_path):
+                if os.path.exists(os.path.join(item_path, '.git')):
+                    repos.append(item)
+                    if verbose:
+                        print(f"Found Git repository: {item}")
+
+        return repos
+
+    def get_repo_path(self, repo_path):
+        """Resolve a repository name to its directory on disk"""
+        if repo_path == os.path.basename(self.repos_dir) and os.path.exists(os.path.join(self.repos_dir, '.git')):
+            return self.repos_dir
+
+        return os.path.join(self.repos_dir, repo_path)
+
+    def git(self, repo_path, *args):
+        """Run a git command in a repository, returns stdout or None on failure"""
+        result = subprocess.run(
+            ['git', *args],
+            cwd=self.get_repo_path(repo_path),
+            stdout=subprocess.PIPE,
+            stderr=subprocess.PIPE,
+            text=True
+        )
+        if result.returncode != 0:
+            return None
+
+        return result.stdout.strip()
+
+    def get_git_dirs(self, repo_path):
+        """Get the git directory of a repository and the one holding its refs
+
+        They differ for linked worktrees, whose refs live in the main
+        repository.
+        """
+        if repo_path not in self._git_dirs:
+            git_dir = self.git(repo_path, 'rev-parse', '--absolute-git-dir')
+            common_dir = self.git(repo_path, 'rev-parse', '--git-common-dir')
+            if git_dir is None or common_dir is None:
+                return None
+
+            self._git_dirs[repo_path] = (git_dir, os.path.join(
+                self.get_repo_path(repo_path), common_dir))
+
+        return self._git_dirs[repo_path]
+
+    def ref_signature(self, repo_path):
+        """Stat HEAD, packed-refs and every loose ref of a repository
+
+        Any push, fetch, commit or ref update changes the result, and
+        comparing it costs no git process.
+        """
+        git_dirs = self.get_git_dirs(repo_path)
+        if git_dirs is None:
+            return None
+
+        git_dir, common_dir = git_dirs
+        paths = [os.path.join(git_dir, 'HEAD'),
+                 os.path.join(common_dir, 'packed-refs')]
+        for root, _, filenames in os.walk(os.path.join(common_dir, 'refs')):
+            paths.extend(os.path.join(root, filename) for filename in filenames)
+
+        signature = []
+        for path in paths:
+            try:
+                stat = os.stat(path)
+            except FileNotFoundError:
+                continue
+            signature.append((path, stat.st_mtime_ns, stat.st_size))
+
+        return tuple(sorted(signature))
+
+    def missing_commits(self, repo_path, commits):
+        """Get the commits that no longer exist, with one `git cat-file`"""
+        names = [f'{commit}^{{commit}}' for commit in commits]
+        with GitBlobReader(self.get_repo_path(repo_path)) as reader:
+            return {name[:-len('^{commit}')]
+                    for name, info in reader.info_many(names) if info is None}
+
+    def plan_update(self, repo_path, watermarks):
+        """Work out which commits are new since the stored watermarks
+
+        Returns (ref, tip, revisions, orphans). revisions is None when the
+        repo has to be indexed from scratch, orphans lists commits that are
+        no longer reachable after a force-push.
+        """
+        ref = self.git(repo_path, 'symbolic-ref', '-q', 'HEAD') or 'HEAD'
+        tip = self.git(repo_path, 'rev-parse', '--verify', '-q', 'HEAD')
+        if not tip or not watermarks:
+            return ref, tip, None, []
+
+        exclude = []
+        rewritten = []
+        missing = self.missing_commits(repo_path, watermarks.values())
+        for watermark_ref, watermark in watermarks.items():
+            if watermark in missing:
+                print(f"  Indexed commit {watermark} of {watermark_ref} "
+                      "no longer exists, re-indexing from scratch")
+                return ref, tip, None, []
+
+            if watermark_ref == ref and self.git(
+                    repo_path, 'merge-base', '--is-ancestor', watermark, tip) is None:
+                rewritten.append(watermark)
+                base = self.git(repo_path, 'merge-base', watermark, tip)
+                if base:
+                    exclude.append(base)
+                continue
+
+            exclude.append(watermark)
+
+        orphans = []
+        if rewritten:
+            print(f"  {ref} was rewritten, falling back to merge-base")
+            orphans = (self.git(
+                repo_path, 'rev-list', *rewritten, '--not', tip,
+                *exclude) or '').split()
+
+        return ref, tip, [tip, '--not', *exclude], orphans
+
+    def get_ref_tips(self, repo_path):
+        """Get {ref: commit} of every branch, remote branch and tag
+
+        Tags are peeled to the commit they point at, symbolic refs and tags
+        of anything but a commit are left out.
+        """
+        output = self.git(
+            repo_path, 'for-each-ref',
+            '--format=%(refname)%1f%(symref)%1f%(objectname)%1f'
+            '%(*objecttype)%1f%(*objectname)%1f%(objecttype)',
+            *REF_NAMESPACES)
+
+        tips = {}
+        for line in (output or '').splitlines():
+            ref, symref, object_name, peeled_type, peeled_name, object_type = \
+                line.split(FIELD_SEPARATOR)
+            if symref:
+                continue
+            if object_type == 'commit':
+                tips[ref] = object_name
+            elif peeled_type == 'commit':
+                tips[ref] = peeled_name
+
+        return tips
+
+    def plan_all_refs(self, repo_path, watermarks):
+        """Work out which commits of any branch or tag are new
+
+        Returns (tips, revisions, orphans) like plan_update, with tips
+        mapping every ref to its commit. revisions walks the union of all
+        refs once in topological order, so history shared between refs is
+        only indexed once. orphans lists indexed commits no ref reaches any
+        more, after a force-push or a deleted branch.
+        """
+        tips = self.get_ref_tips(repo_path)
+        if not tips or not watermarks:
+            return tips, None, []
+
+        exclude = sorted(set(watermarks.values()))
+        missing = self.missing_commits(repo_path, exclude)
+        if missing:
+            print(f"  Indexed commit {min(missing)} no longer exists, "
+                  "re-indexing from scratch")
+            return tips, None, []
+
+        heads = sorted(set(tips.values()))
+        orphans = (self.git(repo_path, 'rev-list', *exclude, '--not',
+                            *heads) or '').split()
+        if orphans:
+            print(f"  {len(orphans)} indexed commits are no longer on any ref")
+
+        return tips, ['--topo-order', *heads, '--not', *exclude], orphans
+
+    def update_ref_membership(self, repo, tips, state):
+        """Record which of the current refs contain each commit
+
+        Every ref owns a bit of the commit_refs masks of its repository.
+        A fast-forwarded ref only adds its bit to its new commits, new and
+        rewritten refs are walked from their tips in one shared pass and the
+        bits of deleted refs are cleared and reused.
+        """
+        stored = state.get_refs(repo)
+        gone = [ref for ref in stored if ref not in tips]
+        clear = 0
+        for ref in gone:
+            clear |= 1 << stored[ref][0]
+        state.delete_refs(repo, gone)
+
+        used = {bit for ref, (bit, _) in stored.items() if ref in tips}
+        next_bit = 0
+        walk = defaultdict(int)
+        masks = defaultdict(int)
+        for ref, tip in sorted(tips.items()):
+            if ref in stored:
+                bit, old = stored[ref]
+                if old == tip:
+                    continue
+
+                if self.git(repo, 'merge-base', '--is-ancestor', old, tip) is None:
+                    clear |= 1 << bit
+                    walk[tip] |= 1 << bit
+                else:
+                    for commit_hash in (self.git(repo, 'rev-list', tip, '--not',
+                                                 old) or '').split():
+                        masks[commit_hash] |= 1 << bit
+            else:
+                while next_bit in used:
+                    next_bit += 1
+                bit = next_bit
+                used.add(bit)
+                walk[tip] |= 1 << bit
+
+            state.set_ref(repo, ref, bit, tip)
+
+        if clear:
+            state.clear_ref_bits(repo, clear)
+
+        if walk:
+            # Children come before their parents in topological order, so a
+            # commit's mask is complete by the time it is reached
+            proc = subprocess.Popen(
+                ['git', 'rev-list', '--topo-order', '--parents', *sorted(walk)],
+                cwd=self.get_repo_path(repo),
+                stdout=subprocess.PIPE,
+                stderr=subprocess.DEVNULL,
+                text=True
+            )
+            with proc:
+                for line in proc.stdout:
+                    commit_hash, *parents = line.split()
+                    mask = walk.pop(commit_hash, 0)
+                    masks[commit_hash] |= mask
+                    for parent in parents:
+                        walk[parent] |= mask
+
+        state.add_ref_bits(repo, masks)
+        return len(masks)
+
+    def iter_commits(self, repo_path, revisions=None):
+        """Stream commit metadata and changed blobs with a single `git log`"""
+        proc = subprocess.Popen(
+            ['git', 'log', '-z', '--raw', '--no-abbrev', '--no-renames',
+                f'--pretty=format:{LOG_FORMAT}', *(revisions or ['HEAD'])],
+            cwd=self.get_repo_path(repo_path),
+            stdout=subprocess.PIPE,
+            stderr=subprocess.PIPE,
+            encoding='utf-8',
+            errors='replace'
+        )
+
+        try:
+            record = None
+            change = None
+            for token in iter_null_terminated(proc.stdout):
+                if token.startswith(RECORD_SEPARATOR):
+                    if record is not None:
+                        yield record
+
+                    header, _, change = token[1:].partition('\n')
+                    commit_hash, author, date, message = header.split(
+                        FIELD_SEPARATOR, 3)
+                    record = CommitRecord(
+                        commit_hash, author, date, message, [])
+                    token = change
+
+                token = token.lstrip('\n')
+                if not token:
+                    continue
+
+                if token.startswith(':'):
+                    change = token[1:].split(' ')
+                elif change:
+                    _, mode, _, blob, status = change
+                    record.files.append(FileChange(status, token, blob, mode))
+                    change = None
+
+            if record is not None:
+                yield record
+
+            proc.wait()
+            if proc.returncode != 0:
+                print(f"Error getting commits in {repo_path}: "
+                      f"{proc.stderr.read().strip()}")
+        finally:
+            if proc.poll() is None:
+                proc.kill()
+                proc.wait()
+            proc.stdout.close()
+            proc.stderr.close()
+
+    def iter_tree(self, repo_path, ref='HEAD'):
+        """Yield (path, blob, mode, size) of every file in the tree of a ref"""
+        proc = subprocess.Popen(
+            ['git', 'ls-tree', '-r', '-l', '-z', '--full-tree', ref],
+            cwd=self.get_repo_path(repo_path),
+            stdout=subprocess.PIPE,
+            stderr=subprocess.PIPE,
+            encoding='utf-8',
+            errors='replace'
+        )
+
+        try:
+            for token in iter_null_terminated(proc.stdout):
+                if not token:
+                    continue
+
+                entry, _, path = token.partition('\t')
+                mode, object_type, blob, size = entry.split()
+                if object_type == 'blob':
+                    yield path, blob, mode, int(size)
+
+            proc.wait()
+            if proc.returncode != 0:
+                print(f"Error listing {ref} in {repo_path}: "
+                      f"{proc.stderr.read().strip()}")
+        finally:
+            if proc.poll() is None:
+                proc.kill()
+                proc.wait()
+            proc.stdout.close()
+            proc.stderr.close()
+
+    def iter_hunks(self, repo_path, revisions=None):
+        """Stream the added and removed lines of every hunk with `git log -p`"""
+        proc = subprocess.Popen(
+            ['git', '-c', 'core.quotepath=off', 'log', '-p', '-U0',
+                '--no-color', '--no-renames', '--no-ext-diff',
+                '--src-prefix=a/', '--dst-prefix=b/',
+                f'--pretty=format:{LOG_FORMAT}', *(revisions or ['HEAD'])],
+            cwd=self.get_repo_path(repo_path),
+            stdout=subprocess.PIPE,
+            stderr=subprocess.PIPE,
+            encoding='utf-8',
+            errors='replace'
+        )
+
+        try:
+            record = None
+            path = None
+            hunk = None
+            for line in proc.stdout:
+                line = line.rstrip('\n')
+
+                if hunk is not None and line[:1] in ('+', '-', '\\'):
+                    if line.startswith('+'):
+                        hunk.added.append(line[1:])
+                    elif line.startswith('-'):
+                        hunk.removed.append(line[1:])
+                    continue
+
+                if hunk is not None:
+                    yield hunk
+                    hunk = None
+
+                if line.startswith(RECORD_SEPARATOR):
+                    commit_hash, author, date, message = line[1:].split(
+                        FIELD_SEPARATOR, 3)
+                    record = CommitRecord(
+                        commit_hash, author, date, message, None)
+                    path = None
+                elif line.startswith('diff --git '):
+                    path = None
+                elif line.startswith('--- ') and line != '--- /dev/null':
+                    # Names with spaces are followed by a tab
+                    path = unquote_path(line[4:].rstrip('\t'))[2:]
+                elif line.startswith('+++ ') and line != '+++ /dev/null':
+                    path = unquote_path(line[4:].rstrip('\t'))[2:]
+                elif line.startswith('@@') and record and path:
+                    hunk = HunkRecord(record.commit_hash, record.author,
+                                      record.date, path, line, [], [])
+
+            if hunk is not None:
+                yield hunk
+
+            proc.wait()
+            if proc.returncode != 0:
+                print(f"Error getting diffs in {repo_path}: "
+                      f"{proc.stderr.read().strip()}")
+        finally:
+            if proc.poll() is None:
+                proc.kill()
+                proc.wait()
+            proc.stdout.close()
+            proc.stderr.close()
+
+    def get_blob_reader(self, repo_path):
+        """Get a batched blob reader for a repository"""
+        if self.pack_reader:
+            return PackBlobReader(self.get_repo_path(repo_path))
+
+        return GitBlobReader(self.get_repo_path(repo_path))
+
+    def decode_blob(self, data):
+        """Decode blob bytes as UTF-8, returns None for binary content"""
+        if data is None:
+            return None
+
+        try:
+            return data.decode('utf-8')
+        except UnicodeDecodeError:
+            return None
+
+    def prefilter_blobs(self, paths, reader, attributes, report):
+        """Drop blobs that are too large or binary before reading them
+
+        paths maps blob ids to the paths they appear at, returns the blob
+        ids worth reading, the ones known to be binary and {blob: size} of
+        the ones too large.
+        """
+        to_read = []
+        binary = []
+        oversized = {}
+        for blob, info in reader.info_many(list(paths)):
+            size = info[2] if info else 0
+            if size > self.max_blob_size:
+                report.add(SKIP_TOO_LARGE, size)
+                oversized[blob] = size
+            elif any(attributes.is_binary(path) for path in paths[blob]):
+                report.add(SKIP_BINARY_ATTRIBUTE, size)
+                binary.append(blob)
+            else:
+                to_read.append(blob)
+
+        return to_read, binary, oversized
+
+    def index_commits(self, repo, revisions, writer, state, metrics=None):
+        """Index the blobs changed by a range of commits
+
+        Returns (files, blobs, report) with the skipped blobs in report.
+        Time and bytes of every stage are added to metrics. Commits
+        checkpointed by an interrupted run are skipped, and writer is given
+        a chance to commit after each commit.
+        """
+        total_files = 0
+        total_blobs = 0
+        commits = 0
+        resumed = 0
+        report = SkipReport()
+        if metrics is None:
+            metrics = IndexMetrics()
+        metrics.start_repo(repo)
+
+        with self.get_blob_reader(repo) as reader, \
+                GitAttributes(self.get_repo_path(repo)) as attributes:
+            records = metrics.timed_iter(repo, 'git_log',
+                                         self.iter_commits(repo, revisions))
+            for record in records:
+                if state.is_checkpointed(repo, record.commit_hash):
+                    resumed += 1
+                    continue
+
+                commits += 1
+                if commits % 50 == 1:
+                    print(
+                        f"  {repo}: processing commit {commits}: {record.commit_hash}")
+
+                changes = [change for change in record.files
+                           if change.status != 'D' and change.mode != GITLINK_MODE]
+
+                unseen = {}
+                oversized = {}
+                with metrics.timed(repo, 'state'):
+                    for change in changes:
+                        if state.is_blob_indexed(change.blob) is None:
+                            unseen.setdefault(change.blob, []).append(change.path)
+
+                if unseen:
+                    with metrics.timed(repo, 'prefilter'):
+                        to_read, binary, oversized = self.prefilter_blobs(
+                            unseen, reader, attributes, report)
+                        for blob in binary:
+                            state.add_blob(blob, False)
+                        for blob, size in oversized.items():
+                            state.add_oversized_blob(blob, size)
+
+                    blobs = metrics.timed_iter(
+                        repo, 'git_read', reader.read_many(to_read),
+                        size=lambda item: len(item[1] or b''))
+                    for blob, data in blobs:
+                        size = len(data or b'')
+                        metrics.count(repo, size=size)
+                        with metrics.timed(repo, 'decode', size):
+                            content = self.decode_blob(data)
+                        state.add_blob(blob, bool(content))
+                        if not content:
+                            report.add(SKIP_BINARY_CONTENT, size)
+                            continue
+
+                        with metrics.timed(repo, 'analyze', size):
+                            writer.update_document(blob=blob, content=content)
+                        with metrics.timed(repo, 'trigrams', size):
+                            state.trigrams.add(blob, content)
+                        total_blobs += 1
+                        metrics.count(repo, blobs=1)
+
+                with metrics.timed(repo, 'state'):
+                    for change in changes:
+                        if change.blob in oversized:
+                            state.add_oversized_occurrence(
+                                change.blob, repo, record.commit_hash,
+                                change.path, record.date, record.author)
+                            continue
+                        if not state.is_blob_indexed(change.blob):
+                            continue
+
+                        state.add_occurrence(
+                            change.blob, repo, record.commit_hash,
+                            change.path, record.date, record.author)
+
+                        total_files += 1
+                        metrics.count(repo, files=1)
+                        if total_files % 100 == 0:
+                            print(f"  {repo}: indexed {metrics.progress(repo)}")
+
+                    state.add_checkpoint(repo, record.commit_hash)
+                writer.checkpoint()
+
+        metrics.finish_repo(repo)
+        if resumed:
+            print(f"  {repo}: skipped {resumed} commits indexed by an "
+                  "interrupted run")
+        print(f"  {repo}: processed {commits} new commits, "
+              f"{metrics.progress(repo)}")
+        return total_files, total_blobs, report
+
+    def resume_checkpoints(self, repo, tips, state):
+        """Keep the checkpoints of an interrupted run that are still valid
+
+        Checkpointed commits that are no longer reachable from any of tips,
+        after a force-push during the interruption, lose their occurrences.
+        Returns whether any checkpoints are left to resume from.
+        """
+        checkpoints = state.get_checkpoints(repo)
+        if not checkpoints:
+            return False
+
+        commits = sorted(checkpoints)
+        unreachable = set()
+        for start in range(0, len(commits), 1000):
+            output = self.git(repo, 'rev-list', *commits[start:start + 1000],
+                              '--not', *tips)
+            if output is None:
+                unreachable = checkpoints
+                break
+            unreachable.update(output.split())
+
+        stale = checkpoints & unreachable
+        if stale:
+            state.delete_commits(repo, stale)
+
+        resumed = len(checkpoints) - len(stale)
+        if resumed:
+            print(f"  Resuming an interrupted run, {resumed} commits "
+                  "are already indexed")
+        return resumed > 0
+
+    def split_revisions(self, repo, revisions, jobs):
+        """Split a large commit range into --skip/--max-count slices"""
+        revisions = revisions or ['HEAD']
+        if jobs <= 1:
+            return [revisions]
+
+        count = int(self.git(repo, 'rev-list', '--count', *revisions) or 0)
+        size = max(MIN_COMMITS_PER_JOB, -(-count // jobs))
+        if count <= size:
+            return [revisions]
+
+        return [[*revisions, f'--skip={skip}', f'--max-count={size}']
+                for skip in range(0, count, size)]
+
+    def merge_job(self, job, writer, state):
+        """Merge the segment and occurrences written by a worker"""
+        job_ix = index.open_dir(job.job_dir)
+        job_conn = sqlite3.connect(os.path.join(job.job_dir, 'state.db'))
+        try:
+            cursor = job_conn.execute(
+                'SELECT blob FROM blobs WHERE indexed = 1')
+            duplicates = [blob for blob, in cursor
+                          if state.is_blob_indexed(blob) is not None]
+            if duplicates:
+                with job_ix.writer() as job_writer:
+                    for blob in duplicates:
+                        job_writer.delete_by_term('blob', blob)
+
+            with job_ix.reader() as reader:
+                writer.add_reader(reader)
+
+            job_store = BlobStore(os.path.join(job.job_dir, 'store'))
+            try:
+                state.trigrams.merge_from(job_conn, job_store)
+            finally:
+                job_store.close()
+            state.conn.executemany(
+                'INSERT OR IGNORE INTO blobs (blob, indexed) VALUES (?, ?)',
+                job_conn.execute('SELECT blob, indexed FROM blobs'))
+            state.conn.executemany(
+                'INSERT OR IGNORE INTO checkpoints (repo, commit_hash) '
+                'VALUES (?, ?)',
+                job_conn.execute('SELECT repo, commit_hash FROM checkpoints'))
+            state.conn.executemany(
+                'INSERT OR REPLACE INTO oversized_blobs (blob, size) '
+                'VALUES (?, ?)',
+                job_conn.execute('SELECT blob, size FROM oversized_blobs'))
+            state.conn.executemany('''
+                INSERT INTO oversized_occurrences
+                    (blob, repo, commit_hash, path, commit_date, author)
+                VALUES (?, ?, ?, ?, ?, ?)
+            ''', job_conn.execute('''
+                SELECT blob, repo, commit_hash, path, commit_date, author
+                FROM oversized_occurrences
+            '''))
+            state.conn.executemany('''
+                INSERT INTO occurrences
+                    (blob, repo, commit_hash, path, commit_date, commit_time,
+                     author)
+                VALUES (?, ?, ?, ?, ?, ?, ?)
+            ''', job_conn.execute('''
+                SELECT blob, repo, commit_hash, path, commit_date, commit_time,
+                    author
+                FROM occurrences
+            '''))
+        finally:
+            job_conn.close()
+            job_ix.close()
+
+    def find_repos(self):
+        """Get the repositories to index, explaining when there are none"""
+        repos = self.get_repo_list()
+
+        print(f"Found {len(repos)} repositories to index")
+        if not repos:
+            print(f"No Git repositories found in {self.repos_dir}")
+            print("Make sure you're providing a directory that contains Git repositories")
+            print("or a Git repository itself.")
+
+        return repos
+
+    def index_oversized(self, repo, writer, state):
+        """Index the blobs skipped for their size that now fit the limit
+
+        Commits are never walked again once watermarked, so the occurrences
+        of oversized blobs are kept aside until --max-blob-size is raised
+        enough. Returns (files, blobs) like index_commits.
+        """
+        blobs = state.get_oversized_blobs(repo, self.max_blob_size)
+        if not blobs:
+            return 0, 0
+
+        print(f"  {repo}: indexing {len(blobs)} blobs that now fit "
+              "--max-blob-size")
+        occurrences = {blob: state.take_oversized_occurrences(blob)
+                       for blob in blobs}
+        total_files = 0
+        total_blobs = 0
+        with self.get_blob_reader(repo) as reader, \
+                GitAttributes(self.get_repo_path(repo)) as attributes:
+            to_read = []
+            for blob, rows in occurrences.items():
+                if state.is_blob_indexed(blob) is not None:
+                    continue
+                if any(attributes.is_binary(path)
+                       for row_repo, _, path, _, _ in rows if row_repo == repo):
+                    state.add_blob(blob, False)
+                else:
+                    to_read.append(blob)
 
-        self.schema = Schema(
-            path=ID(stored=True),
-            repo=ID(stored=True),
-            content=TEXT(analyzer=StandardAnalyzer()),
-            commit_hash=ID(stored=True),
-            commit_date=STORED,
-            commit_author=STORED
-        )
+            for blob, data in reader.read_many(to_read):
+                content = self.decode_blob(data)
+                state.add_blob(blob, bool(content))
+                if content:
+                    writer.update_document(blob=blob, content=content)
+                    state.trigrams.add(blob, content)
+                    total_blobs += 1
 
-        if not os.path.exists(self.index_dir):
-            os.makedirs(self.index_dir)
-            self.ix = index.create_in(self.index_dir, self.schema)
-        else:
+        for blob, rows in occurrences.items():
+            if not state.is_blob_indexed(blob):
+                continue
+
+            for row_repo, commit_hash, path, commit_date, author in rows:
+                state.add_occurrence(blob, row_repo, commit_hash, path,
+                                     commit_date, author)
+                total_files += 1
+        return total_files, total_blobs
+
+    def index_repos(self, jobs=1):
+        """Index all text files in all commits of all repositories
+
+        Returns the IndexMetrics of the run.
+        """
+        started = time.perf_counter()
+        metrics = IndexMetrics()
+        repos = self.find_repos()
+        if not repos:
+            return metrics
+
+        total_files = 0
+        total_blobs = 0
+        report = SkipReport()
+        watermarks = []
+        planned = []
+
+        jobs_dir = os.path.join(self.index_dir, 'jobs')
+        shutil.rmtree(jobs_dir, ignore_errors=True)
+
+        with IndexState(self.index_dir) as state:
+            for repo in repos:
+                print(f"Planning repository: {repo}")
+
+                with metrics.timed(repo, 'plan'):
+                    if self.all_refs:
+                        tips, revisions, orphans = self.plan_all_refs(
+                            repo, state.get_watermarks(repo))
+                    else:
+                        ref, tip, revisions, orphans = self.plan_update(
+                            repo, state.get_watermarks(repo))
+                        tips = {ref: tip} if tip else {}
+                if not tips:
+                    print(f"  No commits found in repo {repo}, skipping...")
+                    continue
+
+                resumed = self.resume_checkpoints(repo, tips.values(), state)
+                if revisions is None and not resumed:
+                    state.clear_repo(repo)
+                if revisions is None and self.all_refs:
+                    revisions = ['--topo-order', *sorted(set(tips.values()))]
+                state.delete_commits(repo, orphans)
+
+                for sliced in self.split_revisions(repo, revisions, jobs):
+                    job_dir = os.path.join(jobs_dir, str(len(planned)))
+                    planned.append(IndexJob(repo, sliced, job_dir))
+                watermarks.append((repo, tips))
+
+            writer = CommittingWriter(self.ix, state, self.writer_limits, metrics)
             try:
-                self.ix = index.open_dir(self.index_dir)
-            except:
-                self.ix = index.create_in(self.index_dir, self.schema)
+                if jobs <= 1:
+                    for job in planned:
+                        files, blobs, skipped = self.index_commits(
+                            job.repo, job.revisions, writer, state, metrics)
+                        total_files += files
+                        total_blobs += blobs
+                        report.merge(skipped)
+                else:
+                    print(f"Indexing {len(planned)} jobs on {jobs} processes")
+                    with ProcessPoolExecutor(max_workers=jobs) as pool:
+                        futures = [pool.submit(run_index_job, self.repos_dir,
+                                               self.index_dir, job,
+                                               self.max_blob_size,
+                                               self.writer_limits,
+                                               self.pack_reader)
+                                   for job in planned]
+                        for done, future in enumerate(as_completed(futures), 1):
+                            job, files, blobs, skipped, job_metrics = future.result()
+                            with metrics.timed(job.repo, 'merge'):
+                                self.merge_job(job, writer, state)
+                            metrics.merge(job_metrics)
+                            total_files += files
+                            total_blobs += blobs
+                            report.merge(skipped)
+                            print(f"[{done}/{len(planned)}] Merged {job.repo}, "
+                                  f"{total_files} files indexed so far")
+                            writer.checkpoint()
 
-    def get_repo_list(self):
-        """Get list of all directories that are Git repositories"""
-        repos = []
+                for repo in repos:
+                    with metrics.timed(repo, 'oversized'):
+                        files, blobs = self.index_oversized(repo, writer, state)
+                    total_files += files
+                    total_blobs += blobs
+            except BaseException:
+                writer.cancel()
+                raise
 
-        if os.path.exists(os.path.join(self.repos_dir, '.git')):
-            repos.append(os.path.basename(self.repos_dir))
-            print(f"Found Git repo: {os.path.basename(self.repos_dir)}")
-            return repos
+            writer.commit()
 
-        for item in os.listdir(self.repos_dir):
-            item_path = os.path.join(self.repos_dir, item)
-            if os.path.isdir(item_path):
-                if os.path.exists(os.path.join(item_path, '.git')):
-                    repos.append(item)
-                    print(f"Found Git repository: {item}")
+            for repo, tips in watermarks:
+                if self.all_refs:
+                    state.set_watermarks(repo, tips)
+                    with metrics.timed(repo, 'refs'):
+                        self.update_ref_membership(repo, tips, state)
+                else:
+                    for ref, tip in tips.items():
+                        state.set_watermark(repo, ref, tip)
+                state.clear_checkpoints(repo)
+            with metrics.timed(None, 'state_commit'):
+                state.commit()
 
-        return repos
+        shutil.rmtree(jobs_dir, ignore_errors=True)
+        metrics.seconds = time.perf_counter() - started
+        print(f"Indexing complete. Total files indexed: {total_files}, "
+              f"unique blobs analyzed: {total_blobs}")
+        report.print_summary()
+        metrics.print_summary()
+        return metrics
 
-    def get_all_commits(self, repo_path):
-        """Get all commit hashes in reverse chronological order"""
-        try:
-            actual_repo_path = repo_path
-            if repo_path == os.path.basename(self.repos_dir) and os.path.exists(os.path.join(self.repos_dir, '.git')):
-                actual_repo_path = self.repos_dir
+    def index_hunks(self):
+        """Index only the added and removed lines of every commit"""
+        repos = self.find_repos()
+        if not repos:
+            return
+
+        total_hunks = 0
+        watermarks = []
+        hunk_ix = self.hunk_ix
+
+        with IndexState(self.hunk_dir) as state:
+            with hunk_ix.writer(limitmb=self.writer_limits.limitmb) as writer:
+                for repo in repos:
+                    print(f"Indexing hunks of repository: {repo}")
+
+                    ref, tip, revisions, orphans = self.plan_update(
+                        repo, state.get_watermarks(repo))
+                    if not tip:
+                        print(f"  No commits found in repo {repo}, skipping...")
+                        continue
+
+                    if revisions is None:
+                        writer.delete_by_term('repo', repo)
+                        state.clear_repo(repo)
+                    for commit_hash in orphans:
+                        writer.delete_by_query(
+                            And([Term('repo', repo), Term('commit_hash', commit_hash)]))
+
+                    for hunk in self.iter_hunks(repo, revisions):
+                        writer.add_document(
+                            repo=repo,
+                            path=hunk.path,
+                            commit_hash=hunk.commit_hash,
+                            author=hunk.author,
+                            date=utc_naive(parse_date(hunk.date)),
+                            hunk=hunk.header,
+                            added='\n'.join(hunk.added),
+                            removed='\n'.join(hunk.removed)
+                        )
+
+                        total_hunks += 1
+                        if total_hunks % 1000 == 0:
+                            print(f"  Indexed {total_hunks} hunks so far...")
+
+                    watermarks.append((repo, ref, tip))
+
+            for repo, ref, tip in watermarks:
+                state.set_watermark(repo, ref, tip)
+            state.commit()
+
+        print(f"Indexing complete. Total hunks indexed: {total_hunks}")
+
+    def index_snapshot(self, ref='HEAD'):
+        """Build or refresh the index of the files in the tree of a ref"""
+        repos = self.find_repos()
+        if not repos:
+            return
+
+        snapshot_ix = self.snapshot_ix
+
+        with IndexState(self.index_dir) as state:
+            with snapshot_ix.searcher() as searcher, \
+                    snapshot_ix.writer(limitmb=self.writer_limits.limitmb) as writer:
+                self.refresh_snapshot(repos, ref, searcher, writer, state)
+            state.commit()
+
+    def refresh_snapshot(self, repos, ref, searcher, writer, state):
+        """Update the snapshot documents of every repo to the tree of ref"""
+        total_files = 0
+        removed_files = 0
+        report = SkipReport()
+
+        for repo in repos:
+            print(f"Indexing {ref} of repository: {repo}")
+
+            indexed = {hit['path']: hit['blob']
+                       for hit in searcher.documents(repo=repo)}
+            changed = {}
+            sizes = {}
+            for path, blob, _, size in self.iter_tree(repo, ref):
+                # Blobs skipped for their size have no trigram entry and are
+                # looked at again once they fit --max-blob-size
+                if (indexed.pop(path, None) != blob
+                        or not state.trigrams.has(blob)
+                        and size <= self.max_blob_size):
+                    changed[path] = blob
+                    sizes[blob] = size
+
+            for path in indexed:
+                writer.delete_by_term('key', f'{repo}:{path}')
+                removed_files += 1
+
+            paths = {blob: [] for blob in changed.values()}
+            for path, blob in changed.items():
+                paths[blob].append(path)
+
+            to_read = []
+            with GitAttributes(self.get_repo_path(repo)) as attributes:
+                for blob, blob_paths in paths.items():
+                    if sizes[blob] > self.max_blob_size:
+                        report.add(SKIP_TOO_LARGE, sizes[blob])
+                    elif any(attributes.is_binary(path) for path in blob_paths):
+                        report.add(SKIP_BINARY_ATTRIBUTE, sizes[blob])
+                    else:
+                        to_read.append(blob)
+
+            contents = dict.fromkeys(paths)
+            with self.get_blob_reader(repo) as reader:
+                for blob, data in reader.read_many(to_read):
+                    contents[blob] = self.decode_blob(data)
+                    if contents[blob] is None:
+                        report.add(SKIP_BINARY_CONTENT, sizes[blob])
+
+            for blob, content in contents.items():
+                if sizes[blob] <= self.max_blob_size:
+                    state.trigrams.add(blob, content)
+                for path in paths[blob]:
+                    # Skipped files keep a document without content so a
+                    # refresh does not look at them again
+                    writer.update_document(
+                        key=f'{repo}:{path}',
+                        repo=repo,
+                        path=path,
+                        ref=ref,
+                        blob=blob,
+                        content=content or ''
+                    )
+                    total_files += 1
+
+            print(f"  {len(changed)} changed and {len(indexed)} removed files")
+
+        print(f"Snapshot complete. Files indexed: {total_files}, "
+              f"files removed: {removed_files}")
+        report.print_summary()
+
+    def reindex_from_store(self, target='history'):
+        """Rebuild the history or snapshot index from the blob store
+
+        Git is never called, so this is how a changed schema or analyzer is
+        picked up without walking history again. state.db is kept as is.
+        """
+        if self.is_sharded():
+            for name in self.shard_names():
+                print(f"Reindexing shard: {name}")
+                self.get_shard(name).reindex_from_store(target)
+            return
+
+        total_files = 0
+        missing = 0
+        with IndexState(self.index_dir) as state:
+            if target == 'snapshot':
+                docs = []
+                if index.exists_in(self.snapshot_dir):
+                    old_ix = index.open_dir(self.snapshot_dir)
+                    with old_ix.searcher() as searcher:
+                        docs = list(searcher.all_stored_fields())
+                    old_ix.close()
+
+                os.makedirs(self.snapshot_dir, exist_ok=True)
+                self._snapshot_ix = index.create_in(self.snapshot_dir,
+                                                    self.snapshot_schema)
+                with self._snapshot_ix.writer(limitmb=self.writer_limits.limitmb) as writer:
+                    for doc in docs:
+                        writer.add_document(
+                            key=f"{doc['repo']}:{doc['path']}",
+                            content=state.trigrams.read(doc['blob']) or '',
+                            **doc)
+                        total_files += 1
             else:
-                actual_repo_path = os.path.join(self.repos_dir, repo_path)
+                blobs = state.get_indexed_blobs()
+                self._ix = index.create_in(self.index_dir, self.schema)
+                with self._ix.writer(limitmb=self.writer_limits.limitmb) as writer:
+                    for blob in blobs:
+                        content = state.trigrams.read(blob)
+                        if content is None:
+                            missing += 1
+                            continue
 
-            result = subprocess.run(
-                ['git', 'log', '--pretty=format:%H'],
-                cwd=actual_repo_path,
-                stdout=subprocess.PIPE,
-                stderr=subprocess.PIPE,
-                text=True
-            )
-            if result.returncode != 0:
-                print(f"Error getting commits: {result.stderr}")
-                return []
+                        writer.add_document(blob=blob, content=content)
+                        total_files += 1
+                        if total_files % 1000 == 0:
+                            print(f"  Reindexed {total_files} blobs so far...")
 
-            commits = result.stdout.strip().split('\n')
-            return [c for c in commits if c]
-        except Exception as e:
-            print(f"Error getting commits in {repo_path}: {e}")
+        print(f"Reindex complete. Documents written: {total_files}")
+        if missing:
+            print(f"{missing} indexed blobs have no text in the store and were "
+                  "left out, delete the index and run index to restore them")
+
+    def index(self, mode='history', jobs=1, ref='HEAD'):
+        """Update the history, hunk or snapshot index
+
+        Returns the IndexMetrics of a history run, None for the others.
+        """
+        if mode == 'hunks':
+            self.index_hunks()
+        elif mode == 'snapshot':
+            self.index_snapshot(ref)
+        else:
+            return self.index_repos(jobs=jobs)
+
+    def is_sharded(self):
+        """Whether the index is kept as one shard per repository"""
+        return os.path.isdir(self.shard_root)
+
+    def shard_names(self):
+        """Get the names of the repositories that have a shard"""
+        if not self.is_sharded():
             return []
 
-    def get_commit_info(self, repo_path, commit_hash):
-        """Get commit metadata"""
-        try:
-            actual_repo_path = repo_path
-            if repo_path == os.path.basename(self.repos_dir) and os.path.exists(os.path.join(self.repos_dir, '.git')):
-                actual_repo_path = self.repos_dir
-            else:
-                actual_repo_path = os.path.join(self.repos_dir, repo_path)
+        return sorted(name for name in os.listdir(self.shard_root)
+                      if os.path.isdir(os.path.join(self.shard_root, name)))
 
-            result = subprocess.run(
-                ['git', 'show', '-s', '--pretty=format:%an|%ad|%s', commit_hash],
-                cwd=actual_repo_path,
-                stdout=subprocess.PIPE,
-                stderr=subprocess.PIPE,
-                text=True
-            )
-            if result.returncode != 0 or not result.stdout:
-                return None, None, None
+    def get_shard(self, repo):
+        """Get an indexer for the shard of one repository"""
+        return GitRepoIndexer(self.repos_dir,
+                              os.path.join(self.shard_root, repo),
+                              self.max_blob_size, repos=[repo],
+                              writer_limits=self.writer_limits,
+                              pack_reader=self.pack_reader,
+                              all_refs=self.all_refs)
 
-            parts = result.stdout.split('|', 2)
-            if len(parts) != 3:
-                return None, None, None
+    def index_shards(self, mode='history', jobs=1, ref='HEAD', repos=None):
+        """Update the shard of every repository, or only of the given repos
 
-            author, date, message = parts
-            return author, date, message
-        except Exception as e:
-            print(
-                f"Error getting info for commit {commit_hash} in {repo_path}: {e}")
-            return None, None, None
+        Shards are independent indexes, so with jobs > 1 each worker process
+        indexes whole shards and nothing has to be merged afterwards. Returns
+        the IndexMetrics of all shards for a history run.
+        """
+        started = time.perf_counter()
+        metrics = IndexMetrics()
+        os.makedirs(self.shard_root, exist_ok=True)
+        names = self.find_repos()
+        if repos:
+            for repo in sorted(set(repos) - set(names)):
+                print(f"No Git repository named {repo} in {self.repos_dir}")
+            names = [name for name in names if name in repos]
+
+        if jobs <= 1:
+            for repo in names:
+                print(f"Updating shard: {repo}")
+                shard_metrics = self.get_shard(repo).index(mode, ref=ref)
+                if shard_metrics is not None:
+                    metrics.merge(shard_metrics)
+        else:
+            print(f"Indexing {len(names)} shards on {jobs} processes")
+            with ProcessPoolExecutor(max_workers=jobs) as pool:
+                futures = [pool.submit(run_shard_job, self.repos_dir,
+                                       self.shard_root, repo,
+                                       self.max_blob_size, mode, ref,
+                                       self.writer_limits, self.pack_reader,
+                                       self.all_refs)
+                           for repo in names]
+                for done, future in enumerate(as_completed(futures), 1):
+                    repo, shard_metrics = future.result()
+                    if shard_metrics is not None:
+                        metrics.merge(shard_metrics)
+                    print(f"[{done}/{len(names)}] Updated shard {repo}")
+
+        metrics.seconds = time.perf_counter() - started
+        return metrics if mode == 'history' else None
+
+    def drop_shard(self, repo):
+        """Delete the shard of one repository, leaving the others untouched"""
+        shard_dir = os.path.join(self.shard_root, repo)
+        if not os.path.isdir(shard_dir):
+            print(f"No shard for repository {repo}")
+            return False
+
+        shutil.rmtree(shard_dir)
+        print(f"Dropped shard: {repo}")
+        return True
+
+    def rebuild_shard(self, repo, jobs=1):
+        """Drop and re-index the shard of one repository from scratch"""
+        shard = self.get_shard(repo)
+        modes = ['history']
+        if os.path.isdir(shard.hunk_dir):
+            modes.append('hunks')
+        if os.path.isdir(shard.snapshot_dir):
+            modes.append('snapshot')
+
+        self.drop_shard(repo)
+        shard = self.get_shard(repo)
+        for mode in modes:
+            shard.index(mode, jobs=jobs)
 
-    def get_commit_files(self, repo_path, commit_hash):
-        """Get all files modified in a commit"""
+    def list_shards(self):
+        """Print every shard with its document count and size on disk"""
+        names = self.shard_names()
+        if not names:
+            print("No shards found.")
+            return
+
+        for name in names:
+            shard = self.get_shard(name)
+            size = sum(os.path.getsize(os.path.join(root, filename))
+                       for root, _, filenames in os.walk(shard.index_dir)
+                       for filename in filenames)
+            print(f"{name}: {shard.ix.doc_count()} blobs, {format_size(size)}")
+            shard.ix.close()
+
+    def update_repos(self, repos, mode='history', jobs=1, ref='HEAD'):
+        """Incrementally index only the given repositories"""
+        if self.is_sharded():
+            self.index_shards(mode, jobs, ref, repos)
+        else:
+            GitRepoIndexer(self.repos_dir, self.index_dir, self.max_blob_size,
+                           repos=repos, writer_limits=self.writer_limits,
+                           pack_reader=self.pack_reader,
+                           all_refs=self.all_refs).index(mode, jobs, ref)
+
+    def watch(self, mode='history', jobs=1, ref='HEAD',
+              interval=DEFAULT_WATCH_INTERVAL, debounce=DEFAULT_WATCH_DEBOUNCE):
+        """Keep the index up to date by re-indexing repos whose refs change
+
+        Refs are polled every interval seconds. A changed repo is indexed
+        once its refs were quiet for debounce seconds, so a burst of pushes
+        costs one update, or after WATCH_MAX_DELAY seconds of constant
+        changes. Repos that settle together are indexed as one batch on at
+        most jobs processes, failed batches are retried after debounce.
+        """
+        indexed = {repo: self.ref_signature(repo)
+                   for repo in self.get_repo_list(verbose=False)}
+        self.update_repos(None, mode, jobs, ref)
+
+        # repo -> (signature, first change, last change)
+        pending = {}
+        print(f"Watching {len(indexed)} repositories for ref changes, "
+              "press Ctrl+C to stop")
         try:
-            actual_repo_path = repo_path
-            if repo_path == os.path.basename(self.repos_dir) and os.path.exists(os.path.join(self.repos_dir, '.git')):
-                actual_repo_path = self.repos_dir
-            else:
-                actual_repo_path = os.path.join(self.repos_dir, repo_path)
+            while True:
+                time.sleep(interval)
+                now = time.monotonic()
+                current = {repo: self.ref_signature(repo)
+                           for repo in self.get_repo_list(verbose=False)}
+                for repo in set(indexed) - set(current):
+                    print(f"Repository {repo} disappeared, no longer watching it")
+                    del indexed[repo]
+                    pending.pop(repo, None)
 
-            result = subprocess.run(
-                ['git', 'diff-tree', '--no-commit-id',
-                    '--name-only', '-r', commit_hash],
-                cwd=actual_repo_path,
-                stdout=subprocess.PIPE,
-                stderr=subprocess.PIPE,
-                text=True
-            )
-            if result.returncode != 0:
-                return []
+                for repo, signature in current.items():
+                    if repo in indexed and signature == indexed[repo]:
+                        pending.pop(repo, None)
+                    elif repo not in pending:
+                        pending[repo] = (signature, now, now)
+                    elif pending[repo][0] != signature:
+                        pending[repo] = (signature, pending[repo][1], now)
 
-            files = result.stdout.strip().split('\n')
-            return [f for f in files if f]
-        except Exception as e:
-            print(
-                f"Error getting files for commit {commit_hash} in {repo_path}: {e}")
-            return []
+                settled = sorted(
+                    repo for repo, (_, first, last) in pending.items()
+                    if now - last >= debounce or now - first >= WATCH_MAX_DELAY)
+                if not settled:
+                    continue
+
+                print(f"Refs changed in {', '.join(settled)}, updating")
+                for repo in settled:
+                    indexed[repo] = pending.pop(repo)[0]
+                try:
+                    self.update_repos(settled, mode, jobs, ref)
+                except Exception as e:
+                    print(f"Error updating {', '.join(settled)}: {e}, "
+                          "will retry")
+                    for repo in settled:
+                        indexed[repo] = None
+        except KeyboardInterrupt:
+            print("Stopped watching")
+
+    def get_index(self, target):
+        """Get the Whoosh index searched for a target"""
+        if target == 'hunks':
+            return self.hunk_ix
+        if target == 'snapshot':
+            return self.snapshot_ix
+
+        return self.ix
+
+    def parse_query(self, target, query_string):
+        """Parse a query string against the fields of a target"""
+        ix = self.get_index(target)
+        query_parser = MultifieldParser(SEARCH_FIELDS[target], schema=ix.schema)
+        return query_parser.parse(query_string)
+
+    def check_search(self, target, mode='query', filters=None, sort='score',
+                     limit=100, page=1):
+        """Raise ValueError for option combinations a target cannot serve"""
+        filters = filters or SearchFilters()
+        if limit < 1 or page < 1:
+            raise ValueError("--limit and --page must be at least 1")
+        if target == 'hunks' and mode != 'query':
+            raise ValueError("--regex and --literal only search the history "
+                             "and snapshot indexes")
+        if target != 'history' and filters.ref:
+            raise ValueError("--ref only filters the history index")
+        if target == 'snapshot' and (filters.author or filters.since
+                                     or filters.until or sort == 'date'):
+            raise ValueError("the snapshot index can only be filtered by "
+                             "--repo and sorted by score")
+
+    def whoosh_filter(self, target, filters):
+        """Build a Whoosh filter query for the hunk and snapshot indexes"""
+        if filters is None:
+            return None
+
+        terms = []
+        if filters.repo:
+            terms.append(Term('repo', filters.repo))
+        if target == 'hunks' and filters.author:
+            terms.append(Term('author', filters.author.lower()))
+        if target == 'hunks' and (filters.since or filters.until):
+            terms.append(DateRange(
+                'date',
+                utc_naive(filters.since) if filters.since else None,
+                utc_naive(filters.until) if filters.until else None))
+
+        return And(terms) if terms else None
+
+    def matching_blobs(self, query, searcher):
+        """Get the ids of every blob matching a query from the blob column"""
+        column = searcher.reader().column_reader('blob')
+        return {column[docnum] for docnum in searcher.docs_for_query(query)}
+
+    def collect(self, searcher, query, limit, deadline=None, **options):
+        """Collect the top limit hits, stopping at the deadline
+
+        Returns (hits, truncated). The collector only keeps a heap of the
+        top hits and is timed with a thread rather than SIGALRM, so it also
+        works in the threads of a sharded search.
+        """
+        collector = searcher.collector(limit=limit, **options)
+        if deadline is not None:
+            collector = TimeLimitCollector(collector, time_left(deadline),
+                                           use_alarm=False)
 
-    def get_file_content_at_commit(self, repo_path, commit_hash, file_path):
-        """Get content of a file at a specific commit"""
         try:
-            actual_repo_path = repo_path
-            if repo_path == os.path.basename(self.repos_dir) and os.path.exists(os.path.join(self.repos_dir, '.git')):
-                actual_repo_path = self.repos_dir
+            searcher.search_with_collector(query, collector)
+        except TimeLimit:
+            return collector.results(), True
+
+        return collector.results(), False
+
+    def find(self, target, query, query_string, searcher, state, limit=100,
+             filters=None, sort='score', page=1, deadline=None, count=False):
+        """Run a parsed query and return one page of matches as a ResultPage
+
+        The total is only computed with count, and not when the deadline
+        cut the search short.
+        """
+        self.check_search(target, 'query', filters, sort, limit, page)
+        offset = (page - 1) * limit
+        wanted = offset + limit
+
+        if target in ('hunks', 'snapshot'):
+            options = {'filter': self.whoosh_filter(target, filters)}
+            if sort == 'date':
+                options.update(sortedby='date', reverse=True)
+
+            hits, truncated = self.collect(searcher, query, wanted, deadline,
+                                           **options)
+            total = len(hits) if count and not truncated else None
+            if target == 'snapshot':
+                results = []
+                for hit in hits[offset:wanted]:
+                    result = dict(snapshot_result(hit), score=hit.score)
+                    snippet = self.snippet(hit, state.trigrams.read(hit['blob']))
+                    if snippet:
+                        result['snippet'] = snippet
+                    results.append(result)
+                return ResultPage(results, truncated, total)
+
+            return ResultPage([{
+                'repo': hit['repo'],
+                'path': hit['path'],
+                'hunk': hit['hunk'],
+                'commit_hash': hit['commit_hash'],
+                'author': hit['author'],
+                'date': hit['date'].replace(tzinfo=timezone.utc).isoformat(),
+                'score': hit.score
+            } for hit in hits[offset:wanted]], truncated, total)
+
+        # Exact path and commit matches rank above every content match
+        terms = query_string.split()
+        occurrences = []
+        scores = {}
+        row_hits = {}
+        blobs = None
+        truncated = False
+        for term in terms:
+            occurrences.extend(state.find_occurrences(term, filters))
+
+        if sort == 'date':
+            blobs = self.matching_blobs(query, searcher)
+            if len(blobs) <= LATEST_BLOBS_LOOKUP:
+                occurrences.extend(
+                    state.get_latest_occurrences(blobs, filters, wanted))
             else:
-                actual_repo_path = os.path.join(self.repos_dir, repo_path)
+                found = 0
+                for blob, row in state.iter_occurrences_by_date(filters):
+                    if blob in blobs:
+                        occurrences.append(row)
+                        found += 1
+                        if found >= wanted:
+                            break
+                    if expired(deadline):
+                        truncated = True
+                        break
 
-            result = subprocess.run(
-                ['git', 'show', f'{commit_hash}:{file_path}'],
-                cwd=actual_repo_path,
-                stdout=subprocess.PIPE,
-                stderr=subprocess.PIPE,
-                text=True
-            )
-            if result.returncode != 0:
-                return ""
+            occurrences = sorted(set(occurrences), reverse=True,
+                                 key=lambda row: parse_date(row[3]))
+        else:
+            window = wanted
+            seen = 0
+            while len(occurrences) < wanted:
+                hits, truncated = self.collect(searcher, query, window, deadline)
+                for hit in hits[seen:]:
+                    rows = state.get_occurrences(hit['blob'], filters)
+                    for row in rows:
+                        scores.setdefault(row, hit.score)
+                        row_hits.setdefault(row, hit)
+                    occurrences.extend(rows)
+                    if len(occurrences) >= wanted:
+                        break
 
-            return result.stdout
-        except Exception as e:
-            print(
-                f"Error getting content of {file_path} at commit {commit_hash} in {repo_path}: {e}")
-            return ""
+                if truncated or hits.scored_length() < window:
+                    break
+                seen = window
+                window *= 4
+
+        total = None
+        if count and not truncated:
+            if blobs is None:
+                blobs = self.matching_blobs(query, searcher)
+            total = state.count_occurrences(blobs, filters, terms)
+
+        occurrences = list(dict.fromkeys(occurrences))[offset:wanted]
+        results = []
+        snippets = {}
+        for row in occurrences:
+            result = dict(occurrence_result(row), score=scores.get(row))
+            hit = row_hits.get(row)
+            if hit is not None:
+                blob = hit['blob']
+                if blob not in snippets:
+                    snippets[blob] = self.snippet(hit, state.trigrams.read(blob))
+                if snippets[blob]:
+                    result['snippet'] = snippets[blob]
+            results.append(result)
 
-    def is_binary_file(self, repo_path, commit_hash, file_path):
-        """Check if a file is binary"""
+        return ResultPage(results, truncated, total)
+
+    def snippet(self, hit, text):
+        """Get the best fragments of a blob's text with the terms marked"""
+        if not text:
+            return None
+
+        hit.results.fragmenter = highlight.ContextFragmenter(
+            maxchars=SNIPPET_CHARS, surround=40)
+        hit.results.formatter = SnippetFormatter()
+        return ' '.join(hit.highlights('content', text=text, top=2).split())
+
+    def compile_pattern(self, pattern, literal=False, ignore_case=False):
+        """Compile a --regex or --literal search pattern"""
+        flags = re.MULTILINE | (re.IGNORECASE if ignore_case else 0)
         try:
-            actual_repo_path = repo_path
-            if repo_path == os.path.basename(self.repos_dir) and os.path.exists(os.path.join(self.repos_dir, '.git')):
-                actual_repo_path = self.repos_dir
-            else:
-                actual_repo_path = os.path.join(self.repos_dir, repo_path)
+            return re.compile(re.escape(pattern) if literal else pattern,
+                              flags)
+        except re.error as e:
+            raise ValueError(f"Invalid regular expression: {e}") from None
 
-            result = subprocess.run(
-                ['git', 'show', f'{commit_hash}:{file_path}'],
-                cwd=actual_repo_path,
-                stdout=subprocess.PIPE,
-                stderr=subprocess.PIPE
-            )
-            if result.returncode != 0:
-                return True
+    def find_pattern(self, target, pattern, searcher, state, limit=100,
+                     filters=None, sort='score', page=1, deadline=None,
+                     count=False):
+        """Find blobs matching a compiled pattern through the trigram index
+
+        Returns a ResultPage like find, counting means verifying every
+        candidate blob.
+        """
+        self.check_search(target, 'pattern', filters, sort, limit, page)
+        offset = (page - 1) * limit
+        wanted = offset + limit
+
+        candidates = state.trigrams.candidates(regex_requirements(pattern))
+        notice = NOTICE_FULL_SCAN if candidates is None else None
+
+        results = []
+        truncated = False
+        if target == 'history' and sort == 'date':
+            blobs = None
+            if candidates is not None:
+                blobs = state.trigrams.get_blobs(candidates)
+
+            verified = {}
+            for blob, row in state.iter_occurrences_by_date(filters):
+                if expired(deadline):
+                    truncated = True
+                    break
+                if blobs is not None and blob not in blobs:
+                    continue
+
+                if blob not in verified:
+                    text = state.trigrams.read(blob)
+                    verified[blob] = text and match_line(pattern, text)
+                if not verified[blob]:
+                    continue
+
+                result = occurrence_result(row)
+                result['match'] = verified[blob]
+                results.append(result)
+                if len(results) >= wanted:
+                    break
+        else:
+            for blob, text in state.trigrams.iter_contents(candidates):
+                if expired(deadline):
+                    truncated = True
+                    break
+
+                line = match_line(pattern, text)
+                if line is None:
+                    continue
+
+                if target == 'snapshot':
+                    rows = [snapshot_result(hit)
+                            for hit in searcher.documents(blob=blob)
+                            if not filters or not filters.repo
+                            or hit['repo'] == filters.repo]
+                else:
+                    rows = [occurrence_result(row)
+                            for row in state.get_occurrences(blob, filters)]
+
+                for row in rows:
+                    row['match'] = line
+                results.extend(rows)
+                if len(results) >= wanted:
+                    break
+
+        total = None
+        if count and not truncated:
+            total = self.count_pattern(target, pattern, candidates, searcher,
+                                       state, filters, deadline)
+            truncated = total is None
+
+        return ResultPage(results[offset:wanted], truncated, total, notice)
+
+    def count_pattern(self, target, pattern, candidates, searcher, state,
+                      filters=None, deadline=None):
+        """Count every match of a pattern, None if the deadline passes first"""
+        matched = set()
+        for blob, text in state.trigrams.iter_contents(candidates):
+            if expired(deadline):
+                return None
+            if pattern.search(text):
+                matched.add(blob)
+
+        if target == 'snapshot':
+            return sum(1 for blob in matched
+                       for hit in searcher.documents(blob=blob)
+                       if not filters or not filters.repo
+                       or hit['repo'] == filters.repo)
+
+        return state.count_occurrences(matched, filters)
 
+    def run_search(self, query_string, target='history', limit=100,
+                   mode='query', ignore_case=False, filters=None, sort='score',
+                   page=1, deadline=None, count=False):
+        """Search an index, or every shard of it, and return a ResultPage"""
+        if self.is_sharded():
+            return self.search_shards(query_string, target, limit, mode,
+                                      ignore_case, filters, sort, page,
+                                      deadline, count)
+
+        ix = self.get_index(target)
+        with ix.searcher() as searcher, IndexState(self.index_dir) as state:
+            if mode == 'query':
+                query = self.parse_query(target, query_string)
+                return self.find(target, query, query_string, searcher,
+                                 state, limit, filters, sort, page, deadline,
+                                 count)
+
+            pattern = self.compile_pattern(
+                query_string, mode == 'literal', ignore_case)
+            return self.find_pattern(target, pattern, searcher, state,
+                                     limit, filters, sort, page, deadline,
+                                     count)
+
+    def search_shards(self, query_string, target='history', limit=100,
+                      mode='query', ignore_case=False, filters=None,
+                      sort='score', page=1, deadline=None, count=False):
+        """Search the shards in parallel and merge their top results
+
+        A --repo filter only opens the shard of that repository. Every shard
+        returns its first page * limit results so the merged page is exact.
+        """
+        names = self.shard_names()
+        if filters and filters.repo:
+            names = [name for name in names if name == filters.repo]
+        if not names:
+            return ResultPage([], False, 0 if count else None)
+
+        shards = [self.get_shard(name) for name in names]
+        with ThreadPoolExecutor(max_workers=min(len(shards),
+                                                SEARCH_THREADS)) as pool:
+            futures = [pool.submit(shard.run_search, query_string, target,
+                                   page * limit, mode, ignore_case, filters,
+                                   sort, 1, deadline, count)
+                       for shard in shards]
+            return merge_pages([future.result() for future in futures],
+                               limit, sort, page)
+
+    def search(self, query_string, target='history', limit=100, mode='query',
+               ignore_case=False, filters=None, sort='score', page=1,
+               timeout_ms=None, count=False):
+        """Search an index for the given query string"""
+        deadline = None
+        if timeout_ms is not None:
+            deadline = time.monotonic() + timeout_ms / 1000
+
+        print_results(self.run_search(query_string, target, limit, mode,
+                                      ignore_case, filters, sort, page,
+                                      deadline, count),
+                      (page - 1) * limit)
+
+
+class ResultCache:
+    """LRU cache of result pages, pages cut short by a deadline are not kept"""
+
+    def __init__(self, size=1024):
+        self.size = size
+        self.pages = OrderedDict()
+
+    def get(self, key):
+        page = self.pages.get(key)
+        if page is not None:
+            self.pages.move_to_end(key)
+        return page
+
+    def put(self, key, page):
+        if page.truncated or self.size <= 0:
+            return
+
+        self.pages[key] = page
+        self.pages.move_to_end(key)
+        if len(self.pages) > self.size:
+            self.pages.popitem(last=False)
+
+
+class SearchService:
+    """Keeps searchers open between queries and caches recent results"""
+
+    def __init__(self, indexer, cache_size=1024):
+        self.indexer = indexer
+        # A sharded service calls search() from its thread pool, one request
+        # at a time
+        self.state = IndexState(indexer.index_dir, check_same_thread=False)
+        self.searchers = {}
+        self.parse_query = lru_cache(maxsize=cache_size)(indexer.parse_query)
+        self.compile_pattern = lru_cache(maxsize=cache_size)(
+            indexer.compile_pattern)
+        self.cache = ResultCache(cache_size)
+
+    def get_searcher(self, target):
+        """Get an open searcher, reopening it if the index has moved on"""
+        searcher = self.searchers.get(target)
+        if searcher is None:
+            searcher = self.indexer.get_index(target).searcher()
+        elif not searcher.up_to_date():
+            searcher = searcher.refresh()
+
+        self.searchers[target] = searcher
+        return searcher
+
+    def _find(self, target, query_string, limit, mode, ignore_case, filters,
+              sort, page, deadline, count):
+        searcher = self.searchers[target]
+        if mode == 'query':
+            query = self.parse_query(target, query_string)
+            return self.indexer.find(target, query, query_string, searcher,
+                                     self.state, limit, filters, sort, page,
+                                     deadline, count)
+
+        pattern = self.compile_pattern(
+            query_string, mode == 'literal', ignore_case)
+        return self.indexer.find_pattern(target, pattern, searcher,
+                                         self.state, limit, filters, sort,
+                                         page, deadline, count)
+
+    def search(self, query_string, target='history', limit=100, mode='query',
+               ignore_case=False, filters=None, sort='score', page=1,
+               deadline=None, count=False):
+        """Search with cached results keyed on the index generation"""
+        self.indexer.check_search(target, mode, filters, sort, limit, page)
+        searcher = self.get_searcher(target)
+        generation = searcher.ixreader.generation()
+        key = (target, generation, query_string, limit, mode, ignore_case,
+               filters, sort, page, count)
+        result_page = self.cache.get(key)
+        if result_page is None:
+            result_page = self._find(target, query_string, limit, mode,
+                                     ignore_case, filters, sort, page,
+                                     deadline, count)
+            self.cache.put(key, result_page)
+
+        return {'generation': generation, **result_page._asdict()}
+
+    def close(self):
+        for searcher in self.searchers.values():
+            searcher.close()
+        self.state.close()
+
+
+class ShardedSearchService:
+    """Fans searches out to a SearchService per shard and merges the results
+
+    Shards added, dropped or rebuilt while serving are picked up on the next
+    search.
+    """
+
+    def __init__(self, indexer, cache_size=1024):
+        self.indexer = indexer
+        self.cache_size = cache_size
+        self.services = {}
+        self.pool = ThreadPoolExecutor(max_workers=SEARCH_THREADS)
+
+    def get_services(self, repo=None):
+        """Get a service per current shard, reopening rebuilt shards"""
+        shards = {}
+        for name in self.indexer.shard_names():
             try:
-                result.stdout.decode('utf-8')
-                return False
-            except UnicodeDecodeError:
-                return True
-        except Exception:
-            return True
-
-    def index_repos(self):
-        """Index all text files in all commits of all repositories"""
-        repos = self.get_repo_list()
+                shards[name] = os.stat(os.path.join(
+                    self.indexer.shard_root, name, 'state.db')).st_ino
+            except FileNotFoundError:
+                continue
 
-        print(f"Found {len(repos)} repositories to index")
-        if not repos:
-            print(f"No Git repositories found in {self.repos_dir}")
-            print("Make sure you're providing a directory that contains Git repositories")
-            print("or a Git repository itself.")
+        # An open state.db keeps its inode, so a new one means a new shard
+        for name in list(self.services):
+            if self.services[name][0] != shards.get(name):
+                self.services.pop(name)[1].close()
+        for name, inode in shards.items():
+            if name not in self.services:
+                service = SearchService(self.indexer.get_shard(name),
+                                        self.cache_size)
+                self.services[name] = (inode, service)
+
+        return {name: service for name, (_, service) in self.services.items()
+                if repo is None or name == repo}
+
+    def search(self, query_string, target='history', limit=100, mode='query',
+               ignore_case=False, filters=None, sort='score', page=1,
+               deadline=None, count=False):
+        """Search every shard and merge the results into one page"""
+        self.indexer.check_search(target, mode, filters, sort, limit, page)
+        services = self.get_services(filters.repo if filters else None)
+        futures = {name: self.pool.submit(service.search, query_string, target,
+                                          page * limit, mode, ignore_case,
+                                          filters, sort, 1, deadline, count)
+                   for name, service in services.items()}
+        bodies = {name: future.result() for name, future in futures.items()}
+        merged = merge_pages([ResultPage(body['results'], body['truncated'],
+                                         body['total'], body['notice'])
+                              for body in bodies.values()],
+                             limit, sort, page)
+        return {
+            'generation': {name: body['generation']
+                           for name, body in bodies.items()},
+            **merged._asdict()
+        }
+
+    def close(self):
+        self.pool.shutdown()
+        for _, service in self.services.values():
+            service.close()
+
+
+class SearchRequestHandler(BaseHTTPRequestHandler):
+    """Answers GET /search?q=<query>&target=<target>&limit=<n> with JSON
+
+    mode=regex or mode=literal runs a trigram search, with i=1 to ignore case.
+    repo, author, since and until filter results and sort=date puts the
+    newest matches first. page selects later pages, timeout_ms stops the
+    search early and count=1 adds the total number of matches. notice
+    explains a search that had to scan every blob.
+    """
+
+    def do_GET(self):
+        url = urlparse(self.path)
+        params = parse_qs(url.query)
+        query_string = params.get('q', [''])[0]
+        target = params.get('target', ['history'])[0]
+        mode = params.get('mode', ['query'])[0]
+        ignore_case = params.get('i', ['0'])[0] == '1'
+
+        if url.path != '/search' or not query_string or target not in SEARCH_FIELDS:
+            self.send_json(400, {'error': 'expected /search?q=<query>'
+                                 f'&target={"|".join(SEARCH_FIELDS)}'})
             return
 
-        total_files = 0
+        try:
+            limit = int(params.get('limit', ['100'])[0])
+            since = params.get('since', [None])[0]
+            until = params.get('until', [None])[0]
+            filters = SearchFilters(
+                repo=params.get('repo', [None])[0],
+                author=params.get('author', [None])[0],
+                since=parse_date(since) if since else None,
+                until=parse_date(until) if until else None,
+                ref=params.get('ref', [None])[0])
+            sort = params.get('sort', ['score'])[0]
+            page = int(params.get('page', ['1'])[0])
+            timeout_ms = params.get('timeout_ms', [None])[0]
+            deadline = None
+            if timeout_ms:
+                deadline = time.monotonic() + int(timeout_ms) / 1000
+            count = params.get('count', ['0'])[0] == '1'
 
-        with self.ix.writer() as writer:
-            for repo in repos:
-                print(f"Indexing repository: {repo}")
+            body = self.server.service.search(query_string, target, limit,
+                                              mode, ignore_case, filters, sort,
+                                              page, deadline, count)
+        except ValueError as e:
+            self.send_json(400, {'error': str(e)})
+            return
+        except Exception as e:
+            self.send_json(500, {'error': str(e)})
+            return
 
-                commits = self.get_all_commits(repo)
-                print(f"  Found {len(commits)} commits")
+        self.send_json(200, body)
 
-                if not commits:
-                    print(f"  No commits found in repo {repo}, skipping...")
-                    continue
+    def send_json(self, status, body):
+        data = json.dumps(body).encode('utf-8')
+        self.send_response(status)
+        self.send_header('Content-Type', 'application/json')
+        self.send_header('Content-Length', str(len(data)))
+        self.end_headers()
+        self.wfile.write(data)
 
-                for i, commit_hash in enumerate(commits):
-                    if i % 50 == 0:
-                        print(
-                            f"  Processing commit {i+1}/{len(commits)}: {commit_hash}")
+    def address_string(self):
+        if isinstance(self.client_address, tuple):
+            return super().address_string()
 
-                    author, date, _ = self.get_commit_info(
-                        repo, commit_hash)
-                    if not author:
-                        continue
+        return 'unix'
 
-                    files = self.get_commit_files(repo, commit_hash)
-                    for file_path in files:
-                        if self.is_binary_file(repo, commit_hash, file_path):
-                            continue
 
-                        content = self.get_file_content_at_commit(
-                            repo, commit_hash, file_path)
-                        if not content:
-                            continue
+# socketserver only has Unix domain socket servers where the platform does
+if hasattr(socketserver, 'UnixStreamServer'):
+    class UnixHTTPServer(socketserver.UnixStreamServer):
+        def get_request(self):
+            request, _ = super().get_request()
+            return request, ''
 
-                        writer.add_document(
-                            path=file_path,
-                            repo=repo,
-                            content=content,
-                            commit_hash=commit_hash,
-                            commit_date=date,
-                            commit_author=author
-                        )
 
-                        total_files += 1
-                        if total_files % 100 == 0:
-                            print(f"  Indexed {total_files} files so far...")
+def serve(indexer, host='127.0.0.1', port=8765, socket_path=None,
+          cache_size=1024):
+    """Serve searches over HTTP until interrupted"""
+    if socket_path:
+        if os.path.exists(socket_path):
+            os.remove(socket_path)
+        server = UnixHTTPServer(socket_path, SearchRequestHandler)
+        print(f"Serving searches on unix socket {socket_path}")
+    else:
+        server = HTTPServer((host, port), SearchRequestHandler)
+        print(f"Serving searches on http://{host}:{port}/search?q=<query>")
+
+    if indexer.is_sharded():
+        server.service = ShardedSearchService(indexer, cache_size)
+    else:
+        server.service = SearchService(indexer, cache_size)
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        pass
+    finally:
+        server.server_close()
+        server.service.close()
+        if socket_path and os.path.exists(socket_path):
+            os.remove(socket_path)
 
-        print(f"Indexing complete. Total files indexed: {total_files}")
 
-    def search(self, query_string):
-        """Search the index for the given query string"""
-        with self.ix.searcher() as searcher:
-            query_parser = MultifieldParser(
-                ["content", "path", "commit_hash"], schema=self.ix.schema)
-            query = query_parser.parse(query_string)
+def match_line(pattern, text):
+    """Get 'line: text' of the first match of a pattern, None without one"""
+    match = pattern.search(text)
+    if match is None:
+        return None
 
-            results = searcher.search(query, limit=100)
+    start = text.rfind('\n', 0, match.start()) + 1
+    end = text.find('\n', match.start())
+    line = text[start:end if end != -1 else len(text)].strip()
+    return f"{text.count(chr(10), 0, start) + 1}: {line}"
 
-            if len(results) == 0:
-                print("No results found.")
-                return
 
-            print(f"Found {len(results)} results:")
+def occurrence_result(row):
+    """Turn an occurrences row into a result dict"""
+    repo, commit_hash, path, date, author = row
+    return {
+        'repo': repo,
+        'path': path,
+        'commit_hash': commit_hash,
+        'author': author,
+        'date': date
+    }
+
+
+def snapshot_result(hit):
+    """Turn a snapshot document into a result dict"""
+    return {
+        'repo': hit['repo'],
+        'path': hit['path'],
+        'ref': hit['ref'],
+        'blob': hit['blob']
+    }
+
+
+def merge_results(result_lists, limit=100, sort='score'):
+    """Merge the results of several shards into one list of the top limit
+
+    Results keep their order within a shard. With sort='score' exact matches,
+    which have a score of None, come first and results without a score at
+    all, like --regex matches, are interleaved by their rank in each shard.
+    """
+    ranked = []
+    for results in result_lists:
+        for rank, result in enumerate(results):
+            if sort == 'date':
+                key = parse_date(result['date']).timestamp()
+            elif 'score' not in result:
+                key = 0
+            elif result['score'] is None:
+                key = float('inf')
+            else:
+                key = result['score']
+            ranked.append((key, -rank, result))
+
+    ranked.sort(key=lambda item: item[:2], reverse=True)
+    return [result for _, _, result in ranked[:limit]]
+
+
+def merge_pages(pages, limit=100, sort='score', page=1):
+    """Merge the first page * limit results of several shards into one page"""
+    offset = (page - 1) * limit
+    results = merge_results([result_page.results for result_page in pages],
+                            offset + limit, sort)
+    totals = [result_page.total for result_page in pages]
+    return ResultPage(
+        results[offset:],
+        any(result_page.truncated for result_page in pages),
+        None if None in totals else sum(totals),
+        next((result_page.notice for result_page in pages
+              if result_page.notice), None))
+
+
+def print_results(result_page, offset=0):
+    """Print a ResultPage in the format of the search command"""
+    if result_page.notice:
+        print(result_page.notice)
+
+    results = result_page.results
+    total = ''
+    if result_page.total is not None:
+        total = f" of {result_page.total}"
+
+    if not results:
+        print("No results found." if not result_page.total else
+              f"No results on this page, {result_page.total} in total.")
+    else:
+        print(f"Showing results {offset + 1}-{offset + len(results)}{total}:")
+        print("-" * 80)
+
+        for i, result in enumerate(results, offset + 1):
+            print(f"{i}. Repository: {result['repo']}")
+            for key, label in RESULT_LABELS:
+                if key in result:
+                    print(f"   {label}: {result[key]}")
             print("-" * 80)
 
-            for i, hit in enumerate(results):
-                print(f"{i+1}. Repository: {hit['repo']}")
-                print(f"   File: {hit['path']}")
-                print(f"   Commit: {hit['commit_hash']}")
-                print(f"   Author: {hit['commit_author']}")
-                print(f"   Date: {hit['commit_date']}")
-                print("-" * 80)
+    if result_page.truncated:
+        print("Search stopped at the time limit, results may be incomplete.")
+
+
+def run_index_job(repos_dir, index_dir, job, max_blob_size, writer_limits,
+                  pack_reader=False):
+    """Index one job into its own index directory, runs in a worker process"""
+    indexer = GitRepoIndexer(repos_dir, job.job_dir, max_blob_size,
+                             writer_limits=writer_limits,
+                             pack_reader=pack_reader)
+
+    metrics = IndexMetrics()
+    with IndexState(job.job_dir, parent_dir=index_dir) as state:
+        with CommittingWriter(indexer.ix, state, writer_limits,
+                              metrics) as writer:
+            files, blobs, report = indexer.index_commits(
+                job.repo, job.revisions, writer, state, metrics)
+
+    indexer.ix.close()
+    return job, files, blobs, report, metrics
+
+
+def run_shard_job(repos_dir, shard_root, repo, max_blob_size, mode, ref,
+                  writer_limits, pack_reader=False, all_refs=False):
+    """Update the shard of one repository, runs in a worker process"""
+    indexer = GitRepoIndexer(repos_dir, os.path.join(shard_root, repo),
+                             max_blob_size, repos=[repo],
+                             writer_limits=writer_limits,
+                             pack_reader=pack_reader, all_refs=all_refs)
+    return repo, indexer.index(mode, ref=ref)
 
 
 def main():
@@ -273,23 +2876,207 @@ def main():
                         help='Directory containing Git repositories')
     parser.add_argument('--index-dir', default='.search_index',
                         help='Directory to store the search index')
+    parser.add_argument('--max-blob-size', type=int,
+                        default=DEFAULT_MAX_BLOB_SIZE,
+                        help='Skip blobs larger than this many bytes '
+                        f'(default {DEFAULT_MAX_BLOB_SIZE})')
 
     subparsers = parser.add_subparsers(dest='command', help='Commands')
 
-    subparsers.add_parser('index', help='Index repositories')
+    index_parser = subparsers.add_parser('index', help='Index repositories')
+    index_parser.add_argument('-j', '--jobs', type=int, default=1,
+                              help='Number of worker processes to index with')
+    index_mode = index_parser.add_mutually_exclusive_group()
+    index_mode.add_argument('--hunks', action='store_true',
+                            help='Index only the lines added and removed '
+                            'by each commit')
+    index_mode.add_argument('--snapshot', action='store_true',
+                            help='Index only the files in the tree of --ref')
+    index_parser.add_argument('--ref', default='HEAD',
+                              help='Ref to index in --snapshot mode')
+    index_parser.add_argument('--writer-mb', type=int, default=DEFAULT_WRITER_MB,
+                              help='Memory the index writer may buffer before '
+                              f'flushing to disk (default {DEFAULT_WRITER_MB})')
+    index_parser.add_argument('--commit-every', type=int,
+                              default=DEFAULT_COMMIT_DOCS, metavar='DOCS',
+                              help='Commit after this many new documents '
+                              f'(default {DEFAULT_COMMIT_DOCS})')
+    index_parser.add_argument('--commit-interval', type=int,
+                              default=DEFAULT_COMMIT_SECONDS, metavar='SECONDS',
+                              help='Commit at least this often '
+                              f'(default {DEFAULT_COMMIT_SECONDS})')
+    index_parser.add_argument('--all-refs', action='store_true',
+                              help='Index every branch, remote branch and tag '
+                              'instead of only HEAD, shared history once')
+    index_parser.add_argument('--pack-reader', action='store_true',
+                              help='Read blobs straight from packfiles instead '
+                              'of through git cat-file where possible')
+    index_parser.add_argument('--metrics', metavar='PATH',
+                              help='Write per-repo stage timings and '
+                              'throughput as JSON to PATH')
+    index_parser.add_argument('--sharded', action='store_true',
+                              help='Keep one index shard per repository, '
+                              'later runs stay sharded')
+    index_parser.add_argument('--repo', action='append', dest='repos',
+                              help='Only update the shard of this repository, '
+                              'adding it if needed (repeatable)')
+    index_parser.add_argument('--watch', action='store_true',
+                              help='Keep running and index new commits '
+                              'whenever refs change, -j bounds how many '
+                              'processes a batch of repos is indexed on')
+    index_parser.add_argument('--interval', type=float,
+                              default=DEFAULT_WATCH_INTERVAL, metavar='SECONDS',
+                              help='How often --watch polls refs '
+                              f'(default {DEFAULT_WATCH_INTERVAL:g})')
+    index_parser.add_argument('--debounce', type=float,
+                              default=DEFAULT_WATCH_DEBOUNCE, metavar='SECONDS',
+                              help='How long refs must be quiet before --watch '
+                              f'indexes a repo (default {DEFAULT_WATCH_DEBOUNCE:g})')
 
     search_parser = subparsers.add_parser(
         'search', help='Search indexed repositories')
     search_parser.add_argument('query', nargs='+', help='Search query terms')
+    search_mode = search_parser.add_mutually_exclusive_group()
+    search_mode.add_argument('--hunks', action='store_const', const='hunks',
+                             dest='target', default='history',
+                             help='Search the diff-hunk index')
+    search_mode.add_argument('--snapshot', action='store_const',
+                             const='snapshot', dest='target',
+                             help='Search the current-tree index')
+    pattern_mode = search_parser.add_mutually_exclusive_group()
+    pattern_mode.add_argument('--regex', action='store_const', const='regex',
+                              dest='mode', default='query',
+                              help='Treat the query as a regular expression')
+    pattern_mode.add_argument('--literal', action='store_const',
+                              const='literal', dest='mode',
+                              help='Treat the query as an exact substring')
+    search_parser.add_argument('-i', '--ignore-case', action='store_true',
+                               help='Ignore case in --regex and --literal')
+    search_parser.add_argument('--repo', help='Only show matches in this repo')
+    search_parser.add_argument('--author',
+                               help='Only show matches committed by this author')
+    search_parser.add_argument('--since', type=parse_date,
+                               help='Only show matches committed at or after '
+                               'this ISO 8601 date')
+    search_parser.add_argument('--until', type=parse_date,
+                               help='Only show matches committed at or before '
+                               'this ISO 8601 date')
+    search_parser.add_argument('--ref',
+                               help='Only show matches in commits contained '
+                               'in this branch or tag, needs index --all-refs')
+    search_parser.add_argument('--sort', choices=['score', 'date'],
+                               default='score',
+                               help='Order results by relevance or newest first')
+    search_parser.add_argument('--limit', type=int, default=100,
+                               help='Number of results per page')
+    search_parser.add_argument('--page', type=int, default=1,
+                               help='Page of results to show')
+    search_parser.add_argument('--timeout-ms', type=int,
+                               help='Stop searching after this many '
+                               'milliseconds and show what was found')
+    search_parser.add_argument('--count', action='store_true',
+                               help='Also count every match, which can be slow')
+
+    reindex_parser = subparsers.add_parser(
+        'reindex', help='Rebuild an index without re-reading git history')
+    reindex_parser.add_argument('--from-store', action='store_true',
+                                required=True,
+                                help='Read blob text from the blob store')
+    reindex_parser.add_argument('--snapshot', action='store_const',
+                                const='snapshot', dest='target',
+                                default='history',
+                                help='Rebuild the current-tree index instead')
+
+    shards_parser = subparsers.add_parser(
+        'shards', help='List, drop or rebuild per-repository shards')
+    shards_parser.add_argument('action', choices=['list', 'drop', 'rebuild'])
+    shards_parser.add_argument('repo', nargs='?',
+                               help='Repository whose shard to drop or rebuild')
+    shards_parser.add_argument('-j', '--jobs', type=int, default=1,
+                               help='Number of worker processes to rebuild with')
+
+    serve_parser = subparsers.add_parser(
+        'serve', help='Answer searches over HTTP with the index kept open')
+    serve_parser.add_argument('--host', default='127.0.0.1',
+                              help='Address to listen on')
+    serve_parser.add_argument('--port', type=int, default=8765,
+                              help='Port to listen on')
+    serve_parser.add_argument('--socket', dest='socket_path',
+                              help='Listen on this unix socket instead of TCP')
+    serve_parser.add_argument('--cache-size', type=int, default=1024,
+                              help='Number of queries and results to cache')
 
     args = parser.parse_args()
 
-    indexer = GitRepoIndexer(args.repos_dir, args.index_dir)
+    writer_limits = WriterLimits()
+    pack_reader = False
+    all_refs = False
+    if args.command == 'index':
+        writer_limits = WriterLimits(args.writer_mb, args.commit_every,
+                                     args.commit_interval)
+        pack_reader = args.pack_reader
+        all_refs = args.all_refs
+
+    indexer = GitRepoIndexer(args.repos_dir, args.index_dir,
+                             args.max_blob_size, writer_limits=writer_limits,
+                             pack_reader=pack_reader, all_refs=all_refs)
 
     if args.command == 'index':
-        indexer.index_repos()
+        mode = 'hunks' if args.hunks else 'snapshot' if args.snapshot else 'history'
+        if args.metrics and mode != 'history':
+            parser.error("--metrics is only recorded for the history index")
+        if args.all_refs and mode != 'history':
+            parser.error("--all-refs only applies to the history index")
+        if args.watch and (args.metrics or args.repos):
+            parser.error("--watch cannot be combined with --metrics or --repo")
+
+        if args.watch:
+            if args.sharded:
+                os.makedirs(indexer.shard_root, exist_ok=True)
+            indexer.watch(mode, args.jobs, args.ref, args.interval,
+                          args.debounce)
+        elif args.sharded or indexer.is_sharded():
+            metrics = indexer.index_shards(mode, args.jobs, args.ref, args.repos)
+        elif args.repos:
+            parser.error("--repo needs a sharded index, pass --sharded")
+        else:
+            metrics = indexer.index(mode, args.jobs, args.ref)
+
+        if args.metrics:
+            metrics.write(args.metrics)
+    elif args.command == 'reindex':
+        indexer.reindex_from_store(args.target)
+    elif args.command == 'shards':
+        if args.action == 'list':
+            indexer.list_shards()
+        elif not args.repo:
+            parser.error(f"shards {args.action} needs a repository name")
+        elif args.action == 'drop':
+            indexer.drop_shard(args.repo)
+        else:
+            indexer.rebuild_shard(args.repo, jobs=args.jobs)
     elif args.command == 'search':
-        indexer.search(' '.join(args.query))
+        filters = SearchFilters(args.repo, args.author, args.since, args.until,
+                                args.ref)
+        try:
+            indexer.check_search(args.target, args.mode, filters, args.sort,
+                                 args.limit, args.page)
+            if args.mode != 'query':
+                indexer.compile_pattern(' '.join(args.query),
+                                        args.mode == 'literal',
+                                        args.ignore_case)
+        except ValueError as e:
+            parser.error(str(e))
+
+        indexer.search(' '.join(args.query), args.target, args.limit,
+                       args.mode, args.ignore_case, filters, args.sort,
+                       args.page, args.timeout_ms, args.count)
+    elif args.command == 'serve':
+        if args.socket_path and not hasattr(socketserver, 'UnixStreamServer'):
+            parser.error("--socket needs Unix domain sockets, which this "
+                         "platform does not have")
+        serve(indexer, args.host, args.port, args.socket_path,
+              args.cache_size)
     else:
         parser.print_help()
 
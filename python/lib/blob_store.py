@@ -0,0 +1,109 @@
+import mmap
+import os
+import sqlite3
+import zlib
+
+PACK_SIZE = 256 * 1024 ** 2
+
+
+class BlobStore:
+    """Content-addressed store of blob text, zlib compressed into pack files
+
+    Records are only ever appended to the newest pack, packs are read back
+    through mmap. store.db maps each blob id to its pack, offset and length
+    and lives next to the packs, so the store survives a rebuild of
+    state.db. Binary blobs are never stored.
+    """
+
+    def __init__(self, store_dir, pack_size=PACK_SIZE,
+                 check_same_thread=True):
+        os.makedirs(store_dir, exist_ok=True)
+        self.store_dir = store_dir
+        self.pack_size = pack_size
+        self.maps = {}
+        self.pack_file = None
+
+        self.conn = sqlite3.connect(os.path.join(store_dir, 'store.db'),
+                                    check_same_thread=check_same_thread)
+        self.conn.execute('''
+            CREATE TABLE IF NOT EXISTS stored_blobs (
+                blob VARCHAR(64) PRIMARY KEY,
+                pack INTEGER,
+                offset INTEGER,
+                length INTEGER
+            )
+        ''')
+        cursor = self.conn.execute('SELECT MAX(pack) FROM stored_blobs')
+        self.pack = cursor.fetchone()[0] or 0
+
+    def pack_path(self, pack):
+        return os.path.join(self.store_dir, f'pack-{pack:05d}.zpack')
+
+    def has(self, blob):
+        cursor = self.conn.execute(
+            'SELECT 1 FROM stored_blobs WHERE blob = ?', (blob,))
+        return cursor.fetchone() is not None
+
+    def put(self, blob, text):
+        """Store the text of a blob unless it is already stored"""
+        if not self.has(blob):
+            self.put_raw(blob, zlib.compress(text.encode('utf-8')))
+
+    def put_raw(self, blob, data):
+        """Append already compressed text to the newest pack"""
+        if self.pack_file is None:
+            self.pack_file = open(self.pack_path(self.pack), 'ab')
+        if self.pack_file.tell() >= self.pack_size:
+            self.pack_file.close()
+            self.pack += 1
+            self.pack_file = open(self.pack_path(self.pack), 'ab')
+
+        offset = self.pack_file.tell()
+        self.pack_file.write(data)
+        self.conn.execute(
+            'INSERT INTO stored_blobs (blob, pack, offset, length) '
+            'VALUES (?, ?, ?, ?)', (blob, self.pack, offset, len(data)))
+
+    def get_raw(self, blob):
+        """Get the compressed text of a blob, None if it is not stored"""
+        cursor = self.conn.execute(
+            'SELECT pack, offset, length FROM stored_blobs WHERE blob = ?',
+            (blob,))
+        row = cursor.fetchone()
+        if row is None:
+            return None
+
+        pack, offset, length = row
+        if self.pack_file is not None and pack == self.pack:
+            self.pack_file.flush()
+
+        mapped = self.maps.get(pack)
+        if mapped is None or len(mapped) < offset + length:
+            if mapped is not None:
+                mapped.close()
+            with open(self.pack_path(pack), 'rb') as f:
+                mapped = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+            self.maps[pack] = mapped
+
+        return mapped[offset:offset + length]
+
+    def get(self, blob):
+        """Get the text of a blob, None if it is not stored"""
+        data = self.get_raw(blob)
+        return None if data is None else zlib.decompress(data).decode('utf-8')
+
+    def commit(self):
+        """Make appended records durable, then commit their locations"""
+        if self.pack_file is not None:
+            self.pack_file.flush()
+            os.fsync(self.pack_file.fileno())
+        self.conn.commit()
+
+    def close(self):
+        for mapped in self.maps.values():
+            mapped.close()
+        self.maps.clear()
+        if self.pack_file is not None:
+            self.pack_file.close()
+            self.pack_file = None
+        self.conn.close()
@@ -0,0 +1,82 @@
+import sqlite3
+
+DATABASE = "directory_tree.db"
+CACHE_SIZE_KB = 64 * 1024
+
+# Parent folders and relative directory paths are stored once and files refer
+# to them by id. A directory path is shared by every parent it exists in, so
+# the same file in two parents has the same (directory_id, name).
+SCHEMA = '''
+    CREATE TABLE IF NOT EXISTS parents (
+        id INTEGER PRIMARY KEY,
+        name VARCHAR(255) UNIQUE
+    );
+    CREATE TABLE IF NOT EXISTS directories (
+        id INTEGER PRIMARY KEY,
+        path VARCHAR(65535) UNIQUE
+    );
+    CREATE TABLE IF NOT EXISTS directory_mtimes (
+        parent_id INTEGER,
+        directory_id INTEGER,
+        mtime_ns INTEGER,
+        PRIMARY KEY (parent_id, directory_id)
+    ) WITHOUT ROWID;
+    CREATE TABLE IF NOT EXISTS files (
+        parent_id INTEGER,
+        directory_id INTEGER,
+        name VARCHAR(255),
+        size INTEGER,
+        mtime_ns INTEGER,
+        inode INTEGER,
+        PRIMARY KEY (parent_id, directory_id, name)
+    ) WITHOUT ROWID;
+    CREATE TABLE IF NOT EXISTS file_hashes (
+        parent_id INTEGER,
+        directory_id INTEGER,
+        name VARCHAR(255),
+        size INTEGER,
+        mtime_ns INTEGER,
+        inode INTEGER,
+        sample_hash VARCHAR(128),
+        full_hash VARCHAR(128),
+        PRIMARY KEY (parent_id, directory_id, name)
+    ) WITHOUT ROWID;
+'''
+
+# Secondary indexes of a WITHOUT ROWID table hold its primary key too, so
+# both cover the duplicate queries of cleanup.py without touching the table
+FILE_INDEXES = {
+    'files_by_path': 'files (directory_id, name, mtime_ns)',
+    'files_by_size': 'files (size)'
+}
+
+
+def create_file_indexes(conn):
+    for name, columns in FILE_INDEXES.items():
+        conn.execute(f'CREATE INDEX IF NOT EXISTS {name} ON {columns}')
+
+
+def drop_file_indexes(conn):
+    for name in FILE_INDEXES:
+        conn.execute(f'DROP INDEX IF EXISTS {name}')
+
+
+def connect(database=DATABASE):
+    conn = sqlite3.connect(database)
+    conn.execute('PRAGMA journal_mode = WAL')
+    conn.execute('PRAGMA synchronous = NORMAL')
+    conn.execute(f'PRAGMA cache_size = {-CACHE_SIZE_KB}')
+
+    columns = [row[1] for row in conn.execute('PRAGMA table_info(files)')]
+    if columns and 'directory_id' not in columns:
+        print(f"{database} was built with an older layout, rebuilding it")
+        conn.executescript('''
+            DROP TABLE files;
+            DROP TABLE IF EXISTS directories;
+            DROP TABLE IF EXISTS file_hashes;
+        ''')
+
+    conn.executescript(SCHEMA)
+    create_file_indexes(conn)
+    conn.commit()
+    return conn
@@ -0,0 +1,492 @@
+import mmap
+import os
+import re
+import struct
+import subprocess
+import threading
+import zlib
+from collections import OrderedDict
+
+DELTA_CACHE_SIZE = 32 * 1024 ** 2
+PACK_OBJECT_TYPES = {1: 'commit', 2: 'tree', 3: 'blob', 4: 'tag'}
+PACK_OFS_DELTA = 6
+PACK_REF_DELTA = 7
+OBJECT_ID = re.compile(r'[0-9a-f]{40}')
+
+
+class GitBlobReader:
+    """Reads objects through long-lived `git cat-file` processes"""
+
+    def __init__(self, repo_path):
+        self.repo_path = repo_path
+        self._batch = None
+        self._batch_check = None
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *_):
+        self.close()
+
+    def _start(self, mode):
+        return subprocess.Popen(
+            ['git', 'cat-file', mode],
+            cwd=self.repo_path,
+            stdin=subprocess.PIPE,
+            stdout=subprocess.PIPE,
+            stderr=subprocess.DEVNULL
+        )
+
+    def _write(self, proc, object_names):
+        for object_name in object_names:
+            proc.stdin.write(object_name.encode('utf-8') + b'\n')
+        proc.stdin.flush()
+
+    def _read_header(self, proc):
+        header = proc.stdout.readline().decode('utf-8').rstrip('\n')
+        parts = header.split(' ')
+        if len(parts) != 3:
+            return None
+
+        sha, object_type, size = parts
+        return sha, object_type, int(size)
+
+    def _read_blob(self, proc):
+        info = self._read_header(proc)
+        if info is None:
+            return None
+
+        _, object_type, size = info
+        data = proc.stdout.read(size)
+        proc.stdout.read(1)
+
+        if object_type != 'blob':
+            return None
+
+        return data
+
+    def _get_batch(self):
+        if self._batch is None:
+            self._batch = self._start('--batch')
+
+        return self._batch
+
+    def _get_batch_check(self):
+        if self._batch_check is None:
+            self._batch_check = self._start('--batch-check')
+
+        return self._batch_check
+
+    def _pipeline(self, proc, object_names, read_response):
+        object_names = [n for n in object_names if '\n' not in n]
+
+        requests = threading.Thread(
+            target=self._write, args=(proc, object_names))
+        requests.start()
+
+        pending = len(object_names)
+        try:
+            for object_name in object_names:
+                response = read_response(proc)
+                pending -= 1
+                yield object_name, response
+        finally:
+            for _ in range(pending):
+                read_response(proc)
+            requests.join()
+
+    def read_many(self, object_names):
+        """Yield (name, bytes) for many blobs, writing requests ahead of reads"""
+        return self._pipeline(self._get_batch(), object_names, self._read_blob)
+
+    def info_many(self, object_names):
+        """Yield (name, (sha, type, size)) for many objects without content"""
+        return self._pipeline(self._get_batch_check(), object_names,
+                              self._read_header)
+
+    def close(self):
+        for proc in (self._batch, self._batch_check):
+            if proc is None:
+                continue
+
+            proc.stdin.close()
+            proc.wait()
+            proc.stdout.close()
+
+        self._batch = None
+        self._batch_check = None
+
+
+def delta_sizes(delta):
+    """Get (base size, result size, header length) of a git pack delta"""
+    sizes = []
+    pos = 0
+    for _ in range(2):
+        size = shift = 0
+        while True:
+            byte = delta[pos]
+            pos += 1
+            size |= (byte & 0x7f) << shift
+            shift += 7
+            if not byte & 0x80:
+                break
+        sizes.append(size)
+
+    return sizes[0], sizes[1], pos
+
+
+def apply_delta(base, delta):
+    """Rebuild an object from its delta base and a git pack delta"""
+    base_size, result_size, pos = delta_sizes(delta)
+    if base_size != len(base):
+        raise ValueError("delta does not apply to its base")
+
+    source = memoryview(base)
+    result = bytearray()
+    while pos < len(delta):
+        opcode = delta[pos]
+        pos += 1
+        if opcode & 0x80:
+            offset = size = 0
+            for i in range(4):
+                if opcode & (1 << i):
+                    offset |= delta[pos] << (8 * i)
+                    pos += 1
+            for i in range(3):
+                if opcode & (0x10 << i):
+                    size |= delta[pos] << (8 * i)
+                    pos += 1
+            result += source[offset:offset + (size or 0x10000)]
+        elif opcode:
+            result += delta[pos:pos + opcode]
+            pos += opcode
+        else:
+            raise ValueError("invalid delta opcode")
+
+    if len(result) != result_size:
+        raise ValueError("delta produced the wrong size")
+
+    return bytes(result)
+
+
+class PackFile:
+    """A memory-mapped version 2 pack index and its packfile"""
+
+    def __init__(self, idx_path):
+        self.path = idx_path[:-len('.idx')] + '.pack'
+        with open(idx_path, 'rb') as f:
+            self.idx = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+        try:
+            with open(self.path, 'rb') as f:
+                self.pack = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+        except (OSError, ValueError):
+            self.idx.close()
+            raise
+
+        if self.idx[:8] != b'\xfftOc\x00\x00\x00\x02' or self.pack[:4] != b'PACK':
+            self.close()
+            raise ValueError(f"unsupported pack format: {self.path}")
+
+        self.fanout = struct.unpack_from('>256I', self.idx, 8)
+        self.count = self.fanout[255]
+        self.offsets_at = 8 + 1024 + self.count * 24
+        self.large_offsets_at = self.offsets_at + self.count * 4
+
+    def find(self, sha):
+        """Get the pack offset of a binary object id, None if not in this pack"""
+        lo = self.fanout[sha[0] - 1] if sha[0] else 0
+        hi = self.fanout[sha[0]]
+        while lo < hi:
+            mid = (lo + hi) // 2
+            at = 8 + 1024 + mid * 20
+            name = self.idx[at:at + 20]
+            if name < sha:
+                lo = mid + 1
+            elif name > sha:
+                hi = mid
+            else:
+                offset, = struct.unpack_from('>I', self.idx,
+                                             self.offsets_at + mid * 4)
+                if offset & 0x80000000:
+                    offset, = struct.unpack_from(
+                        '>Q', self.idx,
+                        self.large_offsets_at + (offset & 0x7fffffff) * 8)
+                return offset
+
+        return None
+
+    def entry(self, offset):
+        """Parse the entry header at offset
+
+        Returns (type, size, data offset, base) where base is the offset of
+        an offset delta's base or the binary id of a ref delta's base.
+        """
+        start = offset
+        byte = self.pack[offset]
+        offset += 1
+        object_type = (byte >> 4) & 7
+        size = byte & 0x0f
+        shift = 4
+        while byte & 0x80:
+            byte = self.pack[offset]
+            offset += 1
+            size |= (byte & 0x7f) << shift
+            shift += 7
+
+        base = None
+        if object_type == PACK_OFS_DELTA:
+            byte = self.pack[offset]
+            offset += 1
+            distance = byte & 0x7f
+            while byte & 0x80:
+                byte = self.pack[offset]
+                offset += 1
+                distance = ((distance + 1) << 7) | (byte & 0x7f)
+            base = start - distance
+            if base < 0:
+                raise ValueError(f"offset delta before the start of {self.path}")
+        elif object_type == PACK_REF_DELTA:
+            base = self.pack[offset:offset + 20]
+            offset += 20
+
+        return object_type, size, offset, base
+
+    def inflate(self, offset, size, max_length=0):
+        """Decompress the zlib stream at offset, size is the expected length
+
+        With max_length only that many bytes are decompressed.
+        """
+        stream = zlib.decompressobj()
+        chunks = []
+        length = 0
+        step = size + (size >> 9) + 64
+        while not stream.eof:
+            chunk = self.pack[offset:offset + step]
+            if not chunk:
+                raise ValueError(f"truncated object in {self.path}")
+
+            data = stream.decompress(chunk, max_length - length
+                                     if max_length else 0)
+            chunks.append(data)
+            length += len(data)
+            if max_length and length >= max_length:
+                return b''.join(chunks)
+            offset += step
+
+        data = b''.join(chunks)
+        if not max_length and len(data) != size:
+            raise ValueError(f"object in {self.path} has the wrong size")
+
+        return data
+
+    def close(self):
+        self.idx.close()
+        self.pack.close()
+
+
+class PackBlobReader(GitBlobReader):
+    """Reads objects straight from memory-mapped packfiles and loose objects
+
+    Delta bases are kept in an LRU cache of cache_size bytes. Anything it
+    cannot read itself, like names that are not full SHA-1 object ids,
+    objects added after the packs were opened or formats it does not know,
+    goes through `git cat-file` instead.
+    """
+
+    def __init__(self, repo_path, cache_size=DELTA_CACHE_SIZE):
+        super().__init__(repo_path)
+        self.cache_size = cache_size
+        self.cache = OrderedDict()
+        self.cached_bytes = 0
+        self.objects_dirs = []
+        self._packs = None
+
+        result = subprocess.run(
+            ['git', 'rev-parse', '--git-path', 'objects',
+             '--show-object-format'],
+            cwd=repo_path, capture_output=True, text=True)
+        lines = result.stdout.splitlines()
+        if result.returncode != 0 or lines[1:] != ['sha1']:
+            return
+
+        objects_dir = os.path.join(repo_path, lines[0])
+        self.objects_dirs.append(objects_dir)
+        try:
+            with open(os.path.join(objects_dir, 'info', 'alternates')) as f:
+                self.objects_dirs.extend(
+                    os.path.join(objects_dir, line.strip()) for line in f
+                    if line.strip() and not line.startswith('#'))
+        except FileNotFoundError:
+            pass
+
+    @property
+    def packs(self):
+        """The packs of the repository and its alternates, opened on first use"""
+        if self._packs is None:
+            self._packs = []
+            for objects_dir in self.objects_dirs:
+                pack_dir = os.path.join(objects_dir, 'pack')
+                if not os.path.isdir(pack_dir):
+                    continue
+
+                for filename in sorted(os.listdir(pack_dir)):
+                    if not filename.endswith('.idx'):
+                        continue
+                    try:
+                        self._packs.append(
+                            PackFile(os.path.join(pack_dir, filename)))
+                    except (OSError, ValueError):
+                        continue
+
+        return self._packs
+
+    def find(self, sha):
+        """Get (pack, offset) of a binary object id"""
+        for pack in self.packs:
+            offset = pack.find(sha)
+            if offset is not None:
+                return pack, offset
+
+        return None
+
+    def cache_put(self, key, value):
+        if key in self.cache:
+            self.cache.move_to_end(key)
+            return
+
+        self.cache[key] = value
+        self.cached_bytes += len(value[1])
+        while self.cached_bytes > self.cache_size and self.cache:
+            _, (_, data) = self.cache.popitem(last=False)
+            self.cached_bytes -= len(data)
+
+    def unpack(self, pack, offset):
+        """Get (type, data) of the entry at offset, resolving delta chains"""
+        chain = []
+        while True:
+            cached = self.cache.get((pack.path, offset))
+            if cached is not None:
+                self.cache.move_to_end((pack.path, offset))
+                object_type, data = cached
+                break
+
+            object_type, size, data_offset, base = pack.entry(offset)
+            if object_type in PACK_OBJECT_TYPES:
+                data = pack.inflate(data_offset, size)
+                break
+
+            chain.append((pack, offset, data_offset, size))
+            if object_type == PACK_OFS_DELTA:
+                offset = base
+            elif object_type == PACK_REF_DELTA:
+                location = self.find(base)
+                if location is None:
+                    raise KeyError(base.hex())
+                pack, offset = location
+            else:
+                raise ValueError(f"unknown pack entry type {object_type}")
+
+        key = (pack.path, offset)
+        for delta_pack, delta_offset, data_offset, size in reversed(chain):
+            self.cache_put(key, (object_type, data))
+            data = apply_delta(data, delta_pack.inflate(data_offset, size))
+            key = (delta_pack.path, delta_offset)
+
+        return PACK_OBJECT_TYPES[object_type], data
+
+    def unpack_info(self, pack, offset):
+        """Get (type, size) of the entry at offset without inflating it whole"""
+        object_type, size, data_offset, _ = pack.entry(offset)
+        if object_type not in PACK_OBJECT_TYPES:
+            _, size, _ = delta_sizes(pack.inflate(data_offset, size, 20))
+
+        object_type = None
+        while object_type is None:
+            cached = self.cache.get((pack.path, offset))
+            if cached is not None:
+                object_type = cached[0]
+                break
+
+            entry_type, _, _, base = pack.entry(offset)
+            if entry_type in PACK_OBJECT_TYPES:
+                object_type = entry_type
+            elif entry_type == PACK_OFS_DELTA:
+                offset = base
+            elif entry_type == PACK_REF_DELTA:
+                location = self.find(base)
+                if location is None:
+                    raise KeyError(base.hex())
+                pack, offset = location
+            else:
+                raise ValueError(f"unknown pack entry type {entry_type}")
+
+        return PACK_OBJECT_TYPES[object_type], size
+
+    def loose_path(self, object_name):
+        for objects_dir in self.objects_dirs:
+            path = os.path.join(objects_dir, object_name[:2], object_name[2:])
+            if os.path.exists(path):
+                return path
+
+        return None
+
+    def lookup(self, object_name, content=True):
+        """Get (type, data or size) of an object, None to ask git instead"""
+        if not OBJECT_ID.fullmatch(object_name) or not self.objects_dirs:
+            return None
+
+        try:
+            location = self.find(bytes.fromhex(object_name))
+            if location is not None:
+                if content:
+                    return self.unpack(*location)
+                return self.unpack_info(*location)
+
+            path = self.loose_path(object_name)
+            if path is None:
+                return None
+            with open(path, 'rb') as f:
+                raw = f.read()
+            data = (zlib.decompress(raw) if content
+                    else zlib.decompressobj().decompress(raw, 64))
+            header, _, data = data.partition(b'\0')
+            object_type, size = header.decode('ascii').split(' ')
+            return object_type, data if content else int(size)
+        except (KeyError, ValueError, IndexError, OSError, zlib.error):
+            return None
+
+    def lookup_many(self, object_names, content, fallback, result):
+        """Yield (name, result(name, type, data or size)) from the packs
+
+        The objects the packs do not have are left to fallback, which is
+        the matching `git cat-file` method.
+        """
+        missing = []
+        for object_name in object_names:
+            found = self.lookup(object_name, content)
+            if found is None:
+                missing.append(object_name)
+            else:
+                yield object_name, result(object_name, *found)
+
+        if missing:
+            yield from fallback(missing)
+
+    def read_many(self, object_names):
+        return self.lookup_many(
+            object_names, True, super().read_many,
+            lambda _, object_type, data: data if object_type == 'blob' else None)
+
+    def info_many(self, object_names):
+        return self.lookup_many(
+            object_names, False, super().info_many,
+            lambda object_name, object_type, size: (object_name, object_type,
+                                                    size))
+
+    def close(self):
+        for pack in self._packs or []:
+            pack.close()
+        self._packs = None
+        self.cache.clear()
+        self.cached_bytes = 0
+        super().close()
@@ -0,0 +1,196 @@
+from array import array
+from collections import defaultdict
+
+try:
+    from re import _constants as sre_constants, _parser as sre_parse
+except ImportError:
+    import sre_constants
+    import sre_parse
+
+
+def text_trigrams(text):
+    """Get the distinct case-folded trigrams of a text"""
+    text = text.lower()
+    return {text[i:i + 3] for i in range(len(text) - 2)}
+
+
+def regex_requirements(pattern):
+    """Work out which literals any match of a compiled regex must contain
+
+    Returns a literal string, an ('and', parts) or ('or', parts) tuple of
+    requirements, or None when the regex can match without any trigram.
+    """
+    def walk(items):
+        parts = []
+        run = []
+
+        def flush():
+            if len(run) >= 3:
+                parts.append(''.join(run))
+            run.clear()
+
+        for op, av in items:
+            if op is sre_constants.LITERAL:
+                run.append(chr(av))
+                continue
+
+            flush()
+            if op is sre_constants.SUBPATTERN:
+                parts.append(walk(av[-1]))
+            elif op in (sre_constants.MAX_REPEAT, sre_constants.MIN_REPEAT):
+                if av[0] >= 1:
+                    parts.append(walk(av[2]))
+            elif op is sre_constants.BRANCH:
+                branches = [walk(branch) for branch in av[1]]
+                if all(branch is not None for branch in branches):
+                    parts.append(('or', branches))
+        flush()
+
+        parts = [part for part in parts if part is not None]
+        if not parts:
+            return None
+
+        return parts[0] if len(parts) == 1 else ('and', parts)
+
+    return walk(sre_parse.parse(pattern.pattern, pattern.flags))
+
+
+class TrigramIndex:
+    """Trigram postings over blob content for substring and regex search
+
+    Each flushed batch writes one row per trigram holding the ids of the
+    blobs that contain it, rows are unioned at query time so adding blobs
+    never rewrites existing postings. The text used to verify candidates
+    lives in the blob store, binary blobs are recorded without any.
+    """
+
+    def __init__(self, conn, store, batch_size=2000):
+        self.conn = conn
+        self.store = store
+        self.batch_size = batch_size
+        self.pending = defaultdict(list)
+        self.pending_blobs = 0
+
+        self.conn.executescript('''
+            CREATE TABLE IF NOT EXISTS trigram_blobs (
+                id INTEGER PRIMARY KEY,
+                blob VARCHAR(64) UNIQUE
+            );
+            CREATE TABLE IF NOT EXISTS trigrams (
+                trigram VARCHAR(3),
+                ids BLOB
+            );
+            CREATE INDEX IF NOT EXISTS trigrams_trigram
+                ON trigrams (trigram);
+        ''')
+
+    def has(self, blob):
+        cursor = self.conn.execute(
+            'SELECT 1 FROM trigram_blobs WHERE blob = ?', (blob,))
+        return cursor.fetchone() is not None
+
+    def add(self, blob, content):
+        """Add the text of a blob, content is None for binary blobs"""
+        if self.has(blob):
+            return
+
+        cursor = self.conn.execute(
+            'INSERT INTO trigram_blobs (blob) VALUES (?)', (blob,))
+        if content is None:
+            return
+
+        self.store.put(blob, content)
+
+        for trigram in text_trigrams(content):
+            self.pending[trigram].append(cursor.lastrowid)
+
+        self.pending_blobs += 1
+        if self.pending_blobs >= self.batch_size:
+            self.flush()
+
+    def flush(self):
+        self.conn.executemany(
+            'INSERT INTO trigrams (trigram, ids) VALUES (?, ?)',
+            ((trigram, array('I', ids).tobytes())
+             for trigram, ids in self.pending.items()))
+        self.pending.clear()
+        self.pending_blobs = 0
+
+    def lookup(self, trigram):
+        """Get the ids of the blobs containing a trigram"""
+        ids = set()
+        cursor = self.conn.execute(
+            'SELECT ids FROM trigrams WHERE trigram = ?', (trigram,))
+        for data, in cursor:
+            ids.update(array('I', data))
+
+        return ids
+
+    def candidates(self, requirement):
+        """Get the ids of blobs that can satisfy a requirement, None for all"""
+        if requirement is None:
+            return None
+
+        if isinstance(requirement, str):
+            result = None
+            for trigram in sorted(text_trigrams(requirement)):
+                ids = self.lookup(trigram)
+                result = ids if result is None else result & ids
+                if not result:
+                    return set()
+            return result
+
+        kind, parts = requirement
+        sets = [self.candidates(part) for part in parts]
+        if kind == 'or':
+            return None if None in sets else set().union(*sets)
+
+        sets = [ids for ids in sets if ids is not None]
+        return set.intersection(*sets) if sets else None
+
+    def iter_contents(self, ids=None):
+        """Yield (blob, text) of candidate blobs, or of all text blobs"""
+        if ids is None:
+            cursor = self.conn.execute(
+                'SELECT blob FROM trigram_blobs ORDER BY id')
+            for blob, in cursor:
+                text = self.store.get(blob)
+                if text is not None:
+                    yield blob, text
+            return
+
+        ids = sorted(ids)
+        for start in range(0, len(ids), 500):
+            chunk = ids[start:start + 500]
+            cursor = self.conn.execute(
+                'SELECT blob FROM trigram_blobs WHERE id IN '
+                f'({",".join("?" * len(chunk))}) ORDER BY id', chunk)
+            for blob, in cursor:
+                text = self.store.get(blob)
+                if text is not None:
+                    yield blob, text
+
+    def read(self, blob):
+        """Get the stored text of a blob, None if binary or unknown"""
+        return self.store.get(blob)
+
+    def merge_from(self, conn, store):
+        """Copy the blobs, text and postings of another trigram index"""
+        remap = {}
+        cursor = conn.execute('SELECT id, blob FROM trigram_blobs')
+        for blob_id, blob in cursor:
+            if self.has(blob):
+                continue
+
+            inserted = self.conn.execute(
+                'INSERT INTO trigram_blobs (blob) VALUES (?)', (blob,))
+            remap[blob_id] = inserted.lastrowid
+            data = store.get_raw(blob)
+            if data is not None and not self.store.has(blob):
+                self.store.put_raw(blob, data)
+
+        self.conn.executemany(
+            'INSERT INTO trigrams (trigram, ids) VALUES (?, ?)',
+            ((trigram, array('I', (remap[i] for i in array('I', ids)
+                                   if i in remap)).tobytes())
+             for trigram, ids in conn.execute('SELECT trigram, ids FROM trigrams')))
@@ -0,0 +1,191 @@
+import os
+import sys
+
+import pytest
+
+import cleanup
+import crawler
+from lib.directory_tree import connect
+
+MTIME = 1_600_000_000
+
+
+@pytest.fixture
+def tree(tmp_path, monkeypatch):
+    """A directory to crawl, with directory_tree.db next to it"""
+    monkeypatch.chdir(tmp_path)
+    root = tmp_path / 'tree'
+    root.mkdir()
+    return root
+
+
+def write(path, text, mtime=MTIME):
+    path.parent.mkdir(parents=True, exist_ok=True)
+    path.write_text(text)
+    os.utime(path, ns=(mtime * 10**9, mtime * 10**9))
+
+
+def run(monkeypatch, module, *args):
+    monkeypatch.setattr(sys, 'argv', [module.__name__, *map(str, args)])
+    module.main()
+
+
+def test_file_edited_in_place_is_not_deleted(tree, monkeypatch, capsys):
+    write(tree / 'A' / 'sub' / 'x.txt', 'same')
+    write(tree / 'B' / 'sub' / 'x.txt', 'same')
+    run(monkeypatch, crawler, tree)
+
+    # Editing a file does not change the modified time of its directory
+    sub = tree / 'A' / 'sub'
+    directory_mtime = sub.stat().st_mtime_ns
+    write(sub / 'x.txt', 'edited', MTIME + 60)
+    os.utime(sub, ns=(directory_mtime, directory_mtime))
+
+    run(monkeypatch, cleanup, tree)
+    assert (sub / 'x.txt').read_text() == 'edited'
+
+    # The incremental crawl stats the files of unchanged directories
+    run(monkeypatch, crawler, tree)
+    assert '1 new or changed files' in capsys.readouterr().out
+    run(monkeypatch, cleanup, tree)
+    assert capsys.readouterr().out == ''
+    assert (sub / 'x.txt').read_text() == 'edited'
+    assert (tree / 'B' / 'sub' / 'x.txt').exists()
+
+
+def test_path_duplicates_are_deleted(tree, monkeypatch, capsys):
+    write(tree / 'A' / 'sub' / 'x.txt', 'same')
+    write(tree / 'B' / 'sub' / 'x.txt', 'same')
+    run(monkeypatch, crawler, tree)
+    capsys.readouterr()
+
+    run(monkeypatch, cleanup, tree)
+    assert capsys.readouterr().out.split() == [
+        str(tree / 'A' / 'sub' / 'x.txt')]
+    assert not (tree / 'A' / 'sub' / 'x.txt').exists()
+    assert (tree / 'B' / 'sub' / 'x.txt').exists()
+
+
+def stored_files(tree):
+    with connect() as conn:
+        cursor = conn.execute('''
+            SELECT p.name, d.path, f.name FROM files f
+            JOIN parents p ON p.id = f.parent_id
+            JOIN directories d ON d.id = f.directory_id
+        ''')
+        return {os.path.join(*row) for row in cursor}
+
+
+def test_unreadable_directory_keeps_its_files(tree, monkeypatch, capsys):
+    write(tree / 'A' / 'locked' / 'x.txt', 'x')
+    write(tree / 'A' / 'locked' / 'deep' / 'y.txt', 'y')
+    write(tree / 'A' / 'open' / 'z.txt', 'z')
+    run(monkeypatch, crawler, tree)
+    known = stored_files(tree)
+
+    scan_directory = crawler.scan_directory
+    locked = str(tree / 'A' / 'locked')
+
+    def failing_scan(directory_path):
+        if directory_path.rstrip(os.sep) == locked:
+            raise PermissionError(13, 'Permission denied', directory_path)
+        return scan_directory(directory_path)
+
+    monkeypatch.setattr(crawler, 'scan_directory', failing_scan)
+    os.utime(locked, ns=(0, 0))
+    os.remove(tree / 'A' / 'open' / 'z.txt')
+    run(monkeypatch, crawler, tree)
+    assert f'Skipping unreadable [{locked}' in capsys.readouterr().out
+    assert stored_files(tree) == known - {os.path.join('A', 'open', 'z.txt')}
+
+
+def test_identical_files_are_deleted_by_content(tree, monkeypatch):
+    write(tree / 'A' / 'one.txt', 'same content')
+    write(tree / 'A' / 'nested' / 'two.txt', 'same content', MTIME + 5)
+    write(tree / 'B' / 'three.txt', 'same content', MTIME + 9)
+    large = 'x' * (3 * cleanup.SAMPLE_SIZE)
+    write(tree / 'A' / 'large.bin', large)
+    write(tree / 'B' / 'large copy.bin', large, MTIME + 1)
+    run(monkeypatch, crawler, tree)
+
+    run(monkeypatch, cleanup, tree, '--content')
+    remaining = {path.relative_to(tree).as_posix()
+                 for path in tree.rglob('*') if path.is_file()}
+    assert remaining == {'B/three.txt', 'B/large copy.bin'}
+    assert stored_files(tree) == {os.path.join('B', 'three.txt'),
+                                  os.path.join('B', 'large copy.bin')}
+
+
+def test_same_size_different_content_is_kept(tree, monkeypatch, capsys):
+    write(tree / 'A' / 'small.txt', 'content a')
+    write(tree / 'B' / 'small.txt', 'content b')
+    # Same first and last bytes, only the full hash tells them apart
+    edge = 'e' * cleanup.SAMPLE_SIZE
+    write(tree / 'A' / 'large.txt', edge + 'middle a' + edge)
+    write(tree / 'B' / 'large.txt', edge + 'middle b' + edge)
+    run(monkeypatch, crawler, tree)
+    capsys.readouterr()
+
+    run(monkeypatch, cleanup, tree, '--content')
+    output = capsys.readouterr().out
+    assert 'Hashed 2 files in full' in output
+    assert str(tree) not in output
+    assert len([path for path in tree.rglob('*') if path.is_file()]) == 4
+
+
+@pytest.mark.parametrize('content', [False, True])
+def test_dry_run_deletes_nothing(tree, monkeypatch, capsys, content):
+    write(tree / 'A' / 'x.txt', 'same')
+    write(tree / 'B' / 'x.txt', 'same')
+    run(monkeypatch, crawler, tree)
+    known = stored_files(tree)
+    capsys.readouterr()
+
+    run(monkeypatch, cleanup, tree, '-n', *(['--content'] if content else []))
+    assert str(tree / 'A' / 'x.txt') in capsys.readouterr().out
+    assert (tree / 'A' / 'x.txt').exists()
+    assert stored_files(tree) == known
+
+
+def test_path_duplicates_need_the_same_size_and_second(tree, monkeypatch):
+    write(tree / 'A' / 'x.txt', 'same')
+    write(tree / 'B' / 'x.txt', 'same')
+    write(tree / 'C' / 'x.txt', 'same', MTIME + 5)
+    write(tree / 'A' / 'y.txt', 'short')
+    write(tree / 'B' / 'y.txt', 'longer')
+    run(monkeypatch, crawler, tree)
+
+    run(monkeypatch, cleanup, tree)
+    assert not (tree / 'A' / 'x.txt').exists()
+    assert (tree / 'B' / 'x.txt').exists()
+    assert (tree / 'C' / 'x.txt').exists()
+    assert (tree / 'A' / 'y.txt').exists()
+
+
+def test_incremental_crawl_removes_vanished_files(tree, monkeypatch, capsys):
+    write(tree / 'A' / 'keep.txt', 'keep')
+    write(tree / 'A' / 'gone.txt', 'gone')
+    write(tree / 'A' / 'old' / 'deep' / 'x.txt', 'x')
+    write(tree / 'A' / 'same' / 'y.txt', 'y')
+    write(tree / 'B' / 'z.txt', 'z')
+    run(monkeypatch, crawler, tree)
+
+    os.remove(tree / 'A' / 'gone.txt')
+    (tree / 'A' / 'old' / 'deep' / 'x.txt').unlink()
+    (tree / 'A' / 'old' / 'deep').rmdir()
+    (tree / 'A' / 'old').rmdir()
+    write(tree / 'A' / 'new.txt', 'new')
+    (tree / 'B' / 'z.txt').unlink()
+    (tree / 'B').rmdir()
+    capsys.readouterr()
+
+    run(monkeypatch, crawler, tree)
+    output = capsys.readouterr().out
+    assert 'B: no longer exists, 1 removed files' in output
+    assert 'A: rescanned 1 directories, 2 removed files' in output
+    assert stored_files(tree) == {os.path.join('A', 'keep.txt'),
+                                  os.path.join('A', 'new.txt'),
+                                  os.path.join('A', 'same', 'y.txt')}
+    with connect() as conn:
+        paths = {path for path, in conn.execute('SELECT path FROM directories')}
+    assert paths == {'', 'same'}
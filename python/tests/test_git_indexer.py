@@ -0,0 +1,393 @@
+import os
+import subprocess
+
+import pytest
+from whoosh import index
+
+from git_indexer import (GitRepoIndexer, SearchFilters, WriterLimits,
+                         unquote_path)
+from lib.git_objects import GitBlobReader, PackBlobReader, PackFile, apply_delta
+
+GIT_ENV = {
+    'GIT_AUTHOR_NAME': 'Test Author',
+    'GIT_AUTHOR_EMAIL': 'author@example.com',
+    'GIT_COMMITTER_NAME': 'Test Author',
+    'GIT_COMMITTER_EMAIL': 'author@example.com'
+}
+
+
+def git(repo, *args, env=None):
+    return subprocess.run(['git', '-C', str(repo), *args], check=True,
+                          capture_output=True, text=True,
+                          env={**os.environ, **GIT_ENV, **(env or {})}).stdout
+
+
+def make_repo(path, commits, files=3):
+    """Create a repository where every commit changes every file"""
+    git(path.parent, 'init', '--quiet', '-b', 'main', path.name)
+    for number in range(commits):
+        for i in range(files):
+            (path / f'file_{i}.txt').write_text(
+                f'{path.name} commit {number} file {i} word_{number}_{i}\n')
+        git(path, 'add', '-A')
+        git(path, 'commit', '--quiet', '-m', f'commit {number}')
+    return path
+
+
+def test_parallel_index_merges_multi_segment_jobs(tmp_path):
+    repos = tmp_path / 'repos'
+    repos.mkdir()
+    make_repo(repos / 'alpha', 8)
+    make_repo(repos / 'beta', 8)
+
+    # Workers commit every few documents, so each job index has segments
+    indexer = GitRepoIndexer(repos, tmp_path / 'index',
+                             writer_limits=WriterLimits(commit_docs=4))
+    indexer.index_repos(jobs=3)
+
+    ix = index.open_dir(str(tmp_path / 'index'))
+    with ix.searcher() as searcher:
+        assert searcher.doc_count() == 2 * 8 * 3
+    page = indexer.run_search('word_7_2')
+    assert {result['repo'] for result in page.results} == {'alpha', 'beta'}
+
+
+def test_unquote_path_decodes_c_escapes():
+    assert unquote_path('plain name.txt') == 'plain name.txt'
+    assert unquote_path(r'"tab\there"') == 'tab\there'
+    assert unquote_path(r'"say \"hi\" \\ bye"') == 'say "hi" \\ bye'
+    assert unquote_path(r'"caf\303\251.txt"') == 'café.txt'
+
+
+def test_hunk_paths_with_spaces_and_non_ascii(tmp_path):
+    repos = tmp_path / 'repos'
+    repos.mkdir()
+    repo = make_repo(repos / 'alpha', 1)
+    names = ['my file.txt', 'café notes.txt', 'say "hi".txt']
+    for name in names:
+        (repo / name).write_text('first\n')
+    git(repo, 'add', '-A')
+    git(repo, 'commit', '--quiet', '-m', 'unusual names')
+
+    indexer = GitRepoIndexer(repos, tmp_path / 'index')
+    paths = {hunk.path for hunk in indexer.iter_hunks('alpha')}
+    assert set(names) <= paths
+
+    indexer.index_hunks()
+    for name in names:
+        page = indexer.run_search(f"path:'{name}'", 'hunks')
+        assert [result['path'] for result in page.results] == [name]
+
+
+def test_invalid_regex_is_a_value_error(tmp_path):
+    indexer = GitRepoIndexer(tmp_path, tmp_path / 'index')
+    with pytest.raises(ValueError, match='Invalid regular expression'):
+        indexer.compile_pattern('foo(')
+
+
+def test_watermarks_are_checked_in_one_batch(tmp_path):
+    repos = tmp_path / 'repos'
+    repos.mkdir()
+    repo = make_repo(repos / 'alpha', 3)
+    for number in range(20):
+        git(repo, 'tag', f'v{number}')
+    blob = git(repo, 'rev-parse', 'HEAD:file_0.txt').strip()
+    head = git(repo, 'rev-parse', 'HEAD').strip()
+
+    indexer = GitRepoIndexer(repos, tmp_path / 'index', all_refs=True)
+    missing = indexer.missing_commits('alpha', [head, blob, '0' * 40])
+    assert missing == {blob, '0' * 40}
+
+    indexer.index_repos()
+    git(repo, 'commit', '--quiet', '--allow-empty', '-m', 'later')
+    calls = []
+    run_git = indexer.git
+
+    def recording_git(repo_path, *args):
+        calls.append(args)
+        return run_git(repo_path, *args)
+
+    indexer.git = recording_git
+    indexer.index_repos()
+    assert calls and not [args for args in calls if args[0] == 'cat-file']
+
+
+def test_hunk_author_filter_with_comma(tmp_path):
+    repos = tmp_path / 'repos'
+    repos.mkdir()
+    repo = make_repo(repos / 'alpha', 1)
+    (repo / 'notes.txt').write_text('signed off\n')
+    git(repo, 'add', '-A')
+    git(repo, 'commit', '--quiet', '-m', 'notes',
+        env={'GIT_AUTHOR_NAME': 'Doe, Jane'})
+
+    indexer = GitRepoIndexer(repos, tmp_path / 'index')
+    indexer.index_hunks()
+    for author in ['Doe, Jane', 'doe, jane']:
+        page = indexer.run_search('signed', 'hunks',
+                                  filters=SearchFilters(author=author))
+        assert [result['author'] for result in page.results] == ['Doe, Jane']
+    page = indexer.run_search('signed', 'hunks',
+                              filters=SearchFilters(author='Doe'))
+    assert page.results == []
+
+
+def delta_varint(value):
+    data = bytearray()
+    while True:
+        byte = value & 0x7f
+        value >>= 7
+        data.append(byte | (0x80 if value else 0))
+        if not value:
+            return bytes(data)
+
+
+def test_apply_delta_copies_and_inserts():
+    base = b'hello brave new world'
+    # Copy "hello " (offset 0, size 6), insert "old", copy "world"
+    delta = (delta_varint(len(base)) + delta_varint(14)
+             + bytes([0x90, 6]) + bytes([3]) + b'old'
+             + bytes([0x91, 16, 5]))
+    assert apply_delta(base, delta) == b'hello oldworld'
+
+
+def test_apply_delta_copy_size_zero_means_64k():
+    base = bytes(range(256)) * 300
+    delta = delta_varint(len(base)) + delta_varint(0x10000) + bytes([0x80])
+    assert apply_delta(base, delta) == base[:0x10000]
+
+
+def test_apply_delta_rejects_bad_deltas():
+    with pytest.raises(ValueError):
+        apply_delta(b'short', delta_varint(6) + delta_varint(0))
+    with pytest.raises(ValueError):
+        apply_delta(b'abc', delta_varint(3) + delta_varint(1) + bytes([0]))
+    with pytest.raises(ValueError):
+        apply_delta(b'abc', delta_varint(3) + delta_varint(5)
+                    + bytes([0x90, 3]))
+
+
+def make_packed_repo(path):
+    """Create a repository whose history is in one pack full of deltas"""
+    git(path.parent, 'init', '--quiet', '-b', 'main', path.name)
+    lines = [f'line {i} of a file that changes a little\n' for i in range(400)]
+    for number in range(10):
+        lines[number * 7] = f'changed in commit {number}\n'
+        (path / 'big.txt').write_text(''.join(lines))
+        (path / 'small.txt').write_text(f'small {number}\n')
+        git(path, 'add', '-A')
+        git(path, 'commit', '--quiet', '-m', f'commit {number}')
+    git(path, 'repack', '-a', '-d', '-f', '-q', '--depth=50', '--window=50')
+    return path
+
+
+def pack_index_entries(idx_path):
+    with open(idx_path, 'rb') as f:
+        output = subprocess.run(['git', 'show-index'], stdin=f, check=True,
+                                capture_output=True, text=True).stdout
+    return {sha: int(offset)
+            for offset, sha, *_ in map(str.split, output.splitlines())}
+
+
+def test_pack_index_lookup(tmp_path):
+    repo = make_packed_repo(tmp_path / 'alpha')
+    pack_dir = repo / '.git' / 'objects' / 'pack'
+    idx_path, = pack_dir.glob('*.idx')
+    pack_path = idx_path.with_suffix('.pack')
+
+    # Writing a second index with every offset in the 64-bit table
+    large_idx = tmp_path / 'large.idx'
+    subprocess.run(['git', 'index-pack', '--index-version=2,0', '-o',
+                    str(large_idx), str(pack_path)], check=True,
+                   capture_output=True)
+    (tmp_path / 'large.pack').write_bytes(pack_path.read_bytes())
+
+    for path in (idx_path, large_idx):
+        pack = PackFile(str(path))
+        try:
+            entries = pack_index_entries(path)
+            assert pack.count == len(entries)
+            for sha, offset in entries.items():
+                assert pack.find(bytes.fromhex(sha)) == offset
+            assert pack.find(b'\x00' * 20) is None
+            assert pack.find(b'\xff' * 20) is None
+        finally:
+            pack.close()
+
+
+def test_pack_reader_matches_cat_file(tmp_path):
+    repo = make_packed_repo(tmp_path / 'alpha')
+    objects = git(repo, 'rev-list', '--objects', '--all').split('\n')
+    names = [line.split()[0] for line in objects if line]
+
+    with GitBlobReader(str(repo)) as git_reader, \
+            PackBlobReader(str(repo)) as pack_reader:
+        # Ask git for everything by name so none of it comes from the packs
+        expected = dict(git_reader.read_many(names))
+        assert dict(pack_reader.read_many(names)) == expected
+        assert (dict(pack_reader.info_many(names))
+                == dict(git_reader.info_many(names)))
+        assert all(pack_reader.lookup(name) is not None for name in names)
+
+
+def test_full_scan_notice_is_returned_not_printed(tmp_path, capsys):
+    repos = tmp_path / 'repos'
+    repos.mkdir()
+    make_repo(repos / 'alpha', 2)
+    indexer = GitRepoIndexer(repos, tmp_path / 'index')
+    indexer.index_repos()
+    capsys.readouterr()
+
+    page = indexer.run_search('w.rd', mode='regex')
+    assert page.results
+    assert 'scanning every blob' in page.notice
+    assert capsys.readouterr().out == ''
+    assert indexer.run_search('word_1', mode='regex').notice is None
+
+
+@pytest.mark.parametrize('jobs', [1, 2])
+def test_oversized_blobs_are_indexed_once_they_fit(tmp_path, jobs):
+    repos = tmp_path / 'repos'
+    repos.mkdir()
+    repo = make_repo(repos / 'alpha', 2)
+    (repo / 'large.txt').write_text('needle_large\n' + 'filler\n' * 300)
+    git(repo, 'add', '-A')
+    git(repo, 'commit', '--quiet', '-m', 'large')
+    git(repo, 'commit', '--quiet', '--allow-empty', '-m', 'later')
+    (repo / 'moved').mkdir()
+    git(repo, 'mv', 'large.txt', 'moved/large.txt')
+    git(repo, 'commit', '--quiet', '-m', 'move')
+
+    GitRepoIndexer(repos, tmp_path / 'index', 1000).index_repos(jobs=jobs)
+    assert GitRepoIndexer(repos, tmp_path / 'index').run_search(
+        'needle_large').results == []
+
+    # Nothing new was committed, the skipped blob is picked up from state
+    indexer = GitRepoIndexer(repos, tmp_path / 'index', 10000)
+    indexer.index_repos(jobs=jobs)
+    page = indexer.run_search('needle_large')
+    assert {result['path'] for result in page.results} == {'large.txt',
+                                                           'moved/large.txt'}
+    indexer.index_repos(jobs=jobs)
+    assert len(indexer.run_search('needle_large').results) == 2
+
+
+def test_oversized_snapshot_files_are_indexed_once_they_fit(tmp_path):
+    repos = tmp_path / 'repos'
+    repos.mkdir()
+    repo = make_repo(repos / 'alpha', 1)
+    (repo / 'large.txt').write_text('needle_large\n' + 'filler\n' * 300)
+    git(repo, 'add', '-A')
+    git(repo, 'commit', '--quiet', '-m', 'large')
+
+    GitRepoIndexer(repos, tmp_path / 'index', 1000).index_snapshot()
+    indexer = GitRepoIndexer(repos, tmp_path / 'index', 10000)
+    assert indexer.run_search('needle_large', 'snapshot').results == []
+    indexer.index_snapshot()
+    page = indexer.run_search('needle_large', 'snapshot')
+    assert [result['path'] for result in page.results] == ['large.txt']
+
+
+@pytest.mark.parametrize('config', [
+    ['diff.noprefix', 'true'],
+    ['diff.srcPrefix', 'src/'],
+    ['diff.mnemonicPrefix', 'true'],
+])
+def test_hunk_paths_ignore_diff_prefix_config(tmp_path, config):
+    repos = tmp_path / 'repos'
+    repos.mkdir()
+    repo = make_repo(repos / 'alpha', 2)
+    git(repo, 'config', *config)
+
+    indexer = GitRepoIndexer(repos, tmp_path / 'index')
+    paths = {hunk.path for hunk in indexer.iter_hunks('alpha')}
+    assert paths == {'file_0.txt', 'file_1.txt', 'file_2.txt'}
+
+
+def commit_file(repo, name, text, message):
+    (repo / name).write_text(text)
+    git(repo, 'add', '-A')
+    git(repo, 'commit', '--quiet', '-m', message)
+    return git(repo, 'rev-parse', 'HEAD').strip()
+
+
+def search_ref(indexer, text, ref):
+    page = indexer.run_search(text, filters=SearchFilters(ref=ref))
+    return {result['path'] for result in page.results}
+
+
+def test_all_refs_index_branches_and_filter_by_ref(tmp_path):
+    repos = tmp_path / 'repos'
+    repos.mkdir()
+    repo = make_repo(repos / 'alpha', 2)
+    git(repo, 'checkout', '--quiet', '-b', 'feature')
+    commit_file(repo, 'feature.txt', 'feature_only\n', 'feature')
+    git(repo, 'checkout', '--quiet', 'main')
+
+    # Without --all-refs only the checked out branch is indexed
+    GitRepoIndexer(repos, tmp_path / 'head').index_repos()
+    assert GitRepoIndexer(repos, tmp_path / 'head').run_search(
+        'feature_only').results == []
+
+    indexer = GitRepoIndexer(repos, tmp_path / 'index', all_refs=True)
+    indexer.index_repos()
+    assert search_ref(indexer, 'feature_only', None) == {'feature.txt'}
+    assert search_ref(indexer, 'feature_only', 'feature') == {'feature.txt'}
+    assert search_ref(indexer, 'feature_only', 'refs/heads/feature') == {
+        'feature.txt'}
+    assert search_ref(indexer, 'feature_only', 'main') == set()
+    # History shared by both branches matches either of them
+    assert search_ref(indexer, 'word_1_0', 'main') == {'file_0.txt'}
+    assert search_ref(indexer, 'word_1_0', 'feature') == {'file_0.txt'}
+
+
+def test_force_push_reindexes_from_the_merge_base(tmp_path, capsys):
+    repos = tmp_path / 'repos'
+    repos.mkdir()
+    repo = make_repo(repos / 'alpha', 3)
+    commit_file(repo, 'extra.txt', 'rewritten_away\n', 'extra')
+    indexer = GitRepoIndexer(repos, tmp_path / 'index')
+    indexer.index_repos()
+    assert search_ref(indexer, 'rewritten_away', None) == {'extra.txt'}
+
+    git(repo, 'reset', '--quiet', '--hard', 'HEAD~2')
+    commit_file(repo, 'extra.txt', 'replacement\n', 'replacement')
+    capsys.readouterr()
+    indexer.index_repos()
+    output = capsys.readouterr().out
+    assert 'was rewritten, falling back to merge-base' in output
+    assert 'processed 1 new commits' in output
+
+    assert search_ref(indexer, 'replacement', None) == {'extra.txt'}
+    assert search_ref(indexer, 'rewritten_away', None) == set()
+    assert search_ref(indexer, 'word_2_0', None) == set()
+    assert search_ref(indexer, 'word_1_0', None) == {'file_0.txt'}
+
+
+def test_rewritten_ref_drops_commits_from_its_filter(tmp_path, capsys):
+    repos = tmp_path / 'repos'
+    repos.mkdir()
+    repo = make_repo(repos / 'alpha', 2)
+    git(repo, 'checkout', '--quiet', '-b', 'feature')
+    commit_file(repo, 'kept.txt', 'kept_by_tag\n', 'tagged')
+    git(repo, 'tag', 'keep')
+    commit_file(repo, 'gone.txt', 'only_rewritten\n', 'dropped')
+    indexer = GitRepoIndexer(repos, tmp_path / 'index', all_refs=True)
+    indexer.index_repos()
+    assert search_ref(indexer, 'kept_by_tag', 'feature') == {'kept.txt'}
+    assert search_ref(indexer, 'only_rewritten', 'feature') == {'gone.txt'}
+
+    # Rewrite feature onto main, the tag still holds one old commit
+    git(repo, 'reset', '--quiet', '--hard', 'main')
+    commit_file(repo, 'new.txt', 'after_rewrite\n', 'rewritten')
+    capsys.readouterr()
+    indexer.index_repos()
+    assert '1 indexed commits are no longer on any ref' in (
+        capsys.readouterr().out)
+
+    assert search_ref(indexer, 'after_rewrite', 'feature') == {'new.txt'}
+    assert search_ref(indexer, 'only_rewritten', 'feature') == set()
+    assert search_ref(indexer, 'only_rewritten', None) == set()
+    assert search_ref(indexer, 'kept_by_tag', 'feature') == set()
+    assert search_ref(indexer, 'kept_by_tag', 'keep') == {'kept.txt'}
+    assert search_ref(indexer, 'word_1_0', 'feature') == {'file_0.txt'}